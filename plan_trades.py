@@ -0,0 +1,52 @@
+#!/bin/env python
+
+import json
+from argparse import ArgumentParser
+from os.path import join
+from trade import Dex, check_file
+from trade.plan import blast, make_plan
+from trade.quote import QuoteEngine
+from trade.traffic import make_profile
+
+
+parser = ArgumentParser(prog='plan_trades')
+commands = parser.add_subparsers(dest='command', required=True)
+make = commands.add_parser('make', help='Generate a file of pre-signed trades')
+make.add_argument('plan', metavar='PATH', help='Plan file to write')
+make.add_argument('--router', metavar='AccountId', required=True, help='Router address on chain')
+make.add_argument('--common', metavar='PATH', type=str, default='./common-amm', help='Path to common-amm')
+make.add_argument('--url', metavar='URL', type=str, default='local', help='Chain WebSocket URL')
+make.add_argument('--phrase', metavar='PHRASE', type=str, default='//Trader', help='Base phrase of trader accounts')
+make.add_argument('--traders', metavar='NUM', type=int, default=10, help='Number of trader accounts')
+make.add_argument('--trades', metavar='NUM', type=int, default=1000, help='Number of trades')
+make.add_argument('--steps', metavar='JSON', type=json.loads, default=1, help='Max swaps per trade, or a mix like \'{"1": 0.7, "2": 0.3}\'')
+make.add_argument('--seed', metavar='NUM', type=int, default=0, help='Random seed')
+make.add_argument('--workers', metavar='NUM', type=int, help='Processes used for signing')
+run = commands.add_parser('blast', help='Submit a plan at the given rate')
+run.add_argument('plan', metavar='PATH', help='Plan file')
+run.add_argument('--url', metavar='URL', type=str, help='Chain WebSocket URL (default: the one used for planning)')
+run.add_argument('--rate', metavar='TPS', type=float, help='Constant rate (default: as fast as possible)')
+run.add_argument('--profile', metavar='JSON', type=json.loads, help='Rate profile, e.g. \'{"type": "poisson", "rate": 100}\'')
+run.add_argument('--connections', metavar='NUM', type=int, default=4, help='Number of connections (threads)')
+run.add_argument('--force', action='store_true', help='Submit even if the plan does not match the chain')
+args = parser.parse_args()
+
+if args.command == 'make':
+    metadata_dir = join(args.common, 'artifacts')
+    metadata_files = {
+        'router': check_file(metadata_dir, 'router_contract.json'),
+        'factory': check_file(metadata_dir, 'factory_contract.json'),
+        'pair': check_file(metadata_dir, 'pair_contract.json'),
+        'psp22': check_file(metadata_dir, 'psp22.json')
+    }
+    dex = Dex(args.url, args.router, metadata_files, report=False)
+    dex.fetch_info()
+    steps = {int(k): w for k, w in args.steps.items()} if isinstance(args.steps, dict) else args.steps
+    dex.build_path_index(max(steps) if isinstance(steps, dict) else steps)
+    quotes = QuoteEngine(dex)
+    quotes.fetch_reserves()
+    header = make_plan(dex, args.phrase, args.traders, args.trades, args.plan, steps, args.seed, quotes, args.workers)
+    print(f'{header["trades"]} trades of {len(header["accounts"])} accounts written to {args.plan}')
+else:
+    profile = make_profile(args.profile) if args.profile else None
+    print(blast(args.plan, args.url, profile, args.rate, args.connections, force=args.force))
@@ -0,0 +1,51 @@
+#!/bin/env python
+
+from argparse import ArgumentParser
+from sys import exit
+from trade.profiler import report as profile_report
+from trade.scenario import compare_results, load_results, load_scenario, run_scenario, save_results
+
+
+parser = ArgumentParser(prog='run_benchmark')
+commands = parser.add_subparsers(dest='command', required=True)
+run = commands.add_parser('run', help='Run a scenario and write results')
+run.add_argument('scenario', metavar='PATH', help='Scenario file (JSON), see trade/scenario.py for the keys')
+run.add_argument('--results', metavar='PATH', required=True, help='Where to write results (JSON)')
+run.add_argument('--router', metavar='AccountId', help='Router address on chain (overrides the scenario)')
+run.add_argument('--common', metavar='PATH', type=str, help='Path to common-amm (overrides the scenario)')
+run.add_argument('--baseline', metavar='PATH', help='Results of an earlier run to compare with')
+run.add_argument('--profile', action='store_true', help='Profile the client side of traders (overrides the scenario)')
+compare = commands.add_parser('compare', help='Compare results of two runs')
+compare.add_argument('old', metavar='OLD', help='Baseline results')
+compare.add_argument('new', metavar='NEW', help='New results')
+for p in (run, compare):
+    p.add_argument('--tolerance', metavar='FRACTION', type=float, default=0.05, help='Relative change treated as a regression')
+args = parser.parse_args()
+
+
+def report(old, new, tolerance):
+    rows = compare_results(old, new, tolerance)
+    print(f'{"":20}{old["scenario"]["name"]:>16}{new["scenario"]["name"]:>16}{"change":>10}')
+    for name, a, b, change, regression in rows:
+        print(f'{name:20}{a:16.3f}{b:16.3f}{change:+10.1%}{"   REGRESSION" if regression else ""}')
+    return any(row[4] for row in rows)
+
+
+if args.command == 'run':
+    scenario = load_scenario(args.scenario)
+    if args.router:
+        scenario['router'] = args.router
+    if args.common:
+        scenario['common'] = args.common
+    if args.profile:
+        scenario['client_profile'] = True
+    results = run_scenario(scenario)
+    save_results(results, args.results)
+    if results['client_profile']:
+        print(profile_report(results['client_profile']))
+    print(f'Results written to {args.results}')
+    if args.baseline and report(load_results(args.baseline), results, args.tolerance):
+        exit(1)
+else:
+    if report(load_results(args.old), load_results(args.new), args.tolerance):
+        exit(1)
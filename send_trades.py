@@ -1,28 +1,22 @@
 #!/bin/env python
 
-import re
 from argparse import ArgumentParser
 from os.path import join
-from trade import Dex, Trader, check_file
-
-
-def get_timings(logfile, skip_first=0):
-    regexp = r'.*call.*Ok.(\d+)'
-    with open(logfile, encoding='utf-8') as f:
-        log = f.read()
-    entries = re.findall(regexp, log)[(2 * skip_first):]
-    res = []
-    for i in range(0, len(entries), 2):
-        res.append(int(entries[i + 1]) - int(entries[i]))
-    return res
+from trade import Dex, GasCache, MetricsCollector, TimingCollector, Trader, check_file, profiler
 
 
 parser = ArgumentParser(prog='send_trades')
 parser.add_argument('--router', metavar='AccountId', required=True, help='Router address on chain')
 parser.add_argument('--trades', metavar='NUM', type=int, default=10, help='Number of trades to send')
 parser.add_argument('--common', metavar='PATH', type=str, default='./common-amm', help='Path to common-amm')
-parser.add_argument('--node-log', metavar='PATH', type=str, help='Path to the log of running node')
+parser.add_argument('--node-log', metavar='PATH', type=str, help='Path to the log of running node (run with -lbasic-authorship=trace)')
+parser.add_argument('--metrics', metavar='PATH', type=str, help='Write trade metrics summary (JSON) to this file')
+parser.add_argument('--batch', metavar='NUM', type=int, default=1, help='Number of swaps packed into a single Utility::batch extrinsic')
+parser.add_argument('--cache-gas', action='store_true', help='Reuse gas estimates instead of a dry-run before each trade')
+parser.add_argument('--profile', action='store_true', help='Print time spent in each client-side stage of trading')
 args = parser.parse_args()
+if args.node_log and args.batch > 1:
+    parser.error('--node-log times single Contracts::call extrinsics, it cannot be used with --batch > 1')
 logfile = check_file(args.node_log) if args.node_log else None
 
 metadata_dir = join(args.common, 'artifacts')
@@ -39,13 +33,30 @@ trader_phrase = '//Alice'
 dex = Dex(chain_url, args.router, metadata_files, report=True)
 dex.fetch_info()
 
-tr = Trader(dex, trader_phrase)
+metrics = MetricsCollector() if args.metrics else None
+tr = Trader(dex, trader_phrase, gas_cache=GasCache() if args.cache_gas else None, metrics=metrics.sink(trader_phrase) if metrics else None)
 tr.update_balances()
 tr.set_allowances()
 
+collector = TimingCollector(logfile) if logfile else None
+if metrics:
+    metrics.start()
+if args.profile:
+    profiler.enable()
+
 for _ in range(args.trades):
-    if logfile:
-        skip = len(get_timings(logfile, 0))
-    tr.trade(1)
-    if logfile:
-        print(f'Walltime {get_timings(logfile, skip)[0]} ns')
+    receipt = tr.trade(1) if args.batch == 1 else tr.trade_batch([1] * args.batch)[0]
+    if collector and receipt.is_success:
+        timing = collector.wait_for(receipt.extrinsic_hash)
+        print(f'Walltime {timing.walltime} ns' if timing else 'Walltime not found in the node log')
+
+if metrics:
+    tr.metrics.flush()
+    metrics.stop()
+    metrics.export_json(args.metrics)
+
+if args.profile:
+    print(profiler.report(profiler.current().summary()))
+
+if args.cache_gas:
+    print(f'Gas cache: {tr.gas_cache.stats()}')
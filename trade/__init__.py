@@ -1,3 +1,10 @@
 from .dex import Dex
+from .endpoints import EndpointPool
+from .engine import AsyncTraderPool
+from .metrics import MetricsCollector
+from .observer import BlockObserver
+from .pipeline import BlockWatcher, Pipeline
+from .provision import Provisioner
+from .timings import TimingCollector
 from .trader import Trader
-from .utils import check_address, check_file, check_url
\ No newline at end of file
+from .utils import GasCache, check_address, check_file, check_url
@@ -1,10 +1,17 @@
+import json
 import pickle
 import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from os.path import join
-from substrateinterface import ContractInstance, Keypair, SubstrateInterface
+from functools import lru_cache
+from substrateinterface import Keypair
 from substrateinterface.exceptions import ContractReadFailedException
 
-from .utils import check_file, check_url
+from .paths import PathIndex
+from .utils import check_file, connect, read_metadata
+
+SNAPSHOT_VERSION = 1
 
 
 class Dex:
@@ -15,6 +22,7 @@ class Dex:
 
     Apart from fetch_info(), which interacts with the chain, this object is totally static and offline
     (dictionaries of strings). Can be safely juggled between different processes, copied, pickled etc.
+    For large dexes prefer save_snapshot()/load_snapshot() followed by refresh(), which fetches only new pairs.
     """
 
     def __init__(self, chain_url, router_address, metadata_dict, report=True):
@@ -30,12 +38,26 @@ class Dex:
         self.tokens = {}
         self.token_symbols = {}
         self.pairs = {}
+        self.n_pairs = 0
+        self.path_index = None
 
     def log(self, msg):
         if self.report:
             print(msg, end='')
 
+    def preload_metadata(self):
+        """Parse all contract metadata files in this process, so that workers forked later do not repeat it."""
+        for f in (self.router_metadata, self.factory_metadata, self.pair_metadata, self.psp22_metadata):
+            read_metadata(f)
+
+    def build_path_index(self, max_length=3):
+        """Precompute trade paths (see PathIndex). Must be called again after the dex structure changes."""
+        self.path_index = PathIndex(self, max_length)
+        return self.path_index
+
     def random_path(self, start, max_length=1):
+        if self.path_index is not None and max_length <= self.path_index.max_length:
+            return self.path_index.random_path(start, max_length)
         result = [start]
         while len(result) <= max_length:
             candidates = set(self.tokens[result[-1]]) - set(result)
@@ -47,7 +69,10 @@ class Dex:
     def get_pair(self, token_0, token_1):
         return self.pairs[(token_0, token_1)] if token_0 < token_1 else self.pairs[(token_1, token_0)]
 
-    def fetch_info(self):
+    def connect(self, endpoints=None):
+        return endpoints.connect() if endpoints is not None else connect(self.chain_url)
+
+    def fetch_info(self, workers=1, endpoints=None):
         """Call the chain and fetch the following info:
             a) factory address
             b) wnative address
@@ -56,50 +81,112 @@ class Dex:
             e) if possible, also tokens symbols
 
         Store the dex structure in self.tokens dict, in a form of graph of psp22 token addresses.
-        """
 
-        kp = Keypair.create_from_uri('//Alice')  # dummy keypair for read methods
-        chain = SubstrateInterface(url=check_url(self.chain_url))
-
-        router = ContractInstance.create_from_address(self.router_address, self.router_metadata, chain)
-        self.factory_address = router.read(kp, method='Router::factory').contract_result_data.value['Ok']
+        With `workers` > 1, reads of pairs and token symbols are spread over that many threads,
+        each with its own connection to the chain. The resulting structure is the same as for a single worker.
+        With `endpoints` (an EndpointPool) connections are taken from the pool instead of `chain_url`.
+        """
+        chain = self.connect(endpoints)
+        reader = Reader(chain)
+        router = reader.contract(self.router_address, self.router_metadata)
+        self.factory_address = router.read(reader.kp, method='Router::factory').contract_result_data.value['Ok']
         self.log(f'Factory address: {self.factory_address}\n')
-        self.wnative_address = router.read(kp, method='Router::wnative').contract_result_data.value['Ok']
+        self.wnative_address = router.read(reader.kp, method='Router::wnative').contract_result_data.value['Ok']
         self.log(f'Wnative address: {self.wnative_address}\n')
-
-        factory = ContractInstance.create_from_address(self.factory_address, self.factory_metadata, chain)
-        n_pairs = factory.read(kp, method='Factory::all_pairs_length').contract_result_data.value['Ok']
-        self.log(f'Found {n_pairs} trading pairs.\nFetching pair info...')
-
-        for i in range(n_pairs):
-            self.log(f' {i}')
-            pair_address = factory.read(kp, method='Factory::all_pairs', args={'pid': i}).contract_result_data.value['Ok']
-            pair = ContractInstance.create_from_address(pair_address, self.pair_metadata, chain)
-            token_0 = pair.read(kp, method='Pair::get_token_0').contract_result_data.value['Ok']
-            token_1 = pair.read(kp, method='Pair::get_token_1').contract_result_data.value['Ok']
-            if token_0 not in self.tokens:
-                self.tokens[token_0] = []
-            self.tokens[token_0].append(token_1)
-            if token_1 not in self.tokens:
-                self.tokens[token_1] = []
-            self.tokens[token_1].append(token_0)
-            if token_0 < token_1:
-                self.pairs[(token_0, token_1)] = pair_address
-            else:
-                self.pairs[(token_1, token_0)] = pair_address
-
-        self.log('\nAll pairs processed. Fetching token symbols\n')
-        for t in self.tokens:
-            token = ContractInstance.create_from_address(t, self.psp22_metadata, chain)
-            try:
-                self.token_symbols[t] = token.read(kp, method='PSP22Metadata::token_symbol').contract_result_data.value['Ok']
-            except ContractReadFailedException:
-                self.token_symbols[t] = None
+        self.tokens, self.token_symbols, self.pairs, self.n_pairs, self.path_index = {}, {}, {}, 0, None
+        self.fetch_new_pairs(workers, chain, endpoints)
+        if endpoints is not None:
+            endpoints.release(chain)
 
         self.log(f'Found {len(self.tokens)} tokens:\n')
         for addr, sym in self.token_symbols.items():
             self.log(f' {sym}\t  {addr}\n')
 
+    def refresh(self, workers=1, endpoints=None):
+        """Fetch only pairs created since the last fetch (pair index >= self.n_pairs) and symbols of new tokens.
+        Return the number of new pairs."""
+        if self.factory_address is None:
+            self.fetch_info(workers, endpoints)
+            return self.n_pairs
+        old = self.n_pairs
+        chain = self.connect(endpoints)
+        self.fetch_new_pairs(workers, chain, endpoints)
+        if endpoints is not None:
+            endpoints.release(chain)
+        return self.n_pairs - old
+
+    def fetch_new_pairs(self, workers, chain, endpoints=None):
+        reader = Reader(chain)
+        factory = reader.contract(self.factory_address, self.factory_metadata)
+        n_pairs = factory.read(reader.kp, method='Factory::all_pairs_length').contract_result_data.value['Ok']
+        self.log(f'Found {n_pairs - self.n_pairs} new trading pairs.\nFetching pair info...')
+
+        for pair_address, token_0, token_1 in self.map_reads(self.read_pair, range(self.n_pairs, n_pairs), workers, chain, endpoints):
+            self.add_pair(pair_address, token_0, token_1)
+        if n_pairs > self.n_pairs:
+            self.path_index = None
+        self.n_pairs = n_pairs
+
+        self.log('\nAll pairs processed. Fetching token symbols\n')
+        tokens = [t for t in self.tokens if t not in self.token_symbols]
+        for t, symbol in zip(tokens, self.map_reads(self.read_symbol, tokens, workers, chain, endpoints)):
+            self.token_symbols[t] = symbol
+
+    def add_pair(self, pair_address, token_0, token_1):
+        if token_0 not in self.tokens:
+            self.tokens[token_0] = []
+        self.tokens[token_0].append(token_1)
+        if token_1 not in self.tokens:
+            self.tokens[token_1] = []
+        self.tokens[token_1].append(token_0)
+        if token_0 < token_1:
+            self.pairs[(token_0, token_1)] = pair_address
+        else:
+            self.pairs[(token_1, token_0)] = pair_address
+
+    def map_reads(self, read, items, workers, chain, endpoints=None):
+        """Apply `read(reader, item)` to all items, return results in order. With `workers` > 1 use a thread pool,
+        each thread with its own connection (SubstrateInterface is not thread safe).
+        With `endpoints`, reads interrupted by a connection error are retried on another node."""
+        if workers <= 1:
+            reader = Reader(chain)
+            if endpoints is None:
+                return [read(reader, x) for x in items]
+            return [endpoints.call(chain, read, reader, x) for x in items]
+        local = threading.local()
+        readers = []
+
+        def task(x):
+            if not hasattr(local, 'reader'):
+                local.reader = Reader(self.connect(endpoints))
+                readers.append(local.reader)
+            if endpoints is None:
+                return read(local.reader, x)
+            return endpoints.call(local.reader.chain, read, local.reader, x)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            result = list(executor.map(task, items))
+        if endpoints is not None:
+            for reader in readers:
+                endpoints.release(reader.chain)
+        return result
+
+    def read_pair(self, reader, i):
+        self.log(f' {i}')
+        factory = reader.contract(self.factory_address, self.factory_metadata)
+        pair_address = factory.read(reader.kp, method='Factory::all_pairs', args={'pid': i}).contract_result_data.value['Ok']
+        pair = reader.contract(pair_address, self.pair_metadata)
+        token_0 = pair.read(reader.kp, method='Pair::get_token_0').contract_result_data.value['Ok']
+        token_1 = pair.read(reader.kp, method='Pair::get_token_1').contract_result_data.value['Ok']
+        return pair_address, token_0, token_1
+
+    def read_symbol(self, reader, token_address):
+        token = reader.contract(token_address, self.psp22_metadata)
+        try:
+            return token.read(reader.kp, method='PSP22Metadata::token_symbol').contract_result_data.value['Ok']
+        except ContractReadFailedException:
+            return None
+
     def save_to_file(self, path='', filename=None):
         if filename is None:
             chain_id = self.chain_url.split('/')[-1]
@@ -113,3 +200,69 @@ class Dex:
     def load_from_file(cls, filename):
         with open(check_file(filename), 'rb') as f:
             return pickle.load(f)
+
+    def save_snapshot(self, path='', filename=None):
+        """Save the dex structure in a compact, versioned JSON format: a table of tokens (address, symbol),
+        a table of pairs (address, token indices) in factory order and the `all_pairs_length` watermark."""
+        if filename is None:
+            chain_id = self.chain_url.split('/')[-1]
+            filename = f'{chain_id}.{self.router_address[:6]}.snapshot.json'
+        path = join(path, filename)
+        index = {t: i for i, t in enumerate(self.tokens)}
+        snapshot = {
+            'version': SNAPSHOT_VERSION,
+            'chain_url': self.chain_url,
+            'router': self.router_address,
+            'factory': self.factory_address,
+            'wnative': self.wnative_address,
+            'all_pairs_length': self.n_pairs,
+            'tokens': [[t, self.token_symbols.get(t)] for t in self.tokens],
+            'pairs': [[addr, index[t0], index[t1]] for (t0, t1), addr in self.pairs.items()]
+        }
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, separators=(',', ':'))
+        self.log(f'Dex snapshot saved to {path}\n')
+
+    @classmethod
+    def load_snapshot(cls, filename, metadata_dict, report=True):
+        """Create Dex from a file written by save_snapshot(). Call refresh() to fetch pairs created since then."""
+        with open(check_file(filename), encoding='utf-8') as f:
+            snapshot = json.load(f)
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            raise ValueError(f'Unsupported dex snapshot version: {snapshot.get("version")}')
+        dex = cls(snapshot['chain_url'], snapshot['router'], metadata_dict, report)
+        dex.factory_address = snapshot['factory']
+        dex.wnative_address = snapshot['wnative']
+        tokens = [t for t, _ in snapshot['tokens']]
+        dex.tokens = {t: [] for t in tokens}
+        for addr, i0, i1 in snapshot['pairs']:
+            dex.add_pair(addr, tokens[i0], tokens[i1])
+        dex.token_symbols = {t: sym for t, sym in snapshot['tokens']}
+        dex.n_pairs = snapshot['all_pairs_length']
+        return dex
+
+
+@lru_cache(maxsize=None)
+def dummy_keypair():
+    return Keypair.create_from_uri('//Alice')
+
+
+class Reader:
+    """Connection used for dex reads, together with contract metadata set up once for that connection
+    and contract handles created on first use. `kp` is used for dry-runs (a dummy keypair by default)."""
+    def __init__(self, chain, kp=None):
+        self.chain = chain
+        self.kp = kp or dummy_keypair()
+        self.metadata = {}
+        self.contracts = {}
+
+    def contract_metadata(self, metadata_file):
+        if metadata_file not in self.metadata:
+            self.metadata[metadata_file] = self.chain.contract_metadata(metadata_file)
+        return self.metadata[metadata_file]
+
+    def contract(self, address, metadata_file):
+        key = (address, metadata_file)
+        if key not in self.contracts:
+            self.contracts[key] = self.chain.contract(address, self.contract_metadata(metadata_file))
+        return self.contracts[key]
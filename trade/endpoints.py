@@ -0,0 +1,189 @@
+from multiprocessing import Array, Lock
+from threading import Thread
+from time import sleep, time
+from websocket import WebSocketConnectionClosedException, WebSocketTimeoutException
+
+from .utils import check_url, connect, last_signed
+
+CONNECTION_ERRORS = (WebSocketConnectionClosedException, WebSocketTimeoutException, ConnectionError, TimeoutError)
+
+
+class EndpointPool:
+    """Set of node endpoints shared by all traders of a run, possibly living in different processes.
+
+    `urls` is a list of WebSocket URLs (or aliases accepted by check_url), or a dict mapping them to weights.
+    connect() returns a SubstrateInterface to the endpoint with the lowest load relative to its weight, among
+    endpoints considered healthy. Load (number of connections handed out) and health are kept in shared memory,
+    so a pool created before spawning worker processes balances connections of all of them.
+
+    Health: start_probes() runs a thread (in the process which calls it) checking every endpoint with system_health
+    each `probe_interval` seconds. An endpoint is also marked down by whoever hits a connection error on it.
+    Without probes (or if they stop), an endpoint marked down is tried again `readmit` seconds later, and marked
+    down again if it still fails. A node coming back gets new connections again; existing connections are not migrated.
+
+    Failures: call(chain, fn, ...) runs `fn` and, on a connection error, moves `chain` to another healthy endpoint
+    (or the same one once it answers again), waiting with exponential backoff between `backoff` bounds, and retries
+    `fn` up to `retries` times. The SubstrateInterface object is kept, so contract handles created on it stay valid.
+    A retried call which had already reached the node would be executed twice, so functions sending extrinsics
+    go through submit(chain, address, fn, ...) instead: they are retried only if the nonce of `address` shows that
+    nothing reached the node.
+
+    Usage pattern:
+    endpoints = EndpointPool({'ws://127.0.0.1:9944': 2, 'ws://127.0.0.1:9945': 1})
+    endpoints.start_probes()
+    dex.fetch_info(endpoints=endpoints)
+    pool = TraderPool(dex, 100, phrase, endpoints=endpoints)
+    """
+    def __init__(self, urls, probe_interval=5, backoff=(0.5, 30), retries=5, readmit=30):
+        weights = urls if isinstance(urls, dict) else {u: 1 for u in urls}
+        if not weights:
+            raise ValueError('EndpointPool needs at least one URL')
+        self.urls = [check_url(u) for u in weights]
+        self.weights = list(weights.values())
+        self.probe_interval = probe_interval
+        self.backoff = backoff
+        self.retries = retries
+        self.readmit = readmit
+        self.lock = Lock()
+        self.load = Array('i', len(self.urls), lock=False)
+        self.healthy = Array('b', [1] * len(self.urls), lock=False)
+        self.down_since = Array('d', len(self.urls), lock=False)
+        self.assigned = {}
+        self.running = False
+
+    @classmethod
+    def local(cls, n_nodes, first_port=9944, **kwargs):
+        """Pool of `n_nodes` nodes of a local testnet listening on consecutive ports."""
+        return cls([f'ws://127.0.0.1:{first_port + i}' for i in range(n_nodes)], **kwargs)
+
+    def pick(self, exclude=None):
+        """Reserve a slot on the least loaded endpoint (relative to weight) and return its index.
+        Prefers healthy endpoints other than `exclude`, falls back to any endpoint if none is healthy."""
+        with self.lock:
+            up = [i for i in range(len(self.urls)) if self.available(i)]
+            candidates = [i for i in up if i != exclude] or up or list(range(len(self.urls)))
+            best = min(candidates, key=lambda i: (self.load[i] / self.weights[i], i))
+            self.load[best] += 1
+            return best
+
+    def available(self, i):
+        return self.healthy[i] or time() - self.down_since[i] > self.readmit
+
+    def unpick(self, i):
+        with self.lock:
+            self.load[i] -= 1
+
+    def release(self, chain):
+        """Give back the slot taken by `chain` (after closing it, or when it is no longer used)."""
+        i = self.assigned.pop(id(chain), None)
+        if i is not None:
+            self.unpick(i)
+
+    def connect(self):
+        """Return a new SubstrateInterface connected to the best endpoint, trying others if it does not answer."""
+        for attempt in range(self.retries + 1):
+            i = self.pick()
+            try:
+                chain = connect(self.urls[i])
+            except CONNECTION_ERRORS:
+                self.unpick(i)
+                self.mark_down(i)
+                self.sleep(attempt)
+                continue
+            self.assigned[id(chain)] = i
+            return chain
+        raise ConnectionError(f'No endpoint available out of {self.urls}')
+
+    def reconnect(self, chain):
+        """Move `chain` to another endpoint (after marking the current one down). Blocks until it succeeds
+        or `retries` attempts fail."""
+        current = self.assigned.get(id(chain))
+        if current is not None:
+            self.mark_down(current)
+        self.release(chain)
+        for attempt in range(self.retries + 1):
+            i = self.pick(exclude=current)
+            chain.url = self.urls[i]
+            try:
+                chain.connect_websocket()
+            except CONNECTION_ERRORS:
+                self.unpick(i)
+                self.mark_down(i)
+                self.sleep(attempt)
+                continue
+            self.assigned[id(chain)] = i
+            return chain
+        raise ConnectionError(f'No endpoint available out of {self.urls}')
+
+    def call(self, chain, fn, *args, **kwargs):
+        """Run `fn(*args, **kwargs)` which uses `chain`, reconnecting and retrying on connection errors."""
+        for attempt in range(self.retries + 1):
+            try:
+                return fn(*args, **kwargs)
+            except CONNECTION_ERRORS:
+                if attempt == self.retries:
+                    raise
+                self.reconnect(chain)
+
+    def submit(self, chain, address, fn, *args, **kwargs):
+        """Run `fn(*args, **kwargs)` which signs extrinsics of `address` (with utils.sign()) and sends them over `chain`.
+        Like call(), but after a connection error `fn` is run again only if nothing was signed meanwhile, or the next
+        nonce of the account on the new node shows that the last signed extrinsic did not reach the chain. Otherwise
+        the error is re-raised, so nothing is sent twice. No extra requests are made unless the connection breaks."""
+        for attempt in range(self.retries + 1):
+            signed = last_signed(address)
+            try:
+                return fn(*args, **kwargs)
+            except CONNECTION_ERRORS:
+                if attempt == self.retries:
+                    raise
+                self.reconnect(chain)
+                last = last_signed(address)
+                if last != signed and self.call(chain, next_nonce, chain, address) > last[1]:
+                    raise
+
+    def sleep(self, attempt):
+        sleep(min(self.backoff[0] * 2 ** attempt, self.backoff[1]))
+
+    def mark_down(self, i):
+        self.healthy[i] = 0
+        self.down_since[i] = time()
+
+    def probe(self, i):
+        """Check a single endpoint: it must answer system_health and not be syncing."""
+        chain = None
+        try:
+            chain = connect(self.urls[i], auto_discover=False)
+            health = chain.rpc_request('system_health', [])['result']
+            return not health['isSyncing']
+        except (*CONNECTION_ERRORS, KeyError):
+            return False
+        finally:
+            if chain is not None:
+                chain.close()
+
+    def start_probes(self):
+        self.running = True
+        Thread(target=self.run_probes, daemon=True).start()
+
+    def stop_probes(self):
+        self.running = False
+
+    def run_probes(self):
+        while self.running:
+            deadline = time() + self.probe_interval
+            for i in range(len(self.urls)):
+                if self.probe(i):
+                    self.healthy[i] = 1
+                else:
+                    self.mark_down(i)
+            sleep(max(0, deadline - time()))
+
+    def status(self):
+        return [{'url': u, 'weight': w, 'load': self.load[i], 'healthy': bool(self.healthy[i])}
+                for i, (u, w) in enumerate(zip(self.urls, self.weights))]
+
+
+def next_nonce(chain, address):
+    """Next nonce of `address`, including extrinsics in the transaction pool of the node."""
+    return chain.rpc_request('system_accountNextIndex', [address])['result']
@@ -0,0 +1,264 @@
+import asyncio
+from time import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Event, Process, Queue
+from substrateinterface.exceptions import ContractReadFailedException, SubstrateRequestException
+
+from .dex import Reader
+from .endpoints import CONNECTION_ERRORS, EndpointPool
+from .ledger import NATIVE, Ledger
+from .metrics import MetricsSink, error_class
+from .pipeline import BlockWatcher, Pipeline
+from .trader import ALLOWANCE, orient_path, pick_amount, pick_trade, swap_args
+from .traffic import Order, latency_summary
+from .utils import GasCache, build_contract_call, derive_keypairs
+
+BLOCK_TIME = 1.0
+
+
+class AsyncTraderPool:
+    """Drop-in alternative to TraderPool able to run thousands of traders.
+
+    Instead of one process (with its own connection, contract handles and dex copy) per trader, traders are
+    asyncio coroutines. Each shard process runs many of them on `connections` websocket connections
+    and a single BlockWatcher. Trades are pipelined (see Pipeline) and balances are kept with a Ledger,
+    so a connection is busy only for the short time of building and sending an extrinsic.
+    Use `shards` > 1 to spread traders over that many processes on multi-core machines (at most one per trader).
+    Orders with a path (see traffic.Order) are traded along it, by whichever trader takes the order: there is
+    no Scheduler assigning orders to traders, use TraderPool with `routing` for that.
+
+    Same usage pattern and same signals as TraderPool:
+    t = AsyncTraderPool(dex, 5000, phrase, connections=8, shards=4)
+    t.spawn_traders(True)
+    t.order_trades(100, 2)
+    t.kill_traders()
+    """
+    def __init__(self, dex, n_traders, phrase, connections=4, shards=1, cache_gas=True, metrics=None, endpoints=None):
+        self.dex = dex
+        self.endpoints = endpoints or EndpointPool([dex.chain_url])
+        self.metrics = metrics
+        self.n_traders = n_traders
+        self.phrase = phrase
+        self.connections = connections
+        self.shards = max(1, min(shards, n_traders))
+        self.cache_gas = cache_gas
+        self.queue = Queue()
+        self.proc = []
+
+    def spawn_traders(self, set_allowance=True):
+        self.dex.preload_metadata()
+        keypairs = derive_keypairs(self.phrase, range(self.n_traders))
+        events = [Event() for _ in range(self.shards)]
+        self.proc = [Process(target=shard_main, args=(self.queue, events[i], self.dex, keypairs[i::self.shards], range(i, self.n_traders, self.shards),
+                                                      self.connections, set_allowance, self.cache_gas,
+                                                      self.metrics.channel if self.metrics else None, self.endpoints)) for i in range(self.shards)]
+        for p in self.proc:
+            p.start()
+        for e in events:
+            e.wait()
+
+    def order_trades(self, n, steps=1):
+        for _ in range(n):
+            self.queue.put(steps)
+
+    def kill_traders(self):
+        for _ in range(self.shards):
+            self.queue.put(0)
+        for p in self.proc:
+            p.join()
+        self.proc = []
+
+
+def shard_main(signal_queue, ready_event, dex, keypairs, indices, connections, set_allowance, cache_gas, metrics_channel, endpoints):
+    metrics = MetricsSink(metrics_channel, f'shard-{indices[0]}') if metrics_channel else None
+    shard = Shard(dex, keypairs, indices, connections, GasCache() if cache_gas else None, metrics, endpoints)
+    asyncio.run(shard.run(signal_queue, ready_event, set_allowance))
+
+
+class Connection:
+    """Connection shared by many traders, taken from an EndpointPool. All blocking calls on it run in its own
+    single thread, in order, and are retried on another node if the connection breaks."""
+    def __init__(self, endpoints):
+        self.endpoints = endpoints
+        self.reader = Reader(endpoints.connect())
+        self.chain = self.reader.chain
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.endpoints.call, self.chain, fn, *args)
+
+    async def submit(self, address, fn, *args):
+        """Like run(), for `fn` sending extrinsics of `address` (see EndpointPool.submit())."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.endpoints.submit, self.chain, address, fn, *args)
+
+
+class Shard:
+    """Traders of a single process, with the connections and the BlockWatcher they share."""
+    def __init__(self, dex, keypairs, indices, n_connections, gas_cache, metrics=None, endpoints=None):
+        self.dex = dex
+        self.metrics = metrics
+        self.endpoints = endpoints or EndpointPool([dex.chain_url])
+        self.keypairs = keypairs
+        self.indices = list(indices)
+        self.n_connections = n_connections
+        self.gas_cache = gas_cache
+        self.loop = None
+        self.watcher = None
+
+    async def run(self, signal_queue, ready_event, set_allowance):
+        self.loop = asyncio.get_running_loop()
+        self.watcher = BlockWatcher(endpoints=self.endpoints)
+        connections = [Connection(self.endpoints) for _ in range(min(self.n_connections, len(self.indices)))]
+        traders = [AsyncTrader(self, i, self.keypairs[j], connections[j % len(connections)]) for j, i in enumerate(self.indices)]
+        await asyncio.gather(*(t.start(set_allowance) for t in traders))
+        ready_event.set()
+        print(f'Shard with {len(traders)} traders on {len(connections)} connections ready\n', end='')
+
+        orders = asyncio.Queue()
+        tasks = [asyncio.create_task(t.run(orders)) for t in traders]
+        while True:
+            step = await self.loop.run_in_executor(None, signal_queue.get)
+            if step == 0:
+                break
+            await orders.put(step)
+        for _ in traders:
+            await orders.put(0)
+        for t, result in zip(traders, await asyncio.gather(*tasks, return_exceptions=True)):
+            if isinstance(result, Exception):
+                print(f'Trader {t.index} failed: {result!r}\n', end='')
+        ok, total = sum(t.ok for t in traders), sum(t.total for t in traders)
+        print(f'Shard with {len(traders)} traders succeeded in {ok}/{total} swaps\n', end='')
+        latencies = [x for t in traders for x in t.latencies]
+        if latencies:
+            print(f'Shard latency from intended send time: {latency_summary(latencies)}\n', end='')
+        if self.metrics is not None:
+            self.metrics.flush()
+        if self.gas_cache is not None:
+            print(f'Shard gas cache: {self.gas_cache.stats()}\n', end='')
+
+
+class AsyncTrader:
+    """Lightweight trader living in a Shard: a keypair, local balances kept by a Ledger, a Pipeline
+    and a Connection shared with other traders. No contract handles of its own."""
+    def __init__(self, shard, index, kp, conn):
+        self.shard = shard
+        self.dex = shard.dex
+        self.index = index
+        self.kp = kp
+        self.conn = conn
+        self.balances = {NATIVE: 0}
+        self.balances.update({t: 0 for t in self.dex.tokens})
+        self.ledger = Ledger(self.kp.ss58_address, self.dex, self.balances)
+        self.pipeline = None
+        self.wakeup = asyncio.Event()
+        self.ok = 0
+        self.total = 0
+        self.latencies = []
+
+    async def start(self, set_allowance):
+        await self.conn.submit(self.kp.ss58_address, self.init, set_allowance)
+        if set_allowance:
+            await self.wait()
+
+    def init(self, set_allowance):
+        loop = self.shard.loop
+        self.pipeline = Pipeline(self.conn.chain, self.kp, self.shard.watcher, notify=lambda: loop.call_soon_threadsafe(self.wakeup.set))
+        addr = self.kp.ss58_address
+        self.balances[NATIVE] = self.conn.chain.query('System', 'Account', [addr]).value['data']['free']
+        for t in self.dex.tokens:
+            token = self.conn.reader.contract(t, self.dex.psp22_metadata)
+            try:
+                self.balances[t] = token.read(self.kp, method='PSP22::balance_of', args={'owner': addr}).contract_result_data.value['Ok']
+            except ContractReadFailedException:
+                pass
+        if set_allowance:
+            calls = []
+            for t in self.dex.tokens:
+                if t != self.dex.wnative_address:
+                    token = self.conn.reader.contract(t, self.dex.psp22_metadata)
+                    allowance = token.read(self.kp, method='PSP22::allowance', args={'owner': addr, 'spender': self.dex.router_address})
+                    if allowance.contract_result_data.value['Ok'] >= ALLOWANCE // 2:
+                        continue
+                    args = {'spender': self.dex.router_address, 'value': ALLOWANCE}
+                    calls.append(build_contract_call(token, self.kp, method='PSP22::approve', args=args, gas_cache=self.shard.gas_cache))
+            if calls:
+                batch = self.conn.chain.compose_call(call_module='Utility', call_function='batch', call_params={'calls': calls})
+                self.pipeline.submit(batch)
+
+    def send(self, path, amount, intended):
+        router = self.conn.reader.contract(self.dex.router_address, self.dex.router_metadata)
+        call = build_contract_call(router, self.kp, *swap_args(self.dex, self.kp.ss58_address, path, amount), gas_cache=self.shard.gas_cache)
+        sub = self.pipeline.submit(call, tag=(path, amount))
+        sub.intended = intended
+        return sub
+
+    def settle(self, done):
+        """Apply receipts of finished submissions to the ledger. Return the number of successful trades."""
+        ok = 0
+        metrics = self.shard.metrics
+        for sub in done:
+            if sub.tag is not None:
+                path, amount = sub.tag
+                self.balances[NATIVE if path[0] == self.dex.wnative_address else path[0]] += amount
+            if sub.receipt is not None:
+                self.ledger.apply(sub.receipt)
+                ok += sub.tag is not None and sub.receipt.is_success
+            if metrics is not None and sub.tag is not None:
+                if sub.receipt is not None:
+                    metrics.record_receipt(sub.receipt, sub.submitted, sub.included, len(path) - 1, sub.intended)
+                else:
+                    metrics.record(sub.intended, sub.submitted, path_len=len(path) - 1, error='Timeout')
+        return ok
+
+    async def wait(self):
+        """Wait until all pending submissions are done, settle them."""
+        ok = 0
+        while self.pipeline.pending:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=BLOCK_TIME)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            done = await self.conn.run(self.pipeline.collect)
+            ok += await self.conn.run(self.settle, done)
+        return ok
+
+    async def trade(self, max_path_len, intended=None, path=None):
+        """Trade like Trader.trade(): along a random path, or along `path` (reversed if only its last token is held).
+        Return the number of successful trades settled meanwhile."""
+        if path is None:
+            path, amount = pick_trade(self.dex, self.balances, max_path_len)
+        else:
+            given, path = path, orient_path(self.dex, self.balances, path)
+            if path is None:
+                if self.shard.metrics is not None:
+                    self.shard.metrics.record(intended, path_len=len(given) - 1, error='NoBalance')
+                return 0
+            amount = pick_amount(self.dex, self.balances, path)
+        await self.conn.submit(self.kp.ss58_address, self.send, path, amount, intended)
+        self.balances[NATIVE if path[0] == self.dex.wnative_address else path[0]] -= amount
+        return await self.wait()
+
+    async def run(self, orders):
+        while True:
+            step = await orders.get()
+            if step == 0:
+                return
+            self.total += 1
+            try:
+                if isinstance(step, Order):
+                    self.ok += await self.trade(step.steps, step.intended, step.path)
+                    self.latencies.append(time() - step.intended)
+                else:
+                    self.ok += await self.trade(step)
+            except CONNECTION_ERRORS as e:
+                if self.shard.metrics is not None:
+                    self.shard.metrics.record(getattr(step, 'intended', None), error=error_class(exception=e))
+            except SubstrateRequestException as e:
+                if self.shard.metrics is not None:
+                    self.shard.metrics.record(getattr(step, 'intended', None), error=error_class(exception=e))
+                msg = e.args[0]
+                if isinstance(msg, dict) and msg.get('message') == 'Invalid Transaction' and 'account balance too low' in str(msg.get('data')):
+                    print(f'Trader {self.index} run out of money. Going fishing...\n', end='')
+                    return
+                raise
@@ -0,0 +1,74 @@
+from substrateinterface.utils.ss58 import ss58_decode
+
+from .utils import contract_events
+
+NATIVE = 'AZERO'
+
+# (module, event) -> (attribute of the account whose native balance changes, sign)
+NATIVE_EVENTS = {
+    ('Balances', 'Withdraw'): [('who', -1)],
+    ('Balances', 'Deposit'): [('who', 1)],
+    ('Balances', 'Reserved'): [('who', -1)],
+    ('Balances', 'Unreserved'): [('who', 1)],
+    ('Balances', 'Transfer'): [('from', -1), ('to', 1)],
+    ('Contracts', 'StorageDepositTransferredAndHeld'): [('from', -1)],
+    ('Contracts', 'StorageDepositTransferredAndReleased'): [('to', 1)],
+}
+
+
+def same_account(a, b):
+    if a is None or b is None:
+        return False
+    try:
+        return ss58_decode(a) == ss58_decode(b)
+    except ValueError:
+        return a == b
+
+
+class Ledger:
+    """Local view of balances of a single account, kept up to date with events of its own extrinsics.
+
+    Operates on the supplied `balances` dict (the one held by Trader, keyed by token address and NATIVE).
+    Native balance follows Balances and storage deposit events (fees included), PSP22 balances follow
+    Transfer events emitted by dex tokens. Events not modelled here (e.g. a transfer received from someone else)
+    make the ledger drift; reconcile() compares it with the chain, reports the drift and fixes the ledger.
+    """
+    def __init__(self, address, dex, balances):
+        self.address = address
+        self.dex = dex
+        self.balances = balances
+        self.psp22_metadata = None
+        self.applied = 0
+        self.drift = {}
+
+    def apply(self, receipt):
+        """Apply balance changes caused by the extrinsic (successful or not - fees are paid anyway)."""
+        for event in receipt.triggered_events:
+            key = (event.value['module_id'], event.value['event_id'])
+            for field, sign in NATIVE_EVENTS.get(key, []):
+                attributes = event.value['attributes']
+                if same_account(attributes.get(field), self.address):
+                    self.balances[NATIVE] += sign * attributes['amount']
+        if receipt.is_success:
+            if self.psp22_metadata is None:
+                self.psp22_metadata = receipt.substrate.contract_metadata(self.dex.psp22_metadata)
+            events = contract_events(receipt, lambda addr: self.psp22_metadata if addr in self.dex.tokens else None)
+            for token, name, args in events:
+                if name != 'Transfer':
+                    continue
+                if same_account(args.get('from'), self.address):
+                    self.balances[token] -= args['value']
+                if same_account(args.get('to'), self.address):
+                    self.balances[token] += args['value']
+        self.applied += 1
+
+    def reconcile(self, onchain):
+        """Compare ledger with `onchain` balances (dict of the same shape), overwrite the ledger with them.
+        Return the drift (on-chain minus ledger) of balances which differ, also accumulated in self.drift."""
+        drift = {}
+        for t, value in onchain.items():
+            if self.balances.get(t) != value:
+                drift[t] = value - self.balances.get(t, 0)
+                self.drift[t] = self.drift.get(t, 0) + drift[t]
+            self.balances[t] = value
+        return drift
@@ -0,0 +1,325 @@
+import bisect
+import csv
+import json
+from collections import namedtuple
+from multiprocessing import Queue
+from threading import Lock, Thread
+from time import sleep, time
+from substrateinterface import SubstrateInterface
+
+TradeRecord = namedtuple('TradeRecord', ['trader', 'intended', 'submitted', 'in_block', 'finalized', 'block_hash',
+                                         'path_len', 'weight', 'fee', 'error', 'batch_size'])
+TradeRecord.__doc__ = """Single trade as seen by the client. Times come from time.time(), `intended` is None for trades
+not scheduled by a load generator, `in_block`/`finalized` are None if unknown. `error` is None for successful trades,
+otherwise a short error class (e.g. 'Module:Contracts.ContractReverted', 'Invalid Transaction', 'Timeout').
+`batch_size` is the number of swaps in the extrinsic; for batched swaps `weight` and `fee` are this swap's share."""
+
+PERCENTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+class Histogram:
+    """HDR-style histogram of non-negative integer values (here: microseconds).
+
+    Values are kept in log-linear buckets: every power of two is split into 2^`sub_bits` equal buckets,
+    so the relative error of reported percentiles is below 2^-`sub_bits` (0.8% by default), while memory
+    does not depend on the number of recorded values.
+    """
+    def __init__(self, sub_bits=7):
+        self.sub_bits = sub_bits
+        self.counts = {}
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.sum = 0
+
+    def bucket(self, value):
+        shift = max(0, value.bit_length() - self.sub_bits - 1)
+        return (value >> shift) << shift
+
+    def record(self, value, count=1):
+        value = max(0, int(value))
+        b = self.bucket(value)
+        self.counts[b] = self.counts.get(b, 0) + count
+        self.total += count
+        self.sum += value * count
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        for b, c in other.counts.items():
+            self.counts[b] = self.counts.get(b, 0) + c
+        self.total += other.total
+        self.sum += other.sum
+        if other.total:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def percentile(self, q):
+        if not self.total:
+            return None
+        rank = q * self.total
+        seen = 0
+        for b in sorted(self.counts):
+            seen += self.counts[b]
+            if seen >= rank:
+                return min(b, self.max)
+        return self.max
+
+    def mean(self):
+        return self.sum / self.total if self.total else None
+
+    def summary(self):
+        result = {'count': self.total, 'min': self.min, 'max': self.max, 'mean': self.mean()}
+        result.update({f'p{q * 100:g}': self.percentile(q) for q in PERCENTILES})
+        return result
+
+
+class MetricsSink:
+    """Worker side of the metrics channel. Buffers records locally and sends them in batches
+    (every `batch` records or `interval` seconds), so the cost per trade is an append to a list."""
+    def __init__(self, channel, trader, batch=100, interval=1.0):
+        self.channel = channel
+        self.trader = trader
+        self.batch = batch
+        self.interval = interval
+        self.buffer = []
+        self.last_flush = time()
+
+    def record(self, intended=None, submitted=None, in_block=None, block_hash=None, path_len=None, weight=None, fee=None, error=None,
+               batch_size=1):
+        self.buffer.append(TradeRecord(self.trader, intended, submitted, in_block, None, block_hash, path_len, weight, fee, error, batch_size))
+        if len(self.buffer) >= self.batch or time() - self.last_flush > self.interval:
+            self.flush()
+
+    def record_receipt(self, receipt, submitted, in_block, path_len, intended=None):
+        """Record a trade from its receipt (which must already be processed, e.g. by checking is_success)."""
+        if receipt.is_success:
+            self.record(intended, submitted, in_block, receipt.block_hash, path_len, receipt.weight['ref_time'], receipt.total_fee_amount)
+        else:
+            self.record(intended, submitted, in_block, receipt.block_hash, path_len, error=error_class(receipt))
+
+    def flush(self):
+        if self.buffer:
+            self.channel.put(self.buffer)
+            self.buffer = []
+        self.last_flush = time()
+
+
+def error_class(receipt=None, exception=None):
+    if exception is not None:
+        msg = exception.args[0] if exception.args else None
+        return msg.get('message', type(exception).__name__) if isinstance(msg, dict) else type(exception).__name__
+    e = receipt.error_message or {}
+    return f'{e.get("type")}:{e.get("name")}'
+
+
+class MetricsCollector:
+    """Aggregates TradeRecords sent by workers (possibly in other processes) through `channel`.
+
+    Keeps HDR-style histograms (in microseconds) of:
+        latency         in_block - intended (or submitted, if there was no intended time)
+        service         in_block - submitted
+        finality        finalized - in_block
+        latency_<k>     latency of trades with a path of k swaps
+    plus error counts and totals of weight and fees, also per swap by batch size (to compare batched and single trades).
+    Throughput is measured over the window from the first to the last inclusion of a successful trade, so time spent
+    before traffic starts and after it drains does not count (the whole run if no trade reported its inclusion time).
+    If `url` is given, finalized heads are followed on a separate connection and `finalized` time of a trade
+    is the moment its block got finalized.
+    With `interval`, a one-line summary is printed every `interval` seconds.
+
+    Usage pattern:
+    m = MetricsCollector(url, interval=5)
+    pool = TraderPool(dex, 100, phrase, metrics=m)
+    m.start()
+    ...
+    m.stop()
+    m.export_json('run.json')
+    """
+    def __init__(self, url=None, interval=None, keep_records=False):
+        self.channel = Queue()
+        self.url = url
+        self.interval = interval
+        self.keep_records = keep_records
+        self.records = []
+        self.histograms = {'latency': Histogram(), 'service': Histogram(), 'finality': Histogram()}
+        self.errors = {}
+        self.ok = 0
+        self.total = 0
+        self.weight = 0
+        self.fee = 0
+        self.per_batch = {}
+        self.included = None
+        self.started = None
+        self.stopped = None
+        self.lock = Lock()
+        self.running = False
+        self.threads = []
+        self.block_numbers = {}
+        self.finalized = []
+        self.awaiting_finality = []
+        self.chain = None
+
+    def sink(self, trader, **kwargs):
+        return MetricsSink(self.channel, trader, **kwargs)
+
+    def start(self):
+        self.started = time()
+        self.running = True
+        self.threads = [Thread(target=self.drain, daemon=True)]
+        if self.url:
+            self.chain = SubstrateInterface(url=self.url)
+            self.threads.append(Thread(target=self.follow_finality, daemon=True))
+        if self.interval:
+            self.threads.append(Thread(target=self.report, daemon=True))
+        for t in self.threads:
+            t.start()
+
+    def stop(self):
+        self.running = False
+        self.channel.put(None)
+        self.threads[0].join()
+        self.stopped = time()
+        with self.lock:
+            if self.keep_records:
+                self.records.extend(self.awaiting_finality)
+
+    def drain(self):
+        for batch in iter(self.channel.get, None):
+            with self.lock:
+                for r in batch:
+                    self.add(r)
+        while not self.channel.empty():
+            batch = self.channel.get()
+            if batch is not None:
+                with self.lock:
+                    for r in batch:
+                        self.add(r)
+
+    def add(self, r):
+        self.total += 1
+        if r.error is None:
+            self.ok += 1
+            self.weight += r.weight or 0
+            self.fee += r.fee or 0
+            totals = self.per_batch.setdefault(r.batch_size, [0, 0, 0])
+            totals[0] += 1
+            totals[1] += r.weight or 0
+            totals[2] += r.fee or 0
+            if r.in_block is not None:
+                first, last = self.included or (r.in_block, r.in_block)
+                self.included = (min(first, r.in_block), max(last, r.in_block))
+        else:
+            self.errors[r.error] = self.errors.get(r.error, 0) + 1
+        if r.in_block is not None:
+            latency = (r.in_block - (r.intended or r.submitted)) * 10**6
+            self.histograms['latency'].record(latency)
+            self.histograms['service'].record((r.in_block - r.submitted) * 10**6)
+            key = f'latency_{r.path_len}'
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].record(latency)
+            if self.url and r.block_hash:
+                self.awaiting_finality.append(r)
+                return
+        if self.keep_records:
+            self.records.append(r)
+
+    def follow_finality(self):
+        def handler(head, update_nr, subscription_id):
+            with self.lock:
+                self.finalized.append((head['header']['number'], time()))
+            return None if self.running else True
+        # block numbers are resolved on this thread's own connection, between subscription updates
+        listener = SubstrateInterface(url=self.url)
+        Thread(target=listener.subscribe_block_headers, args=(handler,), kwargs={'finalized_only': True}, daemon=True).start()
+        while self.running:
+            sleep(0.5)
+            with self.lock:
+                waiting, self.awaiting_finality = self.awaiting_finality, []
+                finalized = list(self.finalized)
+            still = []
+            for r in waiting:
+                if r.block_hash not in self.block_numbers:
+                    self.block_numbers[r.block_hash] = self.chain.get_block_number(r.block_hash)
+                n = self.block_numbers[r.block_hash]
+                i = bisect.bisect_left([f[0] for f in finalized], n)
+                if i < len(finalized):
+                    with self.lock:
+                        self.histograms['finality'].record((finalized[i][1] - r.in_block) * 10**6)
+                        if self.keep_records:
+                            self.records.append(r._replace(finalized=finalized[i][1]))
+                else:
+                    still.append(r)
+            with self.lock:
+                self.awaiting_finality.extend(still)
+
+    def report(self):
+        while self.running:
+            sleep(self.interval)
+            print(self.status_line() + '\n', end='')
+
+    def status_line(self):
+        with self.lock:
+            elapsed = time() - self.started
+            lat = self.histograms['latency']
+            p = {q: lat.percentile(q) for q in (0.5, 0.99)}
+            fmt = lambda us: '-' if us is None else f'{us / 1000:.0f}ms'
+            return (f'[{elapsed:.0f}s] trades {self.ok}/{self.total}  {self.total / elapsed:.1f}/s  '
+                    f'latency p50 {fmt(p[0.5])} p99 {fmt(p[0.99])} max {fmt(lat.max)}  errors {sum(self.errors.values())}')
+
+    def summary(self):
+        with self.lock:
+            end = self.stopped or time()
+            window = self.included[1] - self.included[0] if self.included else 0
+            if window <= 0:
+                window = end - self.started
+            return {
+                'started': self.started,
+                'duration': end - self.started,
+                'window': window,
+                'trades': self.total,
+                'succeeded': self.ok,
+                'throughput': self.ok / window,
+                'errors': dict(self.errors),
+                'weight': self.weight,
+                'fee': self.fee,
+                'per_batch_size': {size: {'trades': n, 'weight_per_swap': w / n, 'fee_per_swap': f / n}
+                                   for size, (n, w, f) in sorted(self.per_batch.items())},
+                'histograms_us': {name: h.summary() for name, h in self.histograms.items()}
+            }
+
+    def export_json(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def export_csv(self, path):
+        """Write all records (requires `keep_records=True`), one trade per line."""
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(TradeRecord._fields)
+            with self.lock:
+                writer.writerows(self.records)
+
+    def export_prometheus(self, path, prefix='common_bench'):
+        """Write metrics in Prometheus text exposition format (e.g. for node_exporter textfile collector)."""
+        s = self.summary()
+        lines = [
+            f'# TYPE {prefix}_trades_total counter',
+            f'{prefix}_trades_total {s["trades"]}',
+            f'# TYPE {prefix}_trades_succeeded_total counter',
+            f'{prefix}_trades_succeeded_total {s["succeeded"]}',
+            f'# TYPE {prefix}_trade_errors_total counter'
+        ]
+        lines += [f'{prefix}_trade_errors_total{{error="{e}"}} {c}' for e, c in s['errors'].items()]
+        for name, h in s['histograms_us'].items():
+            metric = f'{prefix}_{name}_seconds'
+            lines.append(f'# TYPE {metric} summary')
+            for q in PERCENTILES:
+                value = h[f'p{q * 100:g}']
+                if value is not None:
+                    lines.append(f'{metric}{{quantile="{q}"}} {value / 10**6}')
+            lines.append(f'{metric}_sum {(h["mean"] or 0) * h["count"] / 10**6}')
+            lines.append(f'{metric}_count {h["count"]}')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
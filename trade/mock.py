@@ -0,0 +1,658 @@
+import json
+import random
+from hashlib import blake2b, sha256
+from threading import Lock, RLock
+from time import sleep, time
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlsplit
+from scalecodec.base import ScaleBytes
+from scalecodec.utils.ss58 import is_valid_ss58_address, ss58_encode
+from substrateinterface.exceptions import SubstrateRequestException
+
+from .quote import get_amount_out
+from .utils import AZERO, MOCK_SCHEME, PARSED_METADATA
+
+CHAINS = {}
+CHAINS_LOCK = Lock()
+MISSING = object()
+EMITTED = object()
+
+# Dex metadata "files" for a mock chain, contracts of a MockChain need no metadata
+METADATA = {'router': 'mock:router', 'factory': 'mock:factory', 'pair': 'mock:pair', 'psp22': 'mock:psp22'}
+PARSED_METADATA.update({name: {} for name in METADATA.values()})
+
+# (ref_time, proof_size) of messages; router swaps cost SWAP_WEIGHT plus HOP_WEIGHT for every pair on the path
+READ_WEIGHT = (200_000_000, 10_000)
+WEIGHTS = {
+    'PSP22::approve': (400_000_000, 20_000),
+    'PSP22::increase_allowance': (450_000_000, 20_000),
+    'PSP22::transfer': (500_000_000, 25_000),
+    'Pair::swap': (1_500_000_000, 60_000),
+}
+SWAP_WEIGHT = (1_000_000_000, 40_000)
+HOP_WEIGHT = (1_800_000_000, 70_000)
+EXTRINSIC_WEIGHT = (150_000_000, 5_000)
+TRANSFER_WEIGHT = (300_000_000, 4_000)
+MAX_EXTRINSIC = (250_000_000_000, 3_500_000)  # per-extrinsic limit of System::BlockWeights
+BASE_FEE = 10**8  # plus 1 per 10 units of ref_time
+
+PARAMS = {'tokens': int, 'pairs': int, 'liquidity': int, 'endowment': int, 'latency': float, 'block_time': float, 'seed': int}
+
+
+class ContractError(Exception):
+    """Revert of a contract message, with the error name (e.g. 'PSP22Error::InsufficientBalance')."""
+
+
+class DispatchError(Exception):
+    """Failure of a call, `args[0]` is the error in the format of ExtrinsicReceipt.error_message."""
+
+
+def module_error(name, docs=''):
+    return {'type': 'Module', 'name': name, 'docs': [docs] if docs else []}
+
+
+def invalid_transaction(reason):
+    return SubstrateRequestException({'code': 1010, 'message': 'Invalid Transaction', 'data': reason})
+
+
+class MockChain:
+    """In-process stand-in for a node running Common: one router, its factory, PSP22 tokens (one of them is wnative)
+    and pairs with constant-product swaps and the 0.3% fee (quote.get_amount_out), native balances and nonces.
+
+    Created from a URL: mock://NAME?tokens=6&pairs=10&liquidity=1000000000&endowment=1000000&latency=0&block_time=0&seed=0
+    Every query parameter is optional:
+        tokens     - number of PSP22 tokens besides wnative
+        pairs      - number of pairs, each token gets a pair with wnative first, then random token-token pairs are added
+        liquidity  - initial reserves of every pair side, in whole coins (varied 0.5x-2x for different prices)
+        endowment  - native coins every account starts with, like on a dev chain (there is no funding to do)
+        latency    - seconds of simulated round trip added to every RPC call (reads, queries, submissions)
+        block_time - with 0 every extrinsic gets its own block instantly, otherwise blocks are produced every
+                     `block_time` seconds and submit_extrinsic() waits for the next one when asked for inclusion
+        seed       - addresses and the dex layout depend only on this, so all processes see the same deployment
+    Extrinsics are executed when submitted, calls of Utility::batch/batch_all like in the runtime (ItemCompleted,
+    BatchInterrupted and BatchCompleted events). Contract messages run transactionally: a revert (ContractReverted)
+    or missing gas (OutOfGas) undoes all their changes, fees and nonces are charged anyway.
+    Events: Balances::Withdraw for fees, Balances::Transfer for native transfers (including native in and out
+    of router swaps), ContractEmitted with PSP22 Transfer and Pair Sync events, so Ledger and
+    QuoteEngine.apply_events() work. Blocks keep their extrinsics, for BlockWatcher and receipts of Pipelines.
+
+    Chain state lives in the memory of a process. Processes forked later (e.g. workers of TraderPool) start with
+    a copy of it and evolve independently, which is fine for measuring the client, not for studying the dex.
+    """
+    def __init__(self, url, tokens=6, pairs=10, liquidity=10**9, endowment=10**6, latency=0.0, block_time=0.0, seed=0):
+        self.url = url
+        self.seed = seed
+        self.latency = latency
+        self.block_time = block_time
+        self.endowment = endowment * AZERO
+        self.lock = RLock()
+        self.journal = None
+        self.events = []
+        self.blocks = {}
+        self.numbers = {}
+        self.outcomes = {}
+        self.free = {}
+        self.nonces = {}
+        self.balances = {}
+        self.allowances = {}
+        self.reserves = {}
+        self.started = time()
+        self.head = 0
+        self.building = None
+        self.index = 0
+        self.extrinsics = 0
+        self.failed = 0
+
+        self.router = self.address('router')
+        self.factory = self.address('factory')
+        self.wnative = self.address('wnative')
+        self.symbols = {self.wnative: 'WAZERO'}
+        self.symbols.update({self.address(f'token/{i}'): f'T{i}' for i in range(tokens)})
+        others = [t for t in self.symbols if t != self.wnative]
+        rng = random.Random(seed)
+        candidates = [(a, b) for i, a in enumerate(others) for b in others[i + 1:]]
+        rng.shuffle(candidates)
+        self.pairs = {}
+        self.all_pairs = []
+        for a, b in ([(self.wnative, t) for t in others] + candidates)[:pairs]:
+            pair = self.address(f'pair/{len(self.all_pairs)}')
+            token_0, token_1 = min(a, b), max(a, b)
+            self.pairs[pair] = (token_0, token_1)
+            self.all_pairs.append(pair)
+            for token in (token_0, token_1):
+                self.balances[(token, pair)] = int(liquidity * AZERO * rng.uniform(0.5, 2))
+            self.reserves[pair] = (self.balances[(token_0, pair)], self.balances[(token_1, pair)])
+        self.pair_of = {tokens: pair for pair, tokens in self.pairs.items()}
+
+        self.messages = {
+            'Router::factory': lambda caller, contract, args, value: self.factory,
+            'Router::wnative': lambda caller, contract, args, value: self.wnative,
+            'Router::swap_exact_native_for_tokens': self.swap_exact_native_for_tokens,
+            'Router::swap_exact_tokens_for_tokens': self.swap_exact_tokens_for_tokens,
+            'Router::swap_exact_tokens_for_native': self.swap_exact_tokens_for_native,
+            'Factory::all_pairs_length': lambda caller, contract, args, value: len(self.all_pairs),
+            'Factory::all_pairs': lambda caller, contract, args, value: self.all_pairs[args['pid']],
+            'Pair::get_token_0': lambda caller, contract, args, value: self.pairs[contract][0],
+            'Pair::get_token_1': lambda caller, contract, args, value: self.pairs[contract][1],
+            'Pair::get_reserves': lambda caller, contract, args, value: [*self.reserves[contract], 0],
+            'Pair::swap': self.pair_swap,
+            'PSP22::balance_of': lambda caller, contract, args, value: self.balances.get((contract, args['owner']), 0),
+            'PSP22::allowance': lambda caller, contract, args, value: self.allowances.get((contract, args['owner'], args['spender']), 0),
+            'PSP22::approve': lambda caller, contract, args, value: self.put(self.allowances, (contract, caller, args['spender']), args['value']),
+            'PSP22::increase_allowance': self.increase_allowance,
+            'PSP22::transfer': lambda caller, contract, args, value: self.transfer(contract, caller, args['to'], args['value']),
+            'PSP22Metadata::token_symbol': lambda caller, contract, args, value: self.symbols[contract],
+        }
+
+    def address(self, label):
+        return ss58_encode(sha256(f'mock/{self.seed}/{label}'.encode()).digest(), 42)
+
+    def block_hash(self, number):
+        block_hash = '0x' + sha256(f'mock/{self.seed}/block/{number}'.encode()).hexdigest()
+        self.numbers[block_hash] = number
+        return block_hash
+
+    def stats(self):
+        return {'blocks': self.head, 'extrinsics': self.extrinsics, 'failed': self.failed, 'accounts': len(self.nonces)}
+
+    # state changes are journaled, so that a failed call can be undone
+
+    def put(self, table, key, value):
+        if self.journal is not None:
+            self.journal.append((table, key, table.get(key, MISSING)))
+        table[key] = value
+
+    def emit(self, module_id, event_id, attributes):
+        """Add an event of the extrinsic being executed, removed again if the call emitting it is undone."""
+        if self.journal is not None:
+            self.journal.append((self.events, None, EMITTED))
+        self.events.append(MockEvent(module_id, event_id, attributes))
+
+    def emit_contract(self, contract, name, args):
+        self.emit('Contracts', 'ContractEmitted', {'contract': contract, 'data': (name, args)})
+
+    def atomic(self, fn, *args, commit=True):
+        """Run fn(*args) and keep its changes only if it does not raise (and `commit`)."""
+        outer, self.journal = self.journal, []
+        try:
+            result = fn(*args)
+        except Exception:
+            self.rollback()
+            raise
+        finally:
+            journal, self.journal = self.journal, outer
+        if not commit:
+            self.journal = journal
+            self.rollback()
+            self.journal = outer
+        elif outer is not None:
+            outer.extend(journal)
+        return result
+
+    def rollback(self):
+        for table, key, old in reversed(self.journal):
+            if old is EMITTED:
+                table.pop()
+            elif old is MISSING:
+                table.pop(key, None)
+            else:
+                table[key] = old
+        self.journal = []
+
+    def native(self, account):
+        if account not in self.free:
+            self.free[account] = self.endowment
+        return self.free[account]
+
+    # contract messages
+
+    def transfer(self, token, sender, to, value):
+        balance = self.balances.get((token, sender), 0)
+        if balance < value:
+            raise ContractError('PSP22Error::InsufficientBalance')
+        self.put(self.balances, (token, sender), balance - value)
+        self.put(self.balances, (token, to), self.balances.get((token, to), 0) + value)
+        self.emit_contract(token, 'Transfer', {'from': sender, 'to': to, 'value': value})
+
+    def transfer_from(self, token, spender, owner, to, value):
+        allowance = self.allowances.get((token, owner, spender), 0)
+        if allowance < value:
+            raise ContractError('PSP22Error::InsufficientAllowance')
+        self.put(self.allowances, (token, owner, spender), allowance - value)
+        self.transfer(token, owner, to, value)
+
+    def increase_allowance(self, caller, contract, args, value):
+        key = (contract, caller, args['spender'])
+        self.put(self.allowances, key, self.allowances.get(key, 0) + args['delta_value'])
+
+    def sync(self, pair):
+        token_0, token_1 = self.pairs[pair]
+        reserves = (self.balances.get((token_0, pair), 0), self.balances.get((token_1, pair), 0))
+        self.put(self.reserves, pair, reserves)
+        self.emit_contract(pair, 'Sync', {'reserve_0': reserves[0], 'reserve_1': reserves[1]})
+
+    def pair_swap(self, caller, pair, args, value):
+        """Pair::swap: pay out the requested amounts, the input must have been transferred to the pair already."""
+        (token_0, token_1), (reserve_0, reserve_1) = self.pairs[pair], self.reserves[pair]
+        out_0, out_1 = args['amount_0_out'], args['amount_1_out']
+        if out_0 == out_1 == 0:
+            raise ContractError('PairError::InsufficientOutputAmount')
+        if out_0 >= reserve_0 or out_1 >= reserve_1:
+            raise ContractError('PairError::InsufficientLiquidity')
+        if out_0:
+            self.transfer(token_0, pair, args['to'], out_0)
+        if out_1:
+            self.transfer(token_1, pair, args['to'], out_1)
+        balance_0, balance_1 = self.balances.get((token_0, pair), 0), self.balances.get((token_1, pair), 0)
+        in_0 = max(0, balance_0 - (reserve_0 - out_0))
+        in_1 = max(0, balance_1 - (reserve_1 - out_1))
+        if in_0 == in_1 == 0:
+            raise ContractError('PairError::InsufficientInputAmount')
+        if (balance_0 * 1000 - in_0 * 3) * (balance_1 * 1000 - in_1 * 3) < reserve_0 * reserve_1 * 1000**2:
+            raise ContractError('PairError::K')
+        self.sync(pair)
+
+    def swap(self, caller, path, amount_in, amount_out_min, to, native_in=False, native_out=False):
+        """Router swap of exact `amount_in` along `path`, input and output wrapped/unwrapped if native."""
+        if amount_in == 0:
+            raise ContractError('RouterError::InsufficientAmount')
+        if native_out and path[-1] != self.wnative or native_in and path[0] != self.wnative:
+            raise ContractError('RouterError::InvalidPath')
+        pairs, amounts = [], [amount_in]
+        for token_in, token_out in zip(path, path[1:]):
+            pair = self.pair_of.get((min(token_in, token_out), max(token_in, token_out)))
+            if pair is None:
+                raise ContractError('RouterError::PairNotFound')
+            reserve_0, reserve_1 = self.reserves[pair]
+            out = get_amount_out(amounts[-1], reserve_0, reserve_1) if token_in < token_out else get_amount_out(amounts[-1], reserve_1, reserve_0)
+            pairs.append(pair)
+            amounts.append(out)
+        if amounts[-1] < max(amount_out_min, 1):
+            raise ContractError('RouterError::InsufficientOutputAmount')
+        if native_in:
+            if self.native(caller) < amount_in:
+                raise DispatchError(module_error('TransferFailed', 'Performing the requested transfer failed.'))
+            self.put(self.free, caller, self.free[caller] - amount_in)
+            self.emit('Balances', 'Transfer', {'from': caller, 'to': self.router, 'amount': amount_in})
+            self.put(self.balances, (self.wnative, pairs[0]), self.balances.get((self.wnative, pairs[0]), 0) + amount_in)
+            self.emit_contract(self.wnative, 'Transfer', {'from': None, 'to': pairs[0], 'value': amount_in})
+        else:
+            self.transfer_from(path[0], self.router, caller, pairs[0], amount_in)
+        for i, pair in enumerate(pairs):
+            recipient = pairs[i + 1] if i + 1 < len(pairs) else (self.router if native_out else to)
+            out = {'amount_0_out': 0, 'amount_1_out': amounts[i + 1], 'to': recipient}
+            if path[i] > path[i + 1]:
+                out['amount_0_out'], out['amount_1_out'] = amounts[i + 1], 0
+            self.pair_swap(self.router, pair, out, 0)
+        if native_out:
+            self.put(self.balances, (self.wnative, self.router), self.balances[(self.wnative, self.router)] - amounts[-1])
+            self.emit_contract(self.wnative, 'Transfer', {'from': self.router, 'to': None, 'value': amounts[-1]})
+            self.put(self.free, to, self.native(to) + amounts[-1])
+            self.emit('Balances', 'Transfer', {'from': self.router, 'to': to, 'amount': amounts[-1]})
+        return amounts
+
+    def swap_exact_native_for_tokens(self, caller, contract, args, value):
+        return self.swap(caller, args['path'], value, args['amount_out_min'], args['to'], native_in=True)
+
+    def swap_exact_tokens_for_tokens(self, caller, contract, args, value):
+        return self.swap(caller, args['path'], args['amount_in'], args['amount_out_min'], args['to'])
+
+    def swap_exact_tokens_for_native(self, caller, contract, args, value):
+        return self.swap(caller, args['path'], args['amount_in'], args['amount_out_min'], args['to'], native_out=True)
+
+    def message(self, caller, contract, method, args, value):
+        if method not in self.messages:
+            raise ValueError(f'Message {method} is not supported by the mock chain')
+        return self.messages[method](caller, contract, args, value)
+
+    @staticmethod
+    def message_weight(method, args):
+        if method.startswith('Router::swap'):
+            hops = len(args['path']) - 1
+            return SWAP_WEIGHT[0] + hops * HOP_WEIGHT[0], SWAP_WEIGHT[1] + hops * HOP_WEIGHT[1]
+        return WEIGHTS.get(method, READ_WEIGHT)
+
+    def dry_run(self, caller, contract, method, args, value):
+        """Result of ContractInstance.read(): the message is executed and its changes undone."""
+        with self.lock:
+            events, self.events = self.events, []
+            try:
+                result = {'Ok': self.atomic(self.message, caller, contract, method, args, value, commit=False)}
+            except (ContractError, DispatchError) as e:
+                result = {'Err': e.args[0]}
+            finally:
+                self.events = events
+        ref_time, proof_size = self.message_weight(method, args)
+        return SimpleNamespace(gas_required={'ref_time': ref_time, 'proof_size': proof_size},
+                               contract_result_data=SimpleNamespace(value=result))
+
+    # extrinsics
+
+    def call_weight(self, call):
+        module, function, params = call['call_module'], call['call_function'], call['call_args']
+        if module == 'Utility':
+            weights = [self.call_weight(c) for c in params['calls']]
+            return sum(w[0] for w in weights), sum(w[1] for w in weights)
+        if module == 'Contracts':
+            return params['gas_limit']['ref_time'], params['gas_limit']['proof_size']
+        return TRANSFER_WEIGHT
+
+    def dispatch(self, sender, call):
+        module, function, params = call['call_module'], call['call_function'], call['call_args']
+        if module == 'Contracts' and function == 'call':
+            method, args = decode_message(params['data'])
+            required = self.message_weight(method, args)
+            if params['gas_limit']['ref_time'] < required[0] or params['gas_limit']['proof_size'] < required[1]:
+                raise DispatchError(module_error('OutOfGas', 'The executed contract exhausted its gas limit.'))
+            try:
+                self.atomic(self.message, sender, params['dest'], method, args, params['value'])
+            except ContractError as e:
+                raise DispatchError(module_error('ContractReverted', e.args[0]))
+        elif module == 'Utility' and function in ('batch', 'batch_all'):
+            for i, c in enumerate(params['calls']):
+                if function == 'batch_all':
+                    self.dispatch(sender, c)
+                else:
+                    try:
+                        self.atomic(self.dispatch, sender, c)
+                    except DispatchError as e:
+                        self.emit('Utility', 'BatchInterrupted', {'index': i, 'error': e.args[0]})
+                        return
+                self.emit('Utility', 'ItemCompleted', {})
+            self.emit('Utility', 'BatchCompleted', {})
+        elif module == 'Balances' and function in ('transfer', 'transfer_keep_alive', 'transfer_allow_death'):
+            if self.native(sender) < params['value']:
+                raise DispatchError(module_error('InsufficientBalance', 'Balance too low to send value.'))
+            self.put(self.free, sender, self.free[sender] - params['value'])
+            self.put(self.free, params['dest'], self.native(params['dest']) + params['value'])
+            self.emit('Balances', 'Transfer', {'from': sender, 'to': params['dest'], 'amount': params['value']})
+        elif module == 'System' and function == 'remark':
+            pass
+        else:
+            raise ValueError(f'Call {module}::{function} is not supported by the mock chain')
+
+    def apply(self, extrinsic):
+        """Validate and execute a signed extrinsic, return (block number, index in block, error, weight, fee, events)."""
+        with self.lock:
+            sender = extrinsic.signer
+            nonce = self.nonces.get(sender, 0)
+            if extrinsic.nonce != nonce:
+                raise invalid_transaction('Transaction is outdated' if extrinsic.nonce < nonce else 'Transaction is in the future')
+            ref_time, proof_size = self.call_weight(extrinsic.call)
+            ref_time, proof_size = ref_time + EXTRINSIC_WEIGHT[0], proof_size + EXTRINSIC_WEIGHT[1]
+            if ref_time > MAX_EXTRINSIC[0] or proof_size > MAX_EXTRINSIC[1]:
+                raise invalid_transaction('Transaction would exhaust the block limits')
+            fee = self.fee(ref_time)
+            if self.native(sender) < fee:
+                raise invalid_transaction('Inability to pay some fees (e.g. account balance too low)')
+            self.events, error = [], None
+            self.free[sender] -= fee
+            self.emit('Balances', 'Withdraw', {'who': sender, 'amount': fee})
+            self.nonces[sender] = nonce + 1
+            try:
+                self.atomic(self.dispatch, sender, extrinsic.call)
+                self.emit('System', 'ExtrinsicSuccess', {})
+            except DispatchError as e:
+                error = e.args[0]
+                self.emit('System', 'ExtrinsicFailed', {'dispatch_error': error})
+                self.failed += 1
+            self.extrinsics += 1
+            number, index = self.include(bytes(extrinsic.data.data))
+            outcome = self.outcomes[(number, index)] = (error, {'ref_time': ref_time, 'proof_size': proof_size}, fee, self.events)
+            return (number, index, *outcome)
+
+    @staticmethod
+    def fee(ref_time):
+        return BASE_FEE + ref_time // 10
+
+    def include(self, data):
+        """Add the extrinsic (encoded) to the block being built, return its number and the index in it."""
+        if self.block_time:
+            number = int((time() - self.started) / self.block_time) + 1
+            self.head = number - 1
+        else:
+            number = self.head = self.head + 1
+        if number != self.building:
+            self.building, self.index = number, 0
+            self.blocks[number] = []
+        self.blocks[number].append(data)
+        self.index += 1
+        return number, self.index - 1
+
+    def block_start(self, number):
+        return self.started + number * self.block_time
+
+    def produced(self):
+        """Number of the last block which is already out."""
+        return int((time() - self.started) / self.block_time) if self.block_time else self.head
+
+
+class MockEvent:
+    def __init__(self, module_id, event_id, attributes):
+        self.value = {'module_id': module_id, 'event_id': event_id, 'attributes': attributes}
+
+
+class MockCall:
+    """Result of compose_call(): `value` looks like the one of GenericCall, encoding is JSON instead of SCALE."""
+    def __init__(self, module, function, params):
+        self.value = {'call_module': module, 'call_function': function, 'call_args': params}
+
+    def encode(self):
+        return json.dumps(self.value, default=lambda call: call.value).encode()
+
+
+class MockExtrinsic:
+    """Signed extrinsic: JSON-encoded call, public key of the signer (32 bytes), nonce (u32) and signature
+    of call and nonce (64 bytes). Everything is decoded back from the bytes, like a node would do. `data` (ScaleBytes)
+    and `extrinsic_hash` (Blake2-256 of the bytes) are like in GenericExtrinsic."""
+    def __init__(self, data):
+        self.call = json.loads(data[:-100])
+        self.signer = ss58_encode(data[-100:-68], 42)
+        self.nonce = int.from_bytes(data[-68:-64], 'little')
+        self.data = ScaleBytes(bytearray(data))
+        self.extrinsic_hash = blake2b(data, digest_size=32).digest()
+
+
+class MockReceipt:
+    """Outcome of an extrinsic, with the attributes of ExtrinsicReceipt used by this package."""
+    def __init__(self, substrate, extrinsic_hash, block_number, index, error, weight, fee, events):
+        self.substrate = substrate
+        self.extrinsic_hash = extrinsic_hash if isinstance(extrinsic_hash, str) else f'0x{extrinsic_hash.hex()}'
+        self.block_number = block_number
+        self.block_hash = substrate.chain.block_hash(block_number)
+        self.extrinsic_idx = index
+        self.is_success = error is None
+        self.error_message = error
+        self.weight = weight
+        self.total_fee_amount = fee
+        self.triggered_events = events
+        self.finalized = False
+
+    def get_extrinsic_identifier(self):
+        return f'{self.block_number}-{self.extrinsic_idx}'
+
+
+class MockMessageData:
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def to_hex(self):
+        return '0x' + json.dumps([self.name, self.args]).encode().hex()
+
+
+def decode_message(data):
+    name, args = json.loads(bytes.fromhex(data[2:]))
+    return name, args
+
+
+class MockMetadata:
+    def generate_message_data(self, name, args=None):
+        return MockMessageData(name, args or {})
+
+
+class MockContract:
+    """Stand-in for ContractInstance of a contract on a MockChain."""
+    def __init__(self, substrate, address, metadata):
+        self.substrate = substrate
+        self.contract_address = address
+        self.metadata = metadata
+
+    def read(self, keypair, method, args=None, value=0, gas_limit=None, block_hash=None):
+        self.substrate.wait()
+        return self.substrate.chain.dry_run(keypair.ss58_address, self.contract_address, method, args or {}, value)
+
+
+class MockSubstrate:
+    """Stand-in for utils.Substrate connected to a MockChain, covering the calls made by this package (Dex, traders
+    in blocking and pipelined mode, Provisioner, plans), except BlockObserver and finality tracking.
+    Calls are composed and encoded as JSON and really signed with the keypair, so the client does comparable work."""
+    def __init__(self, chain, url):
+        self.chain = chain
+        self.url = url
+        self.ss58_format = 42
+        self.runtime_version = 1
+        self.transaction_version = 1
+
+    def wait(self):
+        if self.chain.latency:
+            sleep(self.chain.latency)
+
+    def contract_metadata(self, metadata_file):
+        return MockMetadata()
+
+    def contract(self, address, metadata):
+        return MockContract(self, address, metadata)
+
+    def contract_receipt(self, receipt, contract):
+        return receipt
+
+    def extrinsic_receipt(self, extrinsic_hash, block_hash, block_number, extrinsic_idx):
+        self.wait()
+        return MockReceipt(self, extrinsic_hash, block_number, extrinsic_idx, *self.chain.outcomes[(block_number, extrinsic_idx)])
+
+    def decode_contract_event(self, event, metadata):
+        return event.value['attributes']['data']
+
+    def account(self, address):
+        with self.chain.lock:
+            return SimpleNamespace(value={'nonce': self.chain.nonces.get(address, 0), 'data': {'free': self.chain.native(address), 'reserved': 0}})
+
+    def query(self, module, storage_function, params=None, block_hash=None):
+        if (module, storage_function) != ('System', 'Account'):
+            raise ValueError(f'Storage {module}::{storage_function} is not supported by the mock chain')
+        self.wait()
+        return self.account(params[0])
+
+    def create_storage_key(self, pallet, storage_function, params=None):
+        if (pallet, storage_function) != ('System', 'Account'):
+            raise ValueError(f'Storage {pallet}::{storage_function} is not supported by the mock chain')
+        return params[0]
+
+    def query_multi(self, storage_keys, block_hash=None):
+        """Only System::Account keys (from create_storage_key()) are supported."""
+        self.wait()
+        return [(key, self.account(key)) for key in storage_keys]
+
+    def get_constant(self, module_name, constant_name, block_hash=None):
+        if (module_name, constant_name) != ('System', 'BlockWeights'):
+            raise ValueError(f'Constant {module_name}::{constant_name} is not supported by the mock chain')
+        limit = {'ref_time': MAX_EXTRINSIC[0], 'proof_size': MAX_EXTRINSIC[1]}
+        return SimpleNamespace(value={'per_class': {'normal': {'max_extrinsic': limit, 'max_total': limit}}})
+
+    def get_payment_info(self, call, keypair):
+        self.wait()
+        ref_time, proof_size = self.chain.call_weight(json.loads(call.encode()))
+        ref_time, proof_size = ref_time + EXTRINSIC_WEIGHT[0], proof_size + EXTRINSIC_WEIGHT[1]
+        return {'class': 'normal', 'partialFee': self.chain.fee(ref_time), 'weight': {'ref_time': ref_time, 'proof_size': proof_size}}
+
+    def compose_call(self, call_module, call_function, call_params=None):
+        return MockCall(call_module, call_function, call_params or {})
+
+    def get_account_nonce(self, account_address):
+        self.wait()
+        return self.chain.nonces.get(account_address, 0)
+
+    def create_signed_extrinsic(self, call, keypair, era=None, nonce=None, tip=0, tip_asset_id=None, signature=None):
+        if nonce is None:
+            nonce = self.get_account_nonce(keypair.ss58_address)
+        payload = call.encode() + keypair.public_key + nonce.to_bytes(4, 'little')
+        return MockExtrinsic(payload + keypair.sign(payload))
+
+    def submit_extrinsic(self, extrinsic, wait_for_inclusion=False, wait_for_finalization=False):
+        self.wait()
+        number, index, error, weight, fee, events = self.chain.apply(extrinsic)
+        if (wait_for_inclusion or wait_for_finalization) and self.chain.block_time:
+            sleep(max(0.0, self.chain.block_start(number) - time()))
+        return MockReceipt(self, extrinsic.extrinsic_hash, number, index, error, weight, fee, events)
+
+    def rpc_request(self, method, params, result_handler=None):
+        self.wait()
+        if method == 'system_accountNextIndex':
+            return {'result': self.chain.nonces.get(params[0], 0)}
+        if method == 'system_health':
+            return {'result': {'isSyncing': False, 'peers': 0, 'shouldHavePeers': False}}
+        if method == 'chain_getBlockHash':
+            return {'result': self.get_block_hash(params[0] if params else None)}
+        if method == 'chain_getBlock':
+            number = self.chain.numbers.get(params[0])
+            extrinsics = ['0x' + data.hex() for data in self.chain.blocks.get(number, [])]
+            return {'result': {'block': {'header': {'number': number}, 'extrinsics': extrinsics}}}
+        if method == 'author_submitExtrinsic':
+            extrinsic = MockExtrinsic(bytes.fromhex(params[0][2:]))
+            self.chain.apply(extrinsic)
+            return {'result': f'0x{extrinsic.extrinsic_hash.hex()}'}
+        raise ValueError(f'RPC method {method} is not supported by the mock chain')
+
+    def subscribe_block_headers(self, subscription_handler, ignore_decoding_errors=False, include_author=False, finalized_only=False):
+        """Call `subscription_handler` for every new block (polling the chain), until it returns something."""
+        update_nr, head = 0, None
+        while True:
+            number = self.chain.produced()
+            if number != head:
+                head = number
+                result = subscription_handler({'header': {'number': number}}, update_nr, 'mock')
+                if result is not None:
+                    return result
+                update_nr += 1
+            sleep(self.chain.block_time / 10 or 0.01)
+
+    def get_block_hash(self, block_id=None):
+        return self.chain.block_hash(self.chain.head if block_id is None else block_id)
+
+    def is_valid_ss58_address(self, value):
+        return is_valid_ss58_address(value, valid_ss58_format=self.ss58_format)
+
+    def init_runtime(self, block_hash=None, block_id=None):
+        pass
+
+    def connect_websocket(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def chain(url):
+    """The MockChain of `url` in this process, created on first use (see MockChain for the URL format)."""
+    with CHAINS_LOCK:
+        if url not in CHAINS:
+            parts = urlsplit(url)
+            if not url.startswith(MOCK_SCHEME) or not parts.netloc:
+                raise ValueError(f'Invalid mock chain URL: {url}')
+            params = {}
+            for key, values in parse_qs(parts.query).items():
+                if key not in PARAMS:
+                    raise ValueError(f'Unknown mock chain parameter: {key} (expected one of {", ".join(PARAMS)})')
+                params[key] = PARAMS[key](values[-1])
+            CHAINS[url] = MockChain(url, **params)
+        return CHAINS[url]
+
+
+def connect(url):
+    """New connection (MockSubstrate) to the mock chain of `url`."""
+    return MockSubstrate(chain(url), url)
+
+
+def router_address(url):
+    return chain(url).router
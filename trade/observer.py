@@ -0,0 +1,212 @@
+from collections import namedtuple
+from threading import Lock, Thread
+from time import time
+from substrateinterface import SubstrateInterface
+from substrateinterface.utils.ss58 import ss58_decode
+
+from .utils import batch_items, check_url, read_metadata
+
+BlockStats = namedtuple('BlockStats', ['number', 'block_hash', 'timestamp', 'seen', 'extrinsics', 'contract_calls',
+                                       'swaps', 'failed_swaps', 'weight', 'weight_limit', 'offered'])
+BlockStats.__doc__ = """What a single block contained. `timestamp` is the on-chain time (seconds), `seen` the time the observer
+got the block. `swaps` maps router method to the number of calls executed, `failed_swaps` counts router calls which failed
+(calls of a Utility batch skipped after it was interrupted are not counted at all).
+`weight` is the ref_time used by normal extrinsics, `weight_limit` their maximum per block. `offered` is the rate
+(trades/s) of the load profile at the time the block was seen, None without a profile."""
+
+
+class BlockObserver:
+    """Watches the chain itself to see how much of the offered load made it into blocks.
+
+    Runs in a daemon thread on its own connection and, for every new block, counts `Contracts::call` extrinsics
+    (also inside Utility batches) and router swaps by method, decoded from the message selector with router metadata.
+    Block fullness is the normal-class weight used (System::BlockWeight) relative to the normal-class maximum
+    derived from System::BlockWeights. Achieved swaps/s is computed from on-chain timestamps over the last `window`
+    blocks and reported next to the rate of the load profile given to offer().
+
+    Usage pattern:
+    o = BlockObserver(dex)
+    pool = TraderPool(dex, 100, phrase, observer=o)
+    o.start()
+    pool.traffic(Ramp(10, 200, 300))
+    ...
+    o.stop()
+    print(o.saturation())
+    """
+    def __init__(self, dex, url=None, window=10, report=True):
+        self.dex = dex
+        self.url = check_url(url or dex.chain_url)
+        self.window = window
+        self.report = report
+        self.router = ss58_decode(dex.router_address)
+        messages = read_metadata(dex.router_metadata)['spec']['messages']
+        self.selectors = {m['selector']: m['label'] for m in messages}
+        self.chain = None
+        self.weight_limit = None
+        self.blocks = []
+        self.block_number = None
+        self.profile = None
+        self.profile_start = None
+        self.lock = Lock()
+        self.running = False
+        self.thread = None
+
+    def log(self, msg):
+        if self.report:
+            print(msg, end='')
+
+    def start(self):
+        self.chain = SubstrateInterface(url=self.url)
+        self.weight_limit = self.normal_weight_limit()
+        self.running = True
+        self.thread = Thread(target=self.chain.subscribe_block_headers, args=(self.on_head,), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def offer(self, profile):
+        """Start comparing blocks with `profile` (see traffic.py), assumed to start now."""
+        with self.lock:
+            self.profile = profile
+            self.profile_start = time()
+
+    def normal_weight_limit(self):
+        weights = self.chain.get_constant('System', 'BlockWeights').value
+        normal = weights['per_class']['normal']
+        if normal.get('max_total') is not None:
+            return normal['max_total']['ref_time']
+        return weights['max_block']['ref_time']
+
+    def on_head(self, head, update_nr, subscription_id):
+        number = head['header']['number']
+        first = number if self.block_number is None else self.block_number + 1
+        for n in range(first, number + 1):
+            stats = self.process_block(n)
+            with self.lock:
+                self.blocks.append(stats)
+            self.log(self.status_line(stats) + '\n')
+        self.block_number = max(number, self.block_number or 0)
+        return None if self.running else True
+
+    def process_block(self, number):
+        seen = time()
+        block_hash = self.chain.get_block_hash(number)
+        block = self.chain.get_block(block_hash)
+        events = {}
+        for e in self.chain.get_events(block_hash):
+            events.setdefault(e.value['extrinsic_idx'], []).append(e)
+        timestamp, contract_calls, swaps, failed_swaps = None, 0, {}, 0
+        for idx, extrinsic in enumerate(block['extrinsics']):
+            extrinsic_events = events.get(idx, [])
+            success = not any(e.value['module_id'] == 'System' and e.value['event_id'] == 'ExtrinsicFailed' for e in extrinsic_events)
+            for call, ok in flatten(extrinsic.value['call'], extrinsic_events, success):
+                key = (call['call_module'], call['call_function'])
+                if key == ('Timestamp', 'set'):
+                    timestamp = call_arg(call, 'now') / 1000
+                if key != ('Contracts', 'call'):
+                    continue
+                contract_calls += 1
+                dest = call_arg(call, 'dest')
+                dest = dest.get('Id') if isinstance(dest, dict) else dest
+                if dest is None or ss58_decode(dest) != self.router:
+                    continue
+                method = self.selectors.get(call_arg(call, 'data')[:10], 'unknown')
+                swaps[method] = swaps.get(method, 0) + 1
+                failed_swaps += not ok
+        weight = self.chain.query('System', 'BlockWeight', block_hash=block_hash).value['normal']['ref_time']
+        with self.lock:
+            offered = self.profile.rate_at(seen - self.profile_start) if self.profile is not None else None
+        return BlockStats(number, block_hash, timestamp, seen, len(block['extrinsics']), contract_calls, swaps,
+                          failed_swaps, weight, self.weight_limit, offered)
+
+    def achieved(self, blocks=None):
+        """Successful router swaps per second over `blocks` (default: the last `window` blocks), based on block timestamps."""
+        if blocks is None:
+            with self.lock:
+                blocks = self.blocks[-self.window:]
+        if len(blocks) < 2 or blocks[0].timestamp is None or blocks[-1].timestamp is None:
+            return None
+        elapsed = blocks[-1].timestamp - blocks[0].timestamp
+        swaps = sum(sum(b.swaps.values()) - b.failed_swaps for b in blocks[1:])
+        return swaps / elapsed if elapsed > 0 else None
+
+    def status_line(self, stats):
+        achieved = self.achieved()
+        swaps = sum(stats.swaps.values())
+        line = (f'Block {stats.number}: {stats.extrinsics} extrinsics, {stats.contract_calls} contract calls, '
+                f'{swaps} swaps ({stats.failed_swaps} failed), weight {100 * stats.weight / stats.weight_limit:.1f}%')
+        if achieved is not None:
+            line += f', achieved {achieved:.1f} swaps/s'
+        if stats.offered is not None:
+            line += f', offered {stats.offered:.1f}/s'
+        return line
+
+    def summary(self):
+        with self.lock:
+            blocks = list(self.blocks)
+        swaps = {}
+        for b in blocks:
+            for method, n in b.swaps.items():
+                swaps[method] = swaps.get(method, 0) + n
+        return {
+            'blocks': len(blocks),
+            'contract_calls': sum(b.contract_calls for b in blocks),
+            'swaps': swaps,
+            'failed_swaps': sum(b.failed_swaps for b in blocks),
+            'achieved': self.achieved(blocks),
+            'fullness_mean': sum(b.weight / b.weight_limit for b in blocks) / len(blocks) if blocks else None,
+            'fullness_max': max((b.weight / b.weight_limit for b in blocks), default=None),
+            'saturation': self.saturation()
+        }
+
+    def saturation(self, tolerance=0.9, resolution=5):
+        """Group blocks by offered rate (in buckets of `resolution` trades/s) and return the highest offered rate
+        for which achieved throughput stayed within `tolerance` of it, or None if no blocks were observed under load.
+        Meant for Ramp or Step profiles, where the offered rate sweeps through a range."""
+        with self.lock:
+            blocks = list(self.blocks)
+        groups = {}
+        for prev, b in zip(blocks, blocks[1:]):
+            if b.offered is None or prev.timestamp is None or b.timestamp is None or b.timestamp <= prev.timestamp:
+                continue
+            group = groups.setdefault(round(b.offered / resolution) * resolution, [0, 0])
+            group[0] += sum(b.swaps.values()) - b.failed_swaps
+            group[1] += b.timestamp - prev.timestamp
+        best = None
+        for rate in sorted(groups):
+            swaps, elapsed = groups[rate]
+            if rate > 0 and swaps / elapsed >= tolerance * rate:
+                best = rate
+        return best
+
+
+def flatten(call, events, success):
+    """Yield (call, succeeded) for `call` and, for Utility batches, for the calls inside which were executed,
+    based on `events` of the extrinsic (see batch_items())."""
+    yield call, success
+    if is_batch(call):
+        calls = call_arg(call, 'calls')
+        for inner, ok in zip(calls, batch_items(events, len(calls), success)):
+            if ok is not None:
+                yield from nested(inner, ok)
+
+
+def nested(call, ok):
+    """Yield (call, ok) for `call` and the calls of batches inside it, which share its outcome (traders never nest batches,
+    so their events are not told apart)."""
+    yield call, ok
+    if is_batch(call):
+        for inner in call_arg(call, 'calls'):
+            yield from nested(inner, ok)
+
+
+def is_batch(call):
+    return call['call_module'] == 'Utility' and call['call_function'] in ('batch', 'batch_all', 'force_batch')
+
+
+def call_arg(call, name):
+    for arg in call['call_args']:
+        if arg['name'] == name:
+            return arg['value']
+    return None
@@ -0,0 +1,80 @@
+import random
+import numpy as np
+
+
+class PathIndex:
+    """Precomputed trade paths of a Dex.
+
+    Tokens are given integer ids (in the order of dex.tokens) and the token graph is kept as CSR adjacency
+    arrays (`offsets`, `neighbours`). All simple paths with 1..`max_length` swaps are enumerated once
+    and stored as int arrays of shape (n_paths, length + 1), sorted by the starting token.
+    `pairs[length]` holds, aligned with `paths[length]`, indices (in dex.pairs) of pairs used by each path,
+    so path weights can be derived from pair weights, e.g. `pair_weights[index.pairs[2]].prod(axis=1)`.
+
+    Number of paths grows quickly with `max_length` for dense dexes, keep it small.
+    """
+    def __init__(self, dex, max_length=3):
+        self.tokens = list(dex.tokens)
+        self.ids = {t: i for i, t in enumerate(self.tokens)}
+        pair_index = {key: i for i, key in enumerate(dex.pairs)}
+        degrees = np.array([len(dex.tokens[t]) for t in self.tokens], dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(degrees)])
+        self.neighbours = np.array([self.ids[n] for t in self.tokens for n in dex.tokens[t]], dtype=np.int64)
+        self.pair_ids = np.array([pair_index[(t, n) if t < n else (n, t)] for t in self.tokens for n in dex.tokens[t]], dtype=np.int64)
+        self.max_length = max_length
+        self.paths = {}
+        self.pairs = {}
+        self.starts = {}
+        paths = np.arange(len(self.tokens), dtype=np.int64)[:, None]
+        pairs = np.empty((len(self.tokens), 0), dtype=np.int64)
+        for length in range(1, max_length + 1):
+            paths, pairs = self.extend(paths, pairs)
+            order = np.argsort(paths[:, 0], kind='stable')
+            self.paths[length], self.pairs[length] = paths[order], pairs[order]
+            self.starts[length] = np.searchsorted(self.paths[length][:, 0], np.arange(len(self.tokens) + 1))
+
+    def extend(self, paths, pairs):
+        """All extensions of `paths` by one hop which do not revisit a token, with pairs they go through."""
+        last = paths[:, -1]
+        degrees = self.offsets[last + 1] - self.offsets[last]
+        rows = np.repeat(np.arange(len(paths)), degrees)
+        edges = self.offsets[last[rows]] + np.arange(len(rows)) - np.repeat(np.cumsum(degrees) - degrees, degrees)
+        nxt = self.neighbours[edges]
+        mask = (paths[rows] != nxt[:, None]).all(axis=1)
+        rows, edges = rows[mask], edges[mask]
+        return np.hstack([paths[rows], nxt[mask][:, None]]), np.hstack([pairs[rows], self.pair_ids[edges][:, None]])
+
+    def random_path(self, start, max_length=1):
+        """Random path from `start` with `max_length` swaps, or the longest shorter one available."""
+        s = self.ids[start]
+        for length in range(min(max_length, self.max_length), 0, -1):
+            lo, hi = self.starts[length][s], self.starts[length][s + 1]
+            if hi > lo:
+                return [self.tokens[i] for i in self.paths[length][random.randrange(lo, hi)]]
+        return [start]
+
+    def sample_paths(self, n, length, weights=None, start=None, rng=None):
+        """Draw `n` paths with exactly `length` swaps, return an int array of shape (n, length + 1).
+
+        `weights` (optional) are aligned with self.paths[length] (e.g. derived from self.pairs[length]).
+        `start` (optional) is a collection of token addresses the paths are allowed to begin with.
+        """
+        if length not in self.paths:
+            raise ValueError(f'Paths of length {length} were not indexed (max_length={self.max_length})')
+        rng = rng or np.random.default_rng()
+        paths = self.paths[length]
+        p = None if weights is None else np.asarray(weights, dtype=np.float64)
+        if start is not None:
+            ids = [self.ids[t] for t in start]
+            rows = np.concatenate([np.arange(self.starts[length][i], self.starts[length][i + 1]) for i in ids]) if ids else np.array([], dtype=np.int64)
+            paths = paths[rows]
+            p = None if p is None else p[rows]
+        if len(paths) == 0:
+            raise ValueError(f'No paths of length {length}')
+        if p is not None:
+            p = p / p.sum()
+        return paths[rng.choice(len(paths), size=n, p=p)]
+
+    def addresses(self, paths):
+        """Convert an int array of paths into lists of token addresses."""
+        return [[self.tokens[i] for i in row] for row in paths.tolist()]
@@ -0,0 +1,216 @@
+from hashlib import blake2b
+from queue import Empty, Queue
+from threading import Lock, Thread
+from time import time
+from substrateinterface.exceptions import SubstrateRequestException
+
+from .endpoints import CONNECTION_ERRORS
+from .utils import connect, sign
+
+
+class BlockWatcher:
+    """Follows new blocks on a dedicated connection and reports inclusion of watched extrinsics.
+
+    Runs in a daemon thread. Blocks are fetched raw and extrinsics are identified by hashing their
+    encoded bytes, so no SCALE decoding happens here. For each watched extrinsic found in a block,
+    `callback(block_hash, block_number, extrinsic_idx)` is called from the watcher thread.
+    The watcher never builds receipts itself: its connection is busy with the subscription.
+    One watcher can be shared by any number of Pipelines in the same process.
+    With `endpoints` (an EndpointPool, `url` is then ignored) the connection is taken from the pool and moved to another
+    node when it breaks. Blocks produced in the meantime are processed once the subscription is back.
+    """
+    def __init__(self, url=None, endpoints=None):
+        self.endpoints = endpoints
+        self.chain = endpoints.connect() if endpoints is not None else connect(url)
+        self.watched = {}
+        self.lock = Lock()
+        self.block_number = None
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def watch(self, extrinsic_hash, callback):
+        with self.lock:
+            self.watched[extrinsic_hash] = callback
+
+    def unwatch(self, extrinsic_hash):
+        with self.lock:
+            self.watched.pop(extrinsic_hash, None)
+
+    def run(self):
+        while True:
+            try:
+                return self.chain.subscribe_block_headers(self.on_head)
+            except CONNECTION_ERRORS:
+                if self.endpoints is None:
+                    raise
+                self.endpoints.reconnect(self.chain)
+
+    def on_head(self, head, update_nr, subscription_id):
+        number = head['header']['number']
+        first = number if self.block_number is None else self.block_number + 1
+        for n in range(first, number + 1):
+            self.process_block(n)
+        self.block_number = max(number, self.block_number or 0)
+
+    def process_block(self, number):
+        block_hash = self.chain.get_block_hash(number)
+        block = self.chain.rpc_request('chain_getBlock', [block_hash])['result']['block']
+        for idx, data in enumerate(block['extrinsics']):
+            extrinsic_hash = '0x' + blake2b(bytes.fromhex(data[2:]), digest_size=32).hexdigest()
+            with self.lock:
+                callback = self.watched.pop(extrinsic_hash, None)
+            if callback:
+                callback(block_hash, number, idx)
+
+
+class Submission:
+    """Single extrinsic sent by a Pipeline. `receipt` is set once it is included in a block,
+    `error` once the pipeline gives up on it."""
+    def __init__(self, extrinsic, nonce, tag, block):
+        self.extrinsic = extrinsic
+        self.extrinsic_hash = f'0x{extrinsic.extrinsic_hash.hex()}'
+        self.nonce = nonce
+        self.tag = tag
+        self.block = block
+        self.submitted = time()
+        self.sent = self.submitted
+        self.intended = None
+        self.included = None
+        self.receipt = None
+        self.error = None
+
+
+class Pipeline:
+    """Non-blocking submission of extrinsics signed by a single account.
+
+    Keeps the account nonce locally, so many extrinsics can be signed and sent back to back without
+    waiting for inclusion. Inclusion is reported by a BlockWatcher and picked up by collect().
+    `notify` (optional) is called from the watcher thread whenever a submission gets included.
+
+    Recovery: a submission which did not make it into a block within `timeout` blocks (or `max_wait` seconds,
+    in case the watcher stopped following blocks) is checked against the on-chain nonce. If its nonce is already
+    used, it is reported as lost. If the chain is stuck right at its nonce, it is sent again (the node may have
+    silently dropped it). Nonces below the lowest pending one which nobody is going to use (invalid or lost
+    extrinsics) are filled with System::remark, so the rest of the pipeline is not stuck in the future queue
+    of the transaction pool.
+    """
+    def __init__(self, chain, keypair, watcher, timeout=10, notify=None, max_wait=60):
+        self.chain = chain
+        self.kp = keypair
+        self.watcher = watcher
+        self.timeout = timeout
+        self.max_wait = max_wait
+        self.nonce = self.next_nonce()
+        self.pending = {}
+        self.done = Queue()
+        self.notify = notify
+
+    def next_nonce(self):
+        """Next nonce of the account, including extrinsics already in the transaction pool."""
+        return self.chain.rpc_request('system_accountNextIndex', [self.kp.ss58_address])['result']
+
+    def submit(self, call, tag=None):
+        """Sign `call` with the next nonce and send it. Return the Submission.
+        A stale nonce is resynced once, other errors reported by the node are re-raised, like in blocking mode."""
+        for attempt in range(2):
+            extrinsic = sign(self.chain, call, self.kp, self.nonce)
+            sub = Submission(extrinsic, self.nonce, tag, self.watcher.block_number)
+            self.watcher.watch(sub.extrinsic_hash, lambda *args, s=sub: self.included(s, args))
+            try:
+                self.send(sub)
+            except SubstrateRequestException as e:
+                self.watcher.unwatch(sub.extrinsic_hash)
+                if attempt == 0 and stale_nonce(e):
+                    self.nonce = self.next_nonce()
+                    continue
+                raise
+            self.pending[sub.nonce] = sub
+            self.nonce += 1
+            return sub
+
+    def included(self, sub, args):
+        self.done.put((sub, args, time()))
+        if self.notify is not None:
+            self.notify()
+
+    def send(self, sub):
+        response = self.chain.rpc_request('author_submitExtrinsic', [str(sub.extrinsic.data)])
+        if 'result' not in response:
+            raise SubstrateRequestException(response.get('error'))
+
+    def collect(self, wait=False, timeout=1.0):
+        """Return the list of Submissions which got included in a block or failed since the last call.
+        If `wait` is True, block until at least one is available (or `timeout` seconds pass, so that recovery
+        of stuck submissions runs meanwhile). Nothing to wait for if no submission is pending."""
+        wait = wait and bool(self.pending)
+        result = []
+        try:
+            while True:
+                sub, (block_hash, block_number, idx), included = self.done.get(block=wait and not result, timeout=timeout)
+                if self.pending.pop(sub.nonce, None) is not sub:
+                    continue
+                sub.included = included
+                sub.receipt = self.chain.extrinsic_receipt(sub.extrinsic_hash, block_hash, block_number, idx)
+                result.append(sub)
+        except Empty:
+            pass
+        return result + self.recover()
+
+    def expired(self, sub, block, now):
+        if now - sub.sent > self.max_wait:
+            return True
+        return block is not None and sub.block is not None and sub.block + self.timeout < block
+
+    def recover(self):
+        if not self.pending:
+            return []
+        block, now = self.watcher.block_number, time()
+        for sub in self.pending.values():
+            sub.block = block if sub.block is None else sub.block
+        with self.watcher.lock:
+            stale = [s for s in self.pending.values() if self.expired(s, block, now) and s.extrinsic_hash in self.watcher.watched]
+        if not stale:
+            return []
+        failed = []
+        chain_nonce = self.chain.get_account_nonce(self.kp.ss58_address)
+        for sub in sorted(stale, key=lambda s: s.nonce):
+            sub.block, sub.sent = block, now
+            if sub.nonce < chain_nonce:
+                failed.append(self.fail(sub, 'Nonce already used'))
+                continue
+            try:
+                self.send(sub)
+            except SubstrateRequestException as e:
+                if not already_known(e):
+                    failed.append(self.fail(sub, e.args[0]))
+        first = min(self.pending, default=self.nonce)
+        for nonce in range(chain_nonce, first):
+            self.fill_gap(nonce)
+        return failed
+
+    def fail(self, sub, error):
+        self.watcher.unwatch(sub.extrinsic_hash)
+        del self.pending[sub.nonce]
+        sub.error = error
+        return sub
+
+    def fill_gap(self, nonce):
+        call = self.chain.compose_call(call_module='System', call_function='remark', call_params={'remark': '0x'})
+        extrinsic = sign(self.chain, call, self.kp, nonce)
+        try:
+            self.chain.rpc_request('author_submitExtrinsic', [str(extrinsic.data)])
+        except SubstrateRequestException:
+            pass
+
+
+def error_data(e):
+    msg = e.args[0] if e.args else None
+    return f'{msg.get("message")} {msg.get("data")}' if isinstance(msg, dict) else str(msg)
+
+
+def stale_nonce(e):
+    return any(s in error_data(e) for s in ('outdated', 'Priority is too low'))
+
+
+def already_known(e):
+    return any(s in error_data(e) for s in ('already imported', 'Already Imported', 'temporarily banned', 'Priority is too low'))
@@ -0,0 +1,230 @@
+import json
+import random
+import struct
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from threading import Lock, Thread
+from time import perf_counter, time
+from substrateinterface.exceptions import ContractReadFailedException, SubstrateRequestException
+
+from .dex import Reader
+from .ledger import NATIVE
+from .pipeline import error_data
+from .trader import pick_trade, swap_args
+from .traffic import Constant, latency_summary, wait_until
+from .utils import check_file, check_url, connect, contract_call, derive_keypairs, estimate_gas
+
+MAGIC = b'CBPLAN\x00\x01'
+LENGTH = struct.Struct('<I')
+RECORD = struct.Struct('<IIB')  # trader, nonce, number of tokens in path
+
+PlannedTrade = namedtuple('PlannedTrade', ['trader', 'nonce', 'path', 'amount', 'extrinsic'])
+PlannedTrade.__doc__ = """Single pre-signed trade: index of the trader account, its nonce, path (token addresses), amount in
+and the signed extrinsic (raw bytes, ready for author_submitExtrinsic)."""
+
+
+def make_plan(dex, phrase, n_traders, n_trades, filename, steps=1, seed=None, quotes=None, workers=None, gas_factor=1.5,
+              minimal_balance=1000000):
+    """Generate `n_trades` signed router swaps of accounts `phrase`//0 ... //(n_traders-1) and save them to `filename`.
+
+    Trades are assigned to traders round-robin and given consecutive nonces, starting from the current ones. Paths and
+    amounts are drawn like in Trader.trade() (`steps` is the max number of swaps, or a dict {steps: weight}), from
+    balances read now and updated as the plan goes. With `quotes` (a QuoteEngine with fetched reserves) outputs of
+    planned swaps are credited too, otherwise only spent amounts are subtracted. Everything is deterministic for
+    a given `seed` and chain state. Gas is estimated once per router method and path length (relaxed by `gas_factor`),
+    encoding and signing run in a pool of `workers` processes. Extrinsics are immortal, so the plan stays valid
+    for a chain with the same genesis, runtime and account nonces, e.g. a fresh dev chain with the same deployment.
+    """
+    random.seed(seed)
+    chain = connect(dex.chain_url)
+    chain.init_runtime()
+    keypairs = derive_keypairs(phrase, range(n_traders))
+    reader = Reader(chain)
+    router = reader.contract(dex.router_address, dex.router_metadata)
+    nonces = [chain.rpc_request('system_accountNextIndex', [kp.ss58_address])['result'] for kp in keypairs]
+    start_nonces = list(nonces)
+    balances = read_balances(dex, chain, [kp.ss58_address for kp in keypairs], workers or 8)
+    mix = (list(steps), list(steps.values())) if isinstance(steps, dict) else None
+
+    trades, gas = [], {}
+    for i in range(n_trades):
+        t = i % n_traders
+        max_path_len = random.choices(*mix)[0] if mix else steps
+        path, amount = pick_trade(dex, balances[t], max_path_len, minimal_balance)
+        balances[t][NATIVE if path[0] == dex.wnative_address else path[0]] -= amount
+        if quotes is not None:
+            balances[t][NATIVE if path[-1] == dex.wnative_address else path[-1]] += quotes.apply_swap(path, amount)
+        method, args, value = swap_args(dex, keypairs[t].ss58_address, path, amount)
+        key = (method, len(path))
+        if key not in gas:
+            gas[key] = estimate_gas(router, keypairs[t], method, args, value, gas_factor)
+        trades.append((t, nonces[t], path, amount))
+        nonces[t] += 1
+
+    n_chunks = min(workers or 8, n_traders)
+    chunks = [[(i, trade) for i, trade in enumerate(trades) if trade[0] % n_chunks == j] for j in range(n_chunks)]
+    extrinsics = [None] * len(trades)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for signed in executor.map(sign_trades, [dex] * n_chunks, [keypairs] * n_chunks, chunks, [gas] * n_chunks):
+            for i, blob in signed:
+                extrinsics[i] = blob
+
+    header = {
+        'genesis_hash': chain.get_block_hash(0),
+        'spec_version': chain.runtime_version,
+        'transaction_version': chain.transaction_version,
+        'chain_url': dex.chain_url,
+        'router': dex.router_address,
+        'tokens': list(dex.tokens),
+        'accounts': [kp.ss58_address for kp in keypairs],
+        'start_nonces': start_nonces,
+        'trades': n_trades,
+        'steps': steps,
+        'seed': seed,
+        'created': time()
+    }
+    save_plan(filename, header, [PlannedTrade(*trade, blob) for trade, blob in zip(trades, extrinsics)])
+    return header
+
+
+def read_balances(dex, chain, addresses, workers=1):
+    """Balances (dicts like Trader.balances) of many accounts. PSP22 reads are spread over `workers` threads."""
+    keys = [chain.create_storage_key('System', 'Account', [a]) for a in addresses]
+    balances = [{NATIVE: value.value['data']['free']} for _, value in chain.query_multi(keys)]
+    items = [(i, t) for i in range(len(addresses)) for t in dex.tokens]
+
+    def read(reader, item):
+        token = reader.contract(item[1], dex.psp22_metadata)
+        try:
+            return token.read(reader.kp, method='PSP22::balance_of', args={'owner': addresses[item[0]]}).contract_result_data.value['Ok']
+        except ContractReadFailedException:
+            return 0
+
+    for (i, t), value in zip(items, dex.map_reads(read, items, workers, chain)):
+        balances[i][t] = value
+    return balances
+
+
+def sign_trades(dex, keypairs, trades, gas):
+    """Encode and sign (index, (trader, nonce, path, amount)) trades on a connection of this process."""
+    chain = connect(dex.chain_url)
+    router = Reader(chain).contract(dex.router_address, dex.router_metadata)
+    result = []
+    for i, (t, nonce, path, amount) in trades:
+        method, args, value = swap_args(dex, keypairs[t].ss58_address, path, amount)
+        call = contract_call(router, method, args, value, gas[(method, len(path))])
+        extrinsic = chain.create_signed_extrinsic(call=call, keypair=keypairs[t], nonce=nonce)
+        result.append((i, bytes(extrinsic.data.data)))
+    return result
+
+
+def save_plan(filename, header, trades):
+    """File layout: MAGIC, header (u32 length + JSON), then for every trade: trader (u32), nonce (u32),
+    number of tokens in path (u8), token indices in header['tokens'] (u16 each), amount (u128),
+    extrinsic (u32 length + bytes). All integers little-endian."""
+    ids = {t: i for i, t in enumerate(header['tokens'])}
+    raw = json.dumps(header).encode()
+    with open(filename, 'wb') as f:
+        f.write(MAGIC + LENGTH.pack(len(raw)) + raw)
+        for trade in trades:
+            f.write(RECORD.pack(trade.trader, trade.nonce, len(trade.path)))
+            f.write(struct.pack(f'<{len(trade.path)}H', *(ids[t] for t in trade.path)))
+            f.write(trade.amount.to_bytes(16, 'little'))
+            f.write(LENGTH.pack(len(trade.extrinsic)) + trade.extrinsic)
+
+
+def load_plan(filename):
+    """Return the header and the list of PlannedTrades of a plan file."""
+    with open(check_file(filename), 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f'Not a trade plan: {filename}')
+    pos = len(MAGIC)
+    (size,) = LENGTH.unpack_from(data, pos)
+    header = json.loads(data[pos + LENGTH.size:pos + LENGTH.size + size])
+    pos += LENGTH.size + size
+    tokens = header['tokens']
+    trades = []
+    while pos < len(data):
+        trader, nonce, n = RECORD.unpack_from(data, pos)
+        pos += RECORD.size
+        path = [tokens[i] for i in struct.unpack_from(f'<{n}H', data, pos)]
+        pos += 2 * n
+        amount = int.from_bytes(data[pos:pos + 16], 'little')
+        (size,) = LENGTH.unpack_from(data, pos + 16)
+        pos += 16 + LENGTH.size
+        trades.append(PlannedTrade(trader, nonce, path, amount, data[pos:pos + size]))
+        pos += size
+    return header, trades
+
+
+def check_plan(header, chain):
+    """Return a list of reasons why the plan would not replay exactly on `chain` (empty if it should)."""
+    problems = []
+    chain.init_runtime()
+    if chain.get_block_hash(0) != header['genesis_hash']:
+        problems.append('different genesis hash')
+    if (chain.runtime_version, chain.transaction_version) != (header['spec_version'], header['transaction_version']):
+        problems.append(f'runtime version {chain.runtime_version}/{chain.transaction_version}, '
+                        f'plan signed for {header["spec_version"]}/{header["transaction_version"]}')
+    moved = sum(1 for a, n in zip(header['accounts'], header['start_nonces'])
+                if chain.rpc_request('system_accountNextIndex', [a])['result'] != n)
+    if moved:
+        problems.append(f'{moved} accounts have different nonces than at planning time')
+    return problems
+
+
+def blast(filename, url=None, profile=None, rate=None, connections=4, observer=None, force=False):
+    """Submit a plan: push pre-signed extrinsics with author_submitExtrinsic at the times of `profile` (or at a constant
+    `rate` per second; as fast as possible if neither is given). Nothing is built or signed here. Accounts are spread
+    over `connections` threads, each with its own connection, so the nonces of an account are sent in order.
+    Unless `force`, refuses to run if the plan would not replay exactly (see check_plan()).
+    Returns a summary: submitted and rejected counts, errors, and lag of actual submission behind schedule."""
+    header, trades = load_plan(filename)
+    url = check_url(url or header['chain_url'])
+    problems = check_plan(header, connect(url))
+    if problems and not force:
+        raise ValueError(f'Plan {filename} does not match the chain: {"; ".join(problems)}')
+    if profile is None:
+        profile = Constant(rate) if rate else None
+    times = list(islice(profile.times(), len(trades))) if profile is not None else [0.0] * len(trades)
+    trades = trades[:len(times)]
+
+    lock = Lock()
+    stats = {'submitted': 0, 'rejected': 0, 'errors': {}, 'lags': []}
+    chains = [connect(url) for _ in range(connections)]
+
+    def push(chain, items, start):
+        lags, errors, ok = [], {}, 0
+        for t, trade in items:
+            wait_until(start + t)
+            lags.append(perf_counter() - start - t)
+            try:
+                response = chain.rpc_request('author_submitExtrinsic', ['0x' + trade.extrinsic.hex()])
+                if 'result' not in response:
+                    raise SubstrateRequestException(response.get('error'))
+                ok += 1
+            except SubstrateRequestException as e:
+                errors[error_data(e)] = errors.get(error_data(e), 0) + 1
+        with lock:
+            stats['submitted'] += ok
+            stats['rejected'] += len(items) - ok
+            stats['lags'] += lags
+            for e, n in errors.items():
+                stats['errors'][e] = stats['errors'].get(e, 0) + n
+
+    start = perf_counter() + 0.1
+    if observer is not None and profile is not None:
+        observer.offer(profile)
+    threads = [Thread(target=push, args=(chain, [(t, trade) for t, trade in zip(times, trades) if trade.trader % connections == j], start))
+               for j, chain in enumerate(chains)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = perf_counter() - start
+    lags = stats.pop('lags')
+    stats.update({'duration': duration, 'rate': stats['submitted'] / duration if duration > 0 else None,
+                  'lag': latency_summary(lags), 'problems': problems})
+    return stats
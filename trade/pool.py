@@ -1,16 +1,24 @@
-from multiprocessing import Event, Process, Queue, Value
+import random
+from multiprocessing import Event, Process, Queue
+from queue import Empty
+from threading import Thread
 from substrateinterface.exceptions import SubstrateRequestException
-from websocket import WebSocketConnectionClosedException
-from time import sleep, time
+from time import time
 
+from .endpoints import CONNECTION_ERRORS, EndpointPool
+from . import profiler
+from .metrics import MetricsSink, error_class
+from .schedule import Dispatcher, PairLoad, Scheduler
+from .traffic import Constant, Order, latency_summary, make_traffic
 from .trader import Trader
+from .utils import GasCache, derive_keypairs
 
 
 class TraderPool:
     """Manager of a horde of traders.
 
     Each trader runs in a separate process and waits for a singal to perform a trade.
-    Signals are passed using a common queue. The signal should be a positive int,
+    Signals are passed using a common queue. The signal should be a positive int (or an Order),
     indicating how many atomic swaps the trade should consist of (occasionally a trader may
     decide to use a shorter path if the value is too large and they have problems finding a
     random path with the given length).
@@ -22,6 +30,20 @@ class TraderPool:
     NOTE! Please make sure that all the accounts {phrase}//0, {phrase}//1, ... {phrase}//(n-1) have some
     native coin available for trading and fees
 
+    Traders connect through `endpoints` (an EndpointPool, by default just `dex.chain_url`), e.g.
+    EndpointPool.local(4) spreads them evenly over 4 nodes of a local testnet. A trade interrupted by
+    a connection error is retried on another node, unless its extrinsic already reached the node (see EndpointPool.submit()).
+
+    With `batch` > 1, a trader which finds more orders waiting in the queue sends up to `batch` of them
+    as a single Utility batch extrinsic (batch_all if `atomic`), see Trader.trade_batch().
+
+    With `routing` set to a policy of Scheduler ('uniform', 'disjoint' or 'hot', with Zipf exponent `skew`),
+    orders get explicit paths and go to per-trader queues instead of the common one, so contention on pairs
+    is under control. Swaps per pair are counted in `load` (a PairLoad), see pair_load().
+
+    With `profile=True` every worker runs a Profiler (see profiler.py) and prints its summary when it exits.
+    After kill_traders(wait=True) the merged profile of all workers is available from client_profile().
+
     Usage pattern:
     t = TraderPool(...)
 
@@ -32,62 +54,187 @@ class TraderPool:
     # schedule 100 trades with 2 swaps each. Traders will start sending tx immediately.
     t.order_trades(100, 2)
 
+    # open-loop traffic following a rate profile (see traffic.py), e.g. Poisson arrivals with mean 20 trades/s
+    t.traffic(Poisson(20, duration=60))
+    t.stop_traffic()
+
+    # with observer=BlockObserver(dex) (started by the caller), blocks are compared with the offered load
+    # of traffic(), e.g. to find the saturation point with a Ramp profile (see observer.py)
+
     # terminate trader processes. Each will print a statistics of all performed trades
     t.kill_traders()
     """
-    def __init__(self, dex, n_traders, phrase):
+    def __init__(self, dex, n_traders, phrase, cache_gas=False, ledger=False, reconcile_every=None, metrics=None, observer=None, endpoints=None,
+                 batch=1, atomic=False, seed=None, routing=None, skew=1.0, profile=False):
         self.dex = dex
+        self.seed = seed
+        self.batch = batch
+        self.atomic = atomic
+        self.endpoints = endpoints or EndpointPool([dex.chain_url])
+        self.metrics = metrics
+        self.observer = observer
+        self.cache_gas = cache_gas
+        self.ledger = ledger
+        self.reconcile_every = reconcile_every
         self.n_traders = n_traders
         self.phrase = phrase
         self.queue = Queue()
+        self.queues = [self.queue] * n_traders
+        self.load = None
+        self.dispatcher = None
+        self.router = None
+        if routing is not None:
+            self.queues = [Queue() for _ in range(n_traders)]
+            self.load = PairLoad(dex)
+            self.dispatcher = Dispatcher(self.queues, Scheduler(dex, n_traders, routing, skew, seed), self.load)
+        self.profiles = Queue() if profile else None
+        self.profile = None
         self.traffic_maker = None
-        self.tps = Value('i', 0)
+        self.stop = Event()
+        self.proc = []
 
     def spawn_traders(self, set_allowance=True):
+        """Start trader processes. Keypairs are derived and contract metadata parsed here, once, before forking."""
+        self.dex.preload_metadata()
+        keypairs = derive_keypairs(self.phrase, range(self.n_traders))
         events = [Event() for _ in range(self.n_traders)]
-        proc = [Process(target=worker, args=(self.queue, events[i], self.dex, self.phrase, i, set_allowance)) for i in range(self.n_traders)]
-        for p in proc:
+        self.proc = [Process(target=worker, args=(self.queues[i], events[i], self.dex, keypairs[i], i, set_allowance, self.cache_gas, self.ledger,
+                                                   self.reconcile_every, self.metrics.channel if self.metrics else None, self.endpoints,
+                                                   self.batch, self.atomic, self.seed, self.load, self.profiles)) for i in range(self.n_traders)]
+        for p in self.proc:
             p.start()
+        if self.dispatcher is not None:
+            self.router = Thread(target=self.route, daemon=True)
+            self.router.start()
         for e in events:
             e.wait()
 
+    def route(self):
+        """Pass orders from the common queue (order_trades() and traffic()) to the Dispatcher. Runs in a thread of this
+        process only, so a single Scheduler keeps track of whose turn it is and what every trader holds."""
+        for order in iter(self.queue.get, None):
+            self.dispatcher.put(order)
+
     def order_trades(self, n, steps=1):
         for _ in range(n):
             self.queue.put(steps)
 
-    def kill_traders(self):
-        for _ in range(self.n_traders):
-            self.queue.put(0)
+    def kill_traders(self, wait=False):
+        """Stop all traders after the orders already queued. With `wait`, block until they exit."""
+        if self.router is not None:
+            self.queue.put(None)
+            self.router.join()
+            self.router = None
+        for q in self.queues:
+            q.put(0)
+        if wait:
+            summaries = []
+            for p in self.proc:
+                while p.is_alive():
+                    summaries += self.collect_profiles()
+                    p.join(0.1)
+            self.proc = []
+            if self.profiles is not None:
+                self.profile = profiler.merge(summaries + self.collect_profiles())
+
+    def collect_profiles(self):
+        # workers cannot exit before their profile is taken out of the queue
+        summaries = []
+        while self.profiles is not None and not self.profiles.empty():
+            summaries.append(self.profiles.get())
+        return summaries
+
+    def client_profile(self):
+        """Merged profile of all workers (see profiler.merge()), None before kill_traders(wait=True) or without `profile`."""
+        return self.profile
+
+    def traffic(self, profile, steps=1, seed=None):
+        """Start an open-loop load generator following `profile`. Replaces the one already running.
+        `steps` can be a dict {steps: weight} for a mix of path lengths (see make_traffic)."""
+        if self.traffic_maker is not None:
+            self.stop_traffic()
+        self.stop.clear()
+        self.traffic_maker = Process(target=make_traffic, args=(self.queue, profile, self.stop, steps, seed))
+        self.traffic_maker.start()
+        if self.observer is not None:
+            self.observer.offer(profile)
+
+    def pair_load(self, top=10):
+        """Per-pair load of the run so far (see PairLoad.summary()), None without `routing`."""
+        return self.load.summary(top) if self.load is not None else None
 
     def constant_traffic(self, tps):
-        self.tps.value = tps
-        if self.traffic_maker is None:
-            self.traffic_maker = Process(target=make_traffic, args=(self.queue, self.tps))
-            self.traffic_maker.start()
+        self.traffic(Constant(tps))
 
     def stop_traffic(self):
-        self.tps.value = -1
+        self.stop.set()
         self.traffic_maker.join()
         self.traffic_maker = None
 
 
-def worker(signal_queue, ready_event, dex, phrase, index, set_allowance):
-    trader = Trader(dex, f'{phrase}//{index}', report=False, change_port=(9944 + index % 4))
+def batches(signal_queue, size):
+    """Yield lists of orders from the queue until the terminating 0. Waits for the first order of a list, then adds
+    up to `size` - 1 orders which are already waiting, so batches grow only when traders fall behind."""
+    while True:
+        orders = [signal_queue.get()]
+        if orders[0] == 0:
+            return
+        while len(orders) < size:
+            try:
+                order = signal_queue.get_nowait()
+            except Empty:
+                break
+            if order == 0:
+                yield orders
+                return
+            orders.append(order)
+        yield orders
+
+
+def worker(signal_queue, ready_event, dex, keypair, index, set_allowance, cache_gas, ledger, reconcile_every, metrics_channel, endpoints,
+           batch, atomic, seed, load=None, profiles=None):
+    if seed is not None:
+        random.seed(seed + index)
+    prof = profiler.enable(f'trader {index}') if profiles is not None else None
+    gas_cache = GasCache() if cache_gas else None
+    metrics = MetricsSink(metrics_channel, index) if metrics_channel else None
+    trader = Trader(dex, keypair, report=False, gas_cache=gas_cache, ledger=ledger,
+                    reconcile_every=reconcile_every, metrics=metrics, endpoints=endpoints)
     if set_allowance:
-        trader.set_allowances()
-    trader.update_balances()
+        endpoints.submit(trader.chain, trader.addr(), trader.set_allowances)
+    endpoints.call(trader.chain, trader.update_balances)
     ready_event.set()
     ok, total = 0, 0
+    latencies = []
     print(f'Trader {index} ready\n', end='')
-    for step in iter(signal_queue.get, 0):
-        total += 1
+    for orders in batches(signal_queue, batch):
+        steps = [o.steps if isinstance(o, Order) else o for o in orders]
+        intended = [o.intended if isinstance(o, Order) else None for o in orders]
+        paths = [o.path if isinstance(o, Order) else None for o in orders]
+        total += len(orders)
         try:
-            result = trader.trade(max_path_len=step)
-            if result.is_success:
-                ok += 1
-        except WebSocketConnectionClosedException:
-            trader.chain.connect_websocket()
+            if len(orders) == 1:
+                result = endpoints.submit(trader.chain, trader.addr(), trader.trade, max_path_len=steps[0], intended=intended[0], path=paths[0])
+                ok += result is not None and result.is_success
+                if load is not None and paths[0] is not None:
+                    if result is None:
+                        load.skip(paths[0])
+                    else:
+                        load.record(paths[0], result.is_success)
+            else:
+                _, items = endpoints.submit(trader.chain, trader.addr(), trader.trade_batch, steps, atomic=atomic, intended=intended, paths=paths)
+                ok += sum(1 for item in items if item[2])
+                if load is not None:
+                    load.record_batch(paths, items)
+            latencies.extend(time() - t for t in intended if t is not None)
+        except CONNECTION_ERRORS as e:
+            if metrics:
+                for step, t in zip(steps, intended):
+                    metrics.record(t, path_len=step, error=error_class(exception=e))
         except SubstrateRequestException as e:
+            if metrics:
+                for step, t in zip(steps, intended):
+                    metrics.record(t, path_len=step, error=error_class(exception=e))
             msg = e.args[0]
             if msg['message'] == 'Invalid Transaction' and 'account balance too low' in msg['data']:
                 print(f'Trader {index} run out of money. Going fishing...\n', end='')
@@ -95,14 +242,16 @@ def worker(signal_queue, ready_event, dex, phrase, index, set_allowance):
             else:
                 raise
     print(f'Trader {index} succeeded in {ok}/{total} swaps\n', end='')
+    if metrics:
+        metrics.flush()
+    if latencies:
+        print(f'Trader {index} latency from intended send time: {latency_summary(latencies)}\n', end='')
+    if trader.ledger is not None:
+        trader.reconcile()
+    if gas_cache is not None:
+        print(f'Trader {index} gas cache: {gas_cache.stats()}\n', end='')
+    if prof is not None:
+        summary = prof.summary()
+        print(f'Trader {index} client profile:\n{profiler.report(summary)}\n', end='')
+        profiles.put(summary)
 
-
-def make_traffic(queue, tps):
-    while True:
-        begin = time()
-        n = tps.value
-        if n == -1:
-            return
-        for _ in range(n - queue.qsize()):
-            queue.put(1)
-        sleep(1 + begin - time())
@@ -0,0 +1,137 @@
+from contextlib import nullcontext
+from functools import wraps
+from sys import getallocatedblocks
+from time import perf_counter, process_time
+
+PROFILER = None
+NULL = nullcontext()
+
+
+class Stage:
+    """Context manager adding one call of a stage to its entry: [calls, wall time, CPU time, allocated blocks]."""
+    __slots__ = ('entry', 'wall', 'cpu', 'blocks')
+
+    def __init__(self, entry):
+        self.entry = entry
+
+    def __enter__(self):
+        self.blocks = getallocatedblocks()
+        self.cpu = process_time()
+        self.wall = perf_counter()
+
+    def __exit__(self, *exc):
+        entry = self.entry
+        entry[0] += 1
+        entry[1] += perf_counter() - self.wall
+        entry[2] += process_time() - self.cpu
+        entry[3] += getallocatedblocks() - self.blocks
+        return False
+
+
+class Profiler:
+    """Per-process profile of the client side of trading.
+
+    Instrumented code (call_contract(), build_contract_call(), send_batch(), GasCache, Trader.trade(),
+    Trader.trade_batch(), Trader.update_balances()) reports its stages through stage() of this module:
+        dry_run  - gas estimation (ContractInstance.read)
+        encode   - message data and Contracts::call (or Utility batch) composition
+        sign     - creating the signed extrinsic
+        rpc      - submission and waiting for inclusion
+        receipt  - fetching and decoding events of the receipt
+    Each stage gets the number of calls, wall time, CPU time (process_time) and the net number of memory blocks
+    allocated (sys.getallocatedblocks()). Times of outer stages (trade, update_balances) include the inner ones.
+    `busy` in summary() is the CPU time of the whole process divided by wall time since enable(). A worker close
+    to 1 is saturated: it cannot send faster, whatever the node does.
+    """
+    def __init__(self, name=None):
+        self.name = name
+        self.stages = {}
+        self.started = perf_counter()
+        self.started_cpu = process_time()
+
+    def stage(self, name):
+        entry = self.stages.get(name)
+        if entry is None:
+            entry = self.stages[name] = [0, 0.0, 0.0, 0]
+        return Stage(entry)
+
+    def summary(self):
+        wall = perf_counter() - self.started
+        cpu = process_time() - self.started_cpu
+        return {
+            'name': self.name,
+            'wall': wall,
+            'cpu': cpu,
+            'busy': cpu / wall if wall > 0 else 0.0,
+            'stages': {name: {'calls': n, 'wall': w, 'cpu': c, 'blocks': b} for name, (n, w, c, b) in self.stages.items()}
+        }
+
+
+def enable(name=None):
+    """Start profiling this process (replaces a profile already running). Return the Profiler."""
+    global PROFILER
+    PROFILER = Profiler(name)
+    return PROFILER
+
+
+def disable():
+    global PROFILER
+    PROFILER = None
+
+
+def current():
+    return PROFILER
+
+
+def stage(name):
+    """Context manager timing stage `name` of the current Profiler, a no-op when profiling is disabled."""
+    return NULL if PROFILER is None else PROFILER.stage(name)
+
+
+def profiled(name):
+    """Decorator timing every call of a function as stage `name` (when profiling is enabled)."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if PROFILER is None:
+                return fn(*args, **kwargs)
+            with PROFILER.stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def merge(summaries):
+    """Combine summary() dicts of several workers: stage counters are added up, `busy` becomes mean and max."""
+    stages = {}
+    for s in summaries:
+        for name, st in s['stages'].items():
+            total = stages.setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'blocks': 0})
+            for key in total:
+                total[key] += st[key]
+    busy = [s['busy'] for s in summaries]
+    return {
+        'workers': len(summaries),
+        'wall': max((s['wall'] for s in summaries), default=0.0),
+        'cpu': sum(s['cpu'] for s in summaries),
+        'busy_mean': sum(busy) / len(busy) if busy else 0.0,
+        'busy_max': max(busy, default=0.0),
+        'stages': stages
+    }
+
+
+def report(summary, saturated=0.9):
+    """Text table of a summary() or merge() result, with a warning if a worker was busy more than `saturated`."""
+    lines = [f'{"stage":16}{"calls":>10}{"wall ms/call":>14}{"cpu ms/call":>14}{"cpu/wall":>10}{"blocks/call":>13}']
+    for name, st in sorted(summary['stages'].items(), key=lambda item: -item[1]['wall']):
+        n = st['calls'] or 1
+        lines.append(f'{name:16}{st["calls"]:>10}{1000 * st["wall"] / n:>14.3f}{1000 * st["cpu"] / n:>14.3f}'
+                     f'{st["cpu"] / st["wall"] if st["wall"] else 0:>10.2f}{st["blocks"] / n:>13.1f}')
+    busy = summary['busy_max'] if 'busy_max' in summary else summary['busy']
+    if 'busy_mean' in summary:
+        lines.append(f'{summary["workers"]} workers, CPU busy {summary["busy_mean"]:.0%} on average, {busy:.0%} at most')
+    else:
+        lines.append(f'CPU busy {busy:.0%}')
+    if busy > saturated:
+        lines.append('WARNING: the client is CPU-bound, results may measure the load generator rather than the node')
+    return '\n'.join(lines)
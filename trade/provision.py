@@ -0,0 +1,177 @@
+from time import sleep
+from substrateinterface import Keypair
+
+from .dex import Reader
+from .pipeline import BlockWatcher, Pipeline
+from .trader import ALLOWANCE
+from .utils import AZERO, GasCache, batch_results, build_contract_call, call_gas, connect, derive_keypairs
+
+QUERY_CHUNK = 500
+
+
+class Provisioner:
+    """Prepares a large number of trader accounts: native funds and router allowances.
+
+    Only missing work is sent: balances are read first (System::Account with query_multi, in chunks of QUERY_CHUNK keys)
+    and allowances with PSP22::allowance dry-runs (spread over `workers` threads). Transfers are packed into Utility
+    batches sized to use at most `fill` of the per-extrinsic weight limit (System::BlockWeights), estimated with
+    get_payment_info, so a few batches fit in every block. Batches are spread over `stash_phrases` round-robin
+    and sent without waiting for inclusion, each stash account with its own Pipeline (and nonce).
+    Approvals must be signed by the traders themselves, so every trader sends its own batch, all of them pipelined.
+    Batches are not atomic, so balances and allowances are read again afterwards and whatever is still missing
+    is sent again (up to `rounds` times).
+    `dex` is needed only for approve().
+
+    Usage pattern:
+    p = Provisioner(dex.chain_url, ['//Alice', '//Bob'], dex)
+    p.fund(phrase, 5000, 100 * AZERO)
+    p.approve(phrase, 5000)
+    pool = TraderPool(dex, 5000, phrase)
+    pool.spawn_traders(False)
+    """
+    def __init__(self, chain_url, stash_phrases, dex=None, fill=0.25, workers=8, report=True, rounds=3):
+        self.dex = dex
+        self.chain = connect(chain_url)
+        self.stashes = [Keypair.create_from_uri(p) for p in stash_phrases]
+        self.fill = fill
+        self.workers = workers
+        self.report = report
+        self.rounds = rounds
+        self.gas_cache = GasCache()
+        self.watcher = None
+        limits = self.chain.get_constant('System', 'BlockWeights').value['per_class']['normal']
+        self.max_extrinsic = limits['max_extrinsic'] or limits['max_total']
+
+    def log(self, msg):
+        if self.report:
+            print(msg, end='')
+
+    def free_balances(self, addresses):
+        result = []
+        for i in range(0, len(addresses), QUERY_CHUNK):
+            keys = [self.chain.create_storage_key('System', 'Account', [a]) for a in addresses[i:i + QUERY_CHUNK]]
+            result += [value.value['data']['free'] for _, value in self.chain.query_multi(keys)]
+        return result
+
+    def chunk_size(self, make_call, keypair):
+        """Number of calls made by `make_call(i)` fitting in one batch, from payment info of batches with 1 and 2 calls."""
+        w1, w2 = (self.chain.get_payment_info(self.batch([make_call(i) for i in range(k)]), keypair)['weight'] for k in (1, 2))
+        sizes = []
+        for dim in ('ref_time', 'proof_size'):
+            per_call = max(1, w2[dim] - w1[dim])
+            sizes.append(int((self.fill * self.max_extrinsic[dim] - (w1[dim] - per_call)) // per_call))
+        return max(1, min(sizes))
+
+    def batch(self, calls):
+        return self.chain.compose_call(call_module='Utility', call_function='batch', call_params={'calls': calls})
+
+    def fund(self, trader_phrase, n_traders, balance, min_balance=None):
+        """Make sure accounts trader_phrase//0 ... //(n_traders-1) have at least `min_balance` (default: half of `balance`)
+        free native balance (in the smallest units). Accounts below that are topped up to `balance`.
+        Balances are read again after sending, accounts still missing funds (e.g. transfers of an interrupted batch)
+        are sent again, up to `rounds` times. Return the number of transfers executed."""
+        min_balance = balance // 2 if min_balance is None else min_balance
+        addresses = [kp.ss58_address for kp in derive_keypairs(trader_phrase, range(n_traders))]
+        funded = 0
+        for attempt in range(self.rounds + 1):
+            missing = [(a, balance - free) for a, free in zip(addresses, self.free_balances(addresses)) if free < min_balance]
+            self.log(f'{len(missing)} of {n_traders} accounts need funding\n')
+            if not missing or attempt == self.rounds:
+                break
+
+            def transfer(i):
+                dest, value = missing[i % len(missing)]
+                return self.chain.compose_call(call_module='Balances', call_function='transfer_keep_alive', call_params={'dest': dest, 'value': value})
+
+            size = self.chunk_size(transfer, self.stashes[0])
+            chunks = [[transfer(j) for j in range(i, min(i + size, len(missing)))] for i in range(0, len(missing), size)]
+            self.log(f'Sending {len(chunks)} batches of up to {size} transfers from {len(self.stashes)} stash accounts\n')
+            funded += self.run([(self.stashes[i % len(self.stashes)], c) for i, c in enumerate(chunks)])
+        return funded
+
+    def read_allowance(self, reader, item):
+        owner, token = item
+        contract = reader.contract(token, self.dex.psp22_metadata)
+        args = {'owner': owner, 'spender': self.dex.router_address}
+        return contract.read(reader.kp, method='PSP22::allowance', args=args).contract_result_data.value['Ok']
+
+    def approve(self, trader_phrase, n_traders, value=ALLOWANCE, min_allowance=None):
+        """Make sure every trader allows the router to spend at least `min_allowance` (default: half of `value`)
+        of each dex token. Missing approvals are set to `value`. Like in fund(), allowances are read again and
+        missing ones sent again, up to `rounds` times. Return the number of approve calls executed."""
+        min_allowance = value // 2 if min_allowance is None else min_allowance
+        keypairs = derive_keypairs(trader_phrase, range(n_traders))
+        tokens = [t for t in self.dex.tokens if t != self.dex.wnative_address]
+        items = [(kp.ss58_address, t) for kp in keypairs for t in tokens]
+        reader = Reader(self.chain)
+        limit = self.fill * self.max_extrinsic['ref_time']
+        approved = 0
+        for attempt in range(self.rounds + 1):
+            allowances = self.dex.map_reads(self.read_allowance, items, self.workers, self.chain)
+            missing = {}
+            for (owner, token), allowance in zip(items, allowances):
+                if allowance < min_allowance:
+                    missing.setdefault(owner, []).append(token)
+            self.log(f'{sum(len(t) for t in missing.values())} of {len(items)} allowances need approval\n')
+            if not missing or attempt == self.rounds:
+                break
+
+            jobs = []
+            for kp in keypairs:
+                calls = [build_contract_call(reader.contract(t, self.dex.psp22_metadata), kp, method='PSP22::approve',
+                                             args={'spender': self.dex.router_address, 'value': value}, gas_cache=self.gas_cache)
+                         for t in missing.get(kp.ss58_address, [])]
+                chunk, gas = [], 0
+                for call in calls:
+                    if chunk and gas + call_gas(call) > limit:
+                        jobs.append((kp, chunk))
+                        chunk, gas = [], 0
+                    chunk.append(call)
+                    gas += call_gas(call)
+                if chunk:
+                    jobs.append((kp, chunk))
+            approved += self.run(jobs)
+        return approved
+
+    def run(self, jobs):
+        """Send (keypair, calls) jobs, each as a Utility batch, through a Pipeline per keypair and wait until all are
+        included or failed. Return the number of calls executed (see batch_results(), an interrupted batch executes
+        only the calls before the failed one)."""
+        if not jobs:
+            return 0
+        if self.watcher is None:
+            self.watcher = BlockWatcher(self.chain.url)
+        pipelines = {}
+        for kp, calls in jobs:
+            if kp.ss58_address not in pipelines:
+                pipelines[kp.ss58_address] = Pipeline(self.chain, kp, self.watcher)
+            pipelines[kp.ss58_address].submit(self.batch(calls), tag=len(calls))
+        ok, executed = 0, 0
+        while any(p.pending for p in pipelines.values()):
+            sleep(0.5)
+            for p in pipelines.values():
+                for sub in p.collect():
+                    results = batch_results(sub.receipt, sub.tag) if sub.receipt is not None else [False] * sub.tag
+                    done = sum(1 for r in results if r)
+                    executed += done
+                    if done == sub.tag:
+                        ok += 1
+                        continue
+                    if sub.receipt is None:
+                        error = sub.error
+                    elif not sub.receipt.is_success:
+                        error = sub.receipt.error_message
+                    else:
+                        error = f'interrupted after {done} of {sub.tag} calls'
+                    self.log(f'Provisioning batch (nonce {sub.nonce}) FAILED: {error}\n')
+        self.log(f'{ok}/{len(jobs)} batches included, {executed}/{sum(len(c) for _, c in jobs)} calls executed\n')
+        return executed
+
+
+def fund_traders(chain_url, n_traders, balance, stash_phrase, trader_phrase):
+    """Send `balance` native coins from an account generated by `stash_phrase` to `n_traders` accounts generated by `trader_phrase`.
+    Funded accounts are: trader_phrase//0, trader_phrase//1, ... , trader_phrase//(n_traders-1)
+    Accounts already holding at least half of `balance` are skipped, others are topped up to `balance`.
+    Transfers are split into batches fitting block weight, see Provisioner (also for using several stash accounts).
+    """
+    return Provisioner(chain_url, [stash_phrase]).fund(trader_phrase, n_traders, balance * AZERO)
@@ -0,0 +1,134 @@
+import numpy as np
+
+from .utils import connect, contract_events
+
+
+def get_amount_out(amount_in, reserve_in, reserve_out):
+    """Output of a single swap in a Common pair (0.3% fee), exact integer arithmetic as on chain."""
+    return (amount_in * 997 * reserve_out) // (reserve_in * 1000 + amount_in * 997)
+
+
+class QuoteEngine:
+    """Off-chain quotes for multi-hop trades along paths of a Dex.
+
+    Keeps reserves of all pairs in dex.pairs (in the order of dex.pairs, reserve_0 belongs to the token with
+    the smaller address). Reserves are fetched with Pair::get_reserves reads (fetch_reserves(), or refresh() of
+    selected pairs on an existing connection) and can be kept up to date with Sync events found in trade receipts
+    (apply_events()). Receipts only show pairs touched by their own extrinsics, so swaps of other accounts are
+    seen only by reading reserves again.
+
+    quote() is exact and meant for setting `amount_out_min`. quote_batch() evaluates many (path, amount)
+    candidates at once in float64, which is precise enough for choosing paths and trade sizes
+    (balances of 10^24 do not fit into int64).
+    """
+    def __init__(self, dex):
+        self.dex = dex
+        self.pair_keys = list(dex.pairs)
+        self.pair_ids = {key: i for i, key in enumerate(self.pair_keys)}
+        self.by_address = {addr: i for i, addr in enumerate(dex.pairs.values())}
+        self.reserves = [(0, 0)] * len(self.pair_keys)
+        self.array = np.zeros((len(self.pair_keys), 2), dtype=np.float64)
+        self.pair_metadata = None
+        # edges of the token graph, for vectorized lookup of pairs along integer paths of dex.path_index
+        tokens = list(dex.tokens)
+        self.n_tokens = len(tokens)
+        self.token_ids = {t: i for i, t in enumerate(tokens)}
+        edges = sorted((self.token_ids[a] * self.n_tokens + self.token_ids[b], self.pair_ids[(a, b) if a < b else (b, a)], a < b)
+                       for a in tokens for b in dex.tokens[a])
+        self.edge_keys = np.array([e[0] for e in edges], dtype=np.int64)
+        self.edge_pairs = np.array([e[1] for e in edges], dtype=np.int64)
+        self.edge_forward = np.array([e[2] for e in edges], dtype=bool)
+
+    def set_reserves(self, pair_id, reserve_0, reserve_1):
+        self.reserves[pair_id] = (reserve_0, reserve_1)
+        self.array[pair_id] = (reserve_0, reserve_1)
+
+    def fetch_reserves(self, workers=1):
+        """Read reserves of all pairs from the chain (see Dex.fetch_info() for the meaning of `workers`)."""
+        chain = connect(self.dex.chain_url)
+        addresses = [self.dex.pairs[key] for key in self.pair_keys]
+        for i, reserves in enumerate(self.dex.map_reads(self.read_reserves, addresses, workers, chain)):
+            self.set_reserves(i, reserves[0], reserves[1])
+
+    def refresh(self, reader, path=None):
+        """Read reserves of pairs along `path` (all pairs if None) again with `reader` (a dex.Reader)."""
+        keys = self.pair_keys if path is None else [(a, b) if a < b else (b, a) for a, b in zip(path, path[1:])]
+        for key in keys:
+            reserves = self.read_reserves(reader, self.dex.pairs[key])
+            self.set_reserves(self.pair_ids[key], reserves[0], reserves[1])
+
+    def apply_events(self, receipt):
+        """Update reserves with Sync events emitted by pairs during the extrinsic. Return the number of updated pairs."""
+        if self.pair_metadata is None:
+            self.pair_metadata = receipt.substrate.contract_metadata(self.dex.pair_metadata)
+        n = 0
+        events = contract_events(receipt, lambda addr: self.pair_metadata if addr in self.by_address else None)
+        for address, name, args in events:
+            if name == 'Sync':
+                reserve_0, reserve_1 = list(args.values())[:2]
+                self.set_reserves(self.by_address[address], reserve_0, reserve_1)
+                n += 1
+        return n
+
+    def quote(self, path, amount):
+        """Exact output of swapping `amount` along `path` (list of token addresses), according to known reserves."""
+        for token_in, token_out in zip(path, path[1:]):
+            r0, r1 = self.reserves[self.pair_ids[(token_in, token_out) if token_in < token_out else (token_out, token_in)]]
+            amount = get_amount_out(amount, r0, r1) if token_in < token_out else get_amount_out(amount, r1, r0)
+        return amount
+
+    def apply_swap(self, path, amount):
+        """Simulate swapping `amount` along `path`: update reserves as the chain would, return the output."""
+        for token_in, token_out in zip(path, path[1:]):
+            pair_id = self.pair_ids[(token_in, token_out) if token_in < token_out else (token_out, token_in)]
+            r0, r1 = self.reserves[pair_id]
+            if token_in < token_out:
+                out = get_amount_out(amount, r0, r1)
+                self.set_reserves(pair_id, r0 + amount, r1 - out)
+            else:
+                out = get_amount_out(amount, r1, r0)
+                self.set_reserves(pair_id, r0 - out, r1 + amount)
+            amount = out
+        return amount
+
+    def amount_out_min(self, path, amount, slippage=0.01):
+        """Minimal acceptable output for a router swap, `slippage` below the current quote (but at least 1)."""
+        return max(1, int(self.quote(path, amount) * (1 - slippage)))
+
+    def quote_batch(self, paths, amounts):
+        """Outputs for a batch of trades. `paths` is an int array (n, length + 1) of token ids of dex.path_index,
+        `amounts` an array of n input amounts. Return a float64 array of n outputs."""
+        paths = np.asarray(paths, dtype=np.int64)
+        out = np.asarray(amounts, dtype=np.float64).copy()
+        for hop in range(paths.shape[1] - 1):
+            keys = paths[:, hop] * self.n_tokens + paths[:, hop + 1]
+            edges = np.searchsorted(self.edge_keys, keys)
+            pairs = self.edge_pairs[edges]
+            forward = self.edge_forward[edges]
+            reserve_in = np.where(forward, self.array[pairs, 0], self.array[pairs, 1])
+            reserve_out = np.where(forward, self.array[pairs, 1], self.array[pairs, 0])
+            out = (out * 997 * reserve_out) / (reserve_in * 1000 + out * 997)
+        return out
+
+    def best_amounts(self, paths, balances, fractions=None, max_impact=0.01):
+        """For each path choose the largest fraction of the balance (int array aligned with `paths`) whose price impact,
+        compared with the spot price, does not exceed `max_impact`. `fractions` to try default to 0.05, 0.10, ... 1.
+        Return a float64 array of amounts (0 if none fits, or for paths with no balance or an empty pair)."""
+        if fractions is None:
+            fractions = np.linspace(0.05, 1, 20)
+        paths = np.asarray(paths, dtype=np.int64)
+        balances = np.asarray(balances, dtype=np.float64)
+        tiny = np.maximum(balances * 1e-9, 1.0)
+        best = np.zeros(len(paths))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            spot = self.quote_batch(paths, tiny) / tiny
+            valid = (balances > 0) & (spot > 0)
+            for f in fractions:
+                amounts = balances * f
+                impact = 1 - self.quote_batch(paths, amounts) / (amounts * spot)
+                best = np.where(valid & (impact <= max_impact), amounts, best)
+        return best
+
+    def read_reserves(self, reader, pair_address):
+        pair = reader.contract(pair_address, self.dex.pair_metadata)
+        return pair.read(reader.kp, method='Pair::get_reserves').contract_result_data.value['Ok']
@@ -0,0 +1,170 @@
+import json
+import platform
+from os.path import join
+from time import sleep, time
+
+from . import mock
+from .dex import Dex
+from .endpoints import EndpointPool
+from .metrics import MetricsCollector
+from .observer import BlockObserver
+from .pool import TraderPool
+from .provision import Provisioner
+from .traffic import make_profile
+from .utils import AZERO, MOCK_SCHEME, check_file
+
+RESULTS_VERSION = 1
+
+DEFAULTS = {
+    'name': 'unnamed',
+    'chain_url': 'local',
+    'endpoints': None,
+    'common': './common-amm',
+    'traders': 10,
+    'phrase': '//Trader',
+    'stash': None,
+    'balance': 1000,
+    'set_allowance': True,
+    'path_mix': {'1': 1},
+    'profile': {'type': 'constant', 'rate': 5},
+    'duration': 60,
+    'drain': 10,
+    'seed': None,
+    'batch': 1,
+    'atomic': False,
+    'routing': None,
+    'skew': 1.0,
+    'client_profile': False,
+    'cache_gas': True,
+    'ledger': False,
+    'observe': True
+}
+
+# (key in results, path in summary, which direction is worse)
+COMPARED = [
+    ('throughput', ('metrics', 'throughput'), 'lower'),
+    ('achieved swaps/s', ('observer', 'achieved'), 'lower'),
+    ('saturation', ('observer', 'saturation'), 'lower'),
+    ('latency p50', ('metrics', 'histograms_us', 'latency', 'p50'), 'higher'),
+    ('latency p99', ('metrics', 'histograms_us', 'latency', 'p99'), 'higher'),
+    ('latency max', ('metrics', 'histograms_us', 'latency', 'max'), 'higher'),
+    ('error rate', ('error_rate',), 'higher'),
+    ('weight per swap', ('weight_per_swap',), 'higher'),
+]
+
+
+def load_scenario(path):
+    """Read a scenario file (JSON) and fill in defaults. Keys:
+        name, chain_url, endpoints (list of URLs or {url: weight}), common (path to common-amm), router,
+        traders, phrase, stash (phrase or list of phrases to fund traders from, None to skip), balance (coins per trader),
+        set_allowance, path_mix ({swaps: weight}), profile (see traffic.make_profile),
+        duration (seconds of traffic, profile may end earlier), drain (seconds to wait for pending trades),
+        seed, batch, atomic, routing, skew (see TraderPool), client_profile (profile the traders, see TraderPool),
+        cache_gas, ledger, observe (run a BlockObserver).
+    With a mock:// chain_url (see mock.py) the run is offline: router, common and stash are not needed,
+    the observer and finality tracking are disabled."""
+    with open(check_file(path), encoding='utf-8') as f:
+        scenario = dict(DEFAULTS, **json.load(f))
+    make_profile(scenario['profile'])
+    if scenario['chain_url'].startswith(MOCK_SCHEME):
+        scenario.update(router=mock.router_address(scenario['chain_url']), stash=None, observe=False)
+    if 'router' not in scenario:
+        raise ValueError(f'Scenario {path} does not specify the router address')
+    return scenario
+
+
+def run_scenario(scenario):
+    """Run a scenario (dict from load_scenario), return results as a JSON-serializable dict."""
+    offline = scenario['chain_url'].startswith(MOCK_SCHEME)
+    metadata_dir = join(scenario['common'], 'artifacts')
+    metadata_files = mock.METADATA if offline else {
+        'router': check_file(metadata_dir, 'router_contract.json'),
+        'factory': check_file(metadata_dir, 'factory_contract.json'),
+        'pair': check_file(metadata_dir, 'pair_contract.json'),
+        'psp22': check_file(metadata_dir, 'psp22.json')
+    }
+    endpoints = EndpointPool(scenario['endpoints'] or [scenario['chain_url']])
+    dex = Dex(scenario['chain_url'], scenario['router'], metadata_files, report=False)
+    dex.fetch_info(endpoints=endpoints)
+    dex.build_path_index(max(int(k) for k in scenario['path_mix']))
+
+    url = endpoints.urls[0]
+    if scenario['stash']:
+        stashes = scenario['stash'] if isinstance(scenario['stash'], list) else [scenario['stash']]
+        provisioner = Provisioner(url, stashes, dex)
+        provisioner.fund(scenario['phrase'], scenario['traders'], scenario['balance'] * AZERO)
+        if scenario['set_allowance']:
+            provisioner.approve(scenario['phrase'], scenario['traders'])
+    metrics = MetricsCollector(None if offline else url, interval=10)
+    observer = BlockObserver(dex, url, report=False) if scenario['observe'] else None
+    pool = TraderPool(dex, scenario['traders'], scenario['phrase'], cache_gas=scenario['cache_gas'], ledger=scenario['ledger'],
+                      metrics=metrics, observer=observer, endpoints=endpoints, batch=scenario['batch'],
+                      atomic=scenario['atomic'], seed=scenario['seed'], routing=scenario['routing'], skew=scenario['skew'],
+                      profile=scenario['client_profile'])
+    pool.spawn_traders(scenario['set_allowance'] and not scenario['stash'])
+
+    metrics.start()
+    if observer is not None:
+        observer.start()
+    started = time()
+    pool.traffic(make_profile(scenario['profile']), {int(k): w for k, w in scenario['path_mix'].items()}, scenario['seed'])
+    sleep(scenario['duration'])
+    pool.stop_traffic()
+    sleep(scenario['drain'])
+    pool.kill_traders(wait=True)
+    metrics.stop()
+    if observer is not None:
+        observer.stop()
+    return make_results(scenario, started, metrics, observer, pool.pair_load(), pool.client_profile())
+
+
+def make_results(scenario, started, metrics, observer, pair_load=None, client_profile=None):
+    summary = metrics.summary()
+    results = {
+        'version': RESULTS_VERSION,
+        'scenario': scenario,
+        'started': started,
+        'host': platform.node(),
+        'metrics': summary,
+        'observer': observer.summary() if observer is not None else None,
+        'pair_load': pair_load,
+        'client_profile': client_profile,
+        'error_rate': 1 - summary['succeeded'] / summary['trades'] if summary['trades'] else None,
+        'weight_per_swap': summary['weight'] / summary['succeeded'] if summary['succeeded'] else None
+    }
+    return json.loads(json.dumps(results))
+
+
+def save_results(results, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+
+
+def load_results(path):
+    with open(check_file(path), encoding='utf-8') as f:
+        results = json.load(f)
+    if results.get('version') != RESULTS_VERSION:
+        raise ValueError(f'Unsupported results version in {path}: {results.get("version")}')
+    return results
+
+
+def lookup(results, path):
+    for key in path:
+        if not isinstance(results, dict) or results.get(key) is None:
+            return None
+        results = results[key]
+    return results
+
+
+def compare_results(old, new, tolerance=0.05):
+    """Compare two result dicts. Return a list of (name, old, new, relative change, regression) for every
+    compared value present in both, where `regression` is True if `new` is worse than `old` by more than `tolerance`."""
+    rows = []
+    for name, path, worse in COMPARED:
+        a, b = lookup(old, path), lookup(new, path)
+        if a is None or b is None:
+            continue
+        change = (b - a) / a if a else (0.0 if b == a else float('inf'))
+        regression = change < -tolerance if worse == 'lower' else change > tolerance
+        rows.append((name, a, b, change, regression))
+    return rows
@@ -0,0 +1,224 @@
+import random
+from itertools import accumulate
+from multiprocessing import Array, Lock
+from time import time
+
+from .traffic import Order
+
+POLICIES = ('uniform', 'disjoint', 'hot')
+
+
+class Scheduler:
+    """Assigns orders to traders and chooses their paths, so that contention on Pair contracts is controlled.
+
+    Traders are served round-robin, the path of each order depends on `policy`:
+        uniform  - random path from a random token held by the trader
+        disjoint - pairs of dex.pairs are dealt to traders, and each trader trades only along its own pairs, so no two
+                   traders touch the same reserves. Every trader first gets a pair with wnative (traders beyond the number
+                   of such pairs get no orders), then the other pairs go one by one to the trader with the fewest pairs
+                   among those already having one of their tokens, so the pairs of every trader are reachable from native
+                   coin. Pairs not connected to wnative at all are not used. Token contracts are still shared, but every
+                   account has its own balance entry.
+        hot      - the first hop goes through a pair drawn from a Zipf distribution over dex.pairs (the k-th pair,
+                   counting from 0, has weight 1 / (k + 1)^`skew`), so a few pairs take most of the load
+    Paths have at most `steps` swaps (fewer if the graph does not allow more) and start from a token the trader holds.
+    Holdings are not read from the chain: every trader starts with native coin only (wnative), and the last token
+    of each path routed to it is added to its holdings. When no allowed path starts from a held token, the order is
+    a funding hop instead: the shortest path from a held token to a token the order was meant to trade (under
+    `disjoint` this never happens, the wnative pair of a trader is always usable).
+    A trader still reverses a path when it only holds the other end, and skips it if it holds neither (see Trader.trade()).
+    """
+    def __init__(self, dex, n_traders, policy='uniform', skew=1.0, seed=None):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown routing policy: {policy} (expected one of {", ".join(POLICIES)})')
+        self.dex = dex
+        self.policy = policy
+        self.rng = random.Random(seed)
+        self.pairs = list(dex.pairs)
+        self.n_traders = n_traders
+        self.turn = 0
+        if policy == 'disjoint':
+            shares = self.deal(n_traders)
+            if not shares:
+                raise ValueError('Routing policy disjoint needs pairs with wnative, there are none')
+            self.n_traders = len(shares)
+            self.owned = []
+            for pairs in shares:
+                neighbours = {}
+                for a, b in pairs:
+                    neighbours.setdefault(a, []).append(b)
+                    neighbours.setdefault(b, []).append(a)
+                self.owned.append((pairs, neighbours))
+        if policy == 'hot':
+            self.cum_weights = list(accumulate(1 / (k + 1) ** skew for k in range(len(self.pairs))))
+        self.held = [[dex.wnative_address] for _ in range(self.n_traders)]
+
+    def deal(self, n_traders):
+        """Pairs of each trader under `disjoint` (see above)."""
+        wnative = self.dex.wnative_address
+        first = [pair for pair in self.pairs if wnative in pair]
+        shares = [[pair] for pair in first[:n_traders]]
+        tokens = [set(pairs[0]) for pairs in shares]
+        rest = first[n_traders:] + [pair for pair in self.pairs if wnative not in pair]
+        while rest:
+            left = []
+            for pair in rest:
+                owners = [i for i, t in enumerate(tokens) if pair[0] in t or pair[1] in t]
+                if not owners:
+                    left.append(pair)
+                    continue
+                i = min(owners, key=lambda i: len(shares[i]))
+                shares[i].append(pair)
+                tokens[i].update(pair)
+            if len(left) == len(rest):
+                break
+            rest = left
+        return shares
+
+    def route(self, steps=1):
+        """Return (trader index, path) for the next order of at most `steps` swaps."""
+        trader = self.turn
+        self.turn = (self.turn + 1) % self.n_traders
+        held = self.held[trader]
+        if self.policy == 'uniform':
+            path = self.walk([self.rng.choice(held)], steps, self.dex.tokens)
+        elif self.policy == 'hot':
+            pair = self.rng.choices(self.pairs, cum_weights=self.cum_weights)[0]
+            path = self.start([pair], held, steps, self.dex.tokens)
+        else:
+            pairs, neighbours = self.owned[trader]
+            path = self.start(pairs, held, steps, neighbours)
+        if path[-1] not in held:
+            held.append(path[-1])
+        return trader, path
+
+    def start(self, pairs, held, steps, neighbours):
+        """Path of at most `steps` swaps, the first through one of `pairs` from its held end, continued along `neighbours`.
+        If no pair has a held end, the funding hop to the nearest token of `pairs` instead."""
+        usable = [pair for pair in pairs if pair[0] in held or pair[1] in held]
+        if not usable:
+            targets = {t for pair in pairs for t in pair}
+            return self.funding_path(held, targets, neighbours) or self.rng.sample(self.rng.choice(pairs), 2)
+        a, b = self.rng.sample(self.rng.choice(usable), 2)
+        return self.walk([a, b] if a in held else [b, a], steps - 1, neighbours)
+
+    def funding_path(self, held, targets, neighbours):
+        """Shortest path along `neighbours` from a token in `held` to one in `targets`, None if there is none."""
+        previous = {t: None for t in held}
+        frontier = list(held)
+        while frontier:
+            reached = []
+            for t in frontier:
+                if t in targets:
+                    path = [t]
+                    while previous[path[-1]] is not None:
+                        path.append(previous[path[-1]])
+                    return path[::-1]
+                for n in neighbours.get(t, []):
+                    if n not in previous:
+                        previous[n] = t
+                        reached.append(n)
+            frontier = reached
+        return None
+
+    def walk(self, path, steps, neighbours):
+        """Extend `path` by up to `steps` random hops along `neighbours` ({token: adjacent tokens}), never revisiting a token."""
+        for _ in range(steps):
+            candidates = [t for t in neighbours.get(path[-1], []) if t not in path]
+            if not candidates:
+                break
+            path.append(self.rng.choice(candidates))
+        return path
+
+
+class PairLoad:
+    """Per-pair counters shared by all processes of a TraderPool: orders offered by the scheduler, orders skipped
+    by traders (no balance at either end of the path) and swaps executed by traders, with the number of failed ones
+    (a swap counts once for every pair on its path)."""
+    def __init__(self, dex):
+        self.pairs = list(dex.pairs)
+        self.ids = {key: i for i, key in enumerate(self.pairs)}
+        self.symbols = {addr: dex.token_symbols.get(addr, addr[:8]) for addr in dex.tokens}
+        self.lock = Lock()
+        self.offered = Array('l', len(self.pairs), lock=False)
+        self.executed = Array('l', len(self.pairs), lock=False)
+        self.failed = Array('l', len(self.pairs), lock=False)
+        self.skipped = Array('l', len(self.pairs), lock=False)
+
+    def pair_ids(self, path):
+        return [self.ids[(a, b) if a < b else (b, a)] for a, b in zip(path, path[1:])]
+
+    def offer(self, path):
+        with self.lock:
+            for i in self.pair_ids(path):
+                self.offered[i] += 1
+
+    def record(self, path, ok):
+        """Count a swap along `path`. `ok` is the outcome like in Trader.trade_batch() items (None: not executed)."""
+        if ok is None:
+            return
+        with self.lock:
+            for i in self.pair_ids(path):
+                self.executed[i] += 1
+                self.failed[i] += not ok
+
+    def skip(self, path):
+        with self.lock:
+            for i in self.pair_ids(path):
+                self.skipped[i] += 1
+
+    def record_batch(self, paths, items):
+        """Count swaps of Trader.trade_batch() `items` and, as skipped, the given `paths` (None entries: picked
+        by the trader) which were left out of the batch."""
+        sent = [path for path, _, _, _ in items]
+        for path in paths:
+            if path is None:
+                continue
+            match = next((i for i, p in enumerate(sent) if p in (path, path[::-1])), None)
+            if match is None:
+                self.skip(path)
+            else:
+                del sent[match]
+        for path, _, ok, _ in items:
+            self.record(path, ok)
+
+    def summary(self, top=10):
+        """Dict with the number of pairs which got any swap, the share of swaps taken by the busiest pair,
+        the number of skipped orders (counted per pair too) and the `top` busiest pairs (all of them if None)
+        with their counters."""
+        with self.lock:
+            rows = [(self.executed[i], self.failed[i], self.offered[i], self.skipped[i], i) for i in range(len(self.pairs))]
+        total = sum(r[0] for r in rows)
+        rows.sort(reverse=True)
+        return {
+            'pairs': len(self.pairs),
+            'active_pairs': sum(1 for r in rows if r[0]),
+            'swaps': total,
+            'max_share': rows[0][0] / total if total else 0.0,
+            'skipped': sum(r[3] for r in rows),
+            'busiest': [{
+                'pair': '/'.join(self.symbols[t] for t in self.pairs[i]),
+                'offered': offered,
+                'executed': executed,
+                'failed': failed,
+                'skipped': skipped
+            } for executed, failed, offered, skipped, i in rows[:top]]
+        }
+
+
+class Dispatcher:
+    """Queue-like front of per-trader queues: put() routes an order with the Scheduler and passes it, with its path,
+    to the queue of the chosen trader. The Scheduler keeps its state in the process calling put(), so all orders must be
+    routed in one process (TraderPool does it in a thread reading its common queue, see TraderPool.route())."""
+    def __init__(self, queues, scheduler, load=None):
+        self.queues = queues
+        self.scheduler = scheduler
+        self.load = load
+
+    def put(self, order):
+        if not isinstance(order, Order):
+            order = Order(order, None, time())
+        trader, path = self.scheduler.route(order.steps)
+        if self.load is not None:
+            self.load.offer(path)
+        self.queues[trader].put(order._replace(path=path))
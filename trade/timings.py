@@ -0,0 +1,149 @@
+import os
+import re
+from collections import deque, namedtuple
+from time import sleep, time
+
+TIMER_REGEXP = re.compile(r'call.*Ok.(\d+)')
+SESSION_REGEXP = re.compile(r'Starting consensus session')
+PUSHED_REGEXP = re.compile(r'\[(0x[0-9a-f…\.]+)\] Pushed to the block')
+PREPARED_REGEXP = re.compile(r'Prepared block for proposing at (\d+) .*\[hash: (0x[0-9a-f…\.]+).*extrinsics \(\d+\): \[([^\]]*)\]')
+IMPORTED_REGEXP = re.compile(r'Imported #(\d+) \((0x[0-9a-f…\.]+)\)')
+
+
+class Timing(namedtuple('Timing', ['start', 'end', 'block', 'block_hash', 'extrinsic'])):
+    """Single start/end pair of node timers, attributed to a block. `extrinsic` is None for pairs of imported
+    blocks, for which the node does not log extrinsic hashes."""
+
+    @property
+    def walltime(self):
+        return self.end - self.start
+
+
+def same_hash(a, b):
+    """Compare two hashes, any of which can be abbreviated by the node logger (0x1234…abcd)."""
+    if a is None or b is None:
+        return False
+    if a == b:
+        return True
+    for sep in ('…', '...'):
+        if sep in a:
+            head, tail = a.split(sep)
+            return b.startswith(head) and b.endswith(tail)
+        if sep in b:
+            return same_hash(b, a)
+    return False
+
+
+class TimingCollector:
+    """Incremental parser of the log of a node with timers.
+
+    Keeps the offset within the log file and on each poll() parses only bytes appended since the previous one,
+    so the cost of a single poll does not depend on the size of the log. Node timers come in start/end pairs.
+
+    Timer lines carry no thread or extrinsic, and the node runs RPC calls (e.g. dry-runs issued by many TraderPool
+    workers) and block authoring on the same pool of threads, so entries of concurrent calls interleave. Pairs are
+    therefore matched with extrinsics by the authoring log: the block builder applies extrinsics one at a time and
+    logs '[hash] Pushed to the block' after each of them (target basic-authorship at trace level, run the node with
+    -lbasic-authorship=trace). The timer entries logged since the previous such line (or since 'Starting consensus
+    session') belong to that extrinsic, if there are exactly two of them. Any other number means that another call
+    ran meanwhile (or that the extrinsic is not a single contract call) and the extrinsic gets no timing rather
+    than a wrong one. Pairs are held back until 'Prepared block for proposing' lists their extrinsics and gives
+    the block. Without the trace lines no authored extrinsic is timed.
+
+    Blocks authored by other nodes are re-executed on import: entries logged before 'Imported #N' are paired
+    consecutively and attributed to the block only. Calls served meanwhile end up there too, so keep dry-runs
+    out (e.g. with a GasCache) when timing imported blocks.
+
+    Usage pattern:
+    c = TimingCollector('node.log')       # starts at the end of the existing log
+    receipt = trader.trade(1)
+    t = c.wait_for(receipt.extrinsic_hash)
+    print(t.walltime)
+    """
+    def __init__(self, logfile, from_end=True, keep=100000):
+        self.logfile = logfile
+        self.offset = os.path.getsize(logfile) if from_end else 0
+        self.rest = b''
+        self.entries = []
+        self.pushed = []
+        self.prepared = None
+        self.timings = deque(maxlen=keep)
+
+    def poll(self):
+        """Parse lines appended to the log since last call and return the list of newly attributed pairs."""
+        size = os.path.getsize(self.logfile)
+        if size < self.offset:
+            self.offset, self.rest, self.entries, self.pushed = 0, b'', [], []
+        if size == self.offset:
+            return []
+        with open(self.logfile, 'rb') as f:
+            f.seek(self.offset)
+            data = self.rest + f.read(size - self.offset)
+        self.offset = size
+        lines = data.split(b'\n')
+        self.rest = lines.pop()
+        result = []
+        for line in lines:
+            self.parse_line(line.decode('utf-8', errors='replace'), result)
+        self.timings.extend(result)
+        return result
+
+    def parse_line(self, line, result):
+        m = TIMER_REGEXP.search(line)
+        if m:
+            self.entries.append(int(m.group(1)))
+            return
+        m = PUSHED_REGEXP.search(line)
+        if m:
+            if len(self.entries) == 2 and self.entries[0] <= self.entries[1]:
+                self.pushed.append(Timing(*self.entries, None, None, m.group(1)))
+            self.entries = []
+            return
+        if SESSION_REGEXP.search(line):
+            self.entries, self.pushed = [], []
+            return
+        m = PREPARED_REGEXP.search(line)
+        if m:
+            extrinsics = [x.strip() for x in m.group(3).split(',') if x.strip()]
+            self.prepared = m.group(2)
+            self.attribute(int(m.group(1)), m.group(2), extrinsics, result)
+            return
+        m = IMPORTED_REGEXP.search(line)
+        if m:
+            self.attribute(int(m.group(1)), m.group(2), None, result)
+
+    def attribute(self, block, block_hash, extrinsics, result):
+        """Attribute pushed pairs listed in `extrinsics` to the block, or (None for an imported block) all pairs
+        of the entries logged since the previous block. Blocks authored here are imported without re-execution,
+        so nothing is attributed to them on import."""
+        entries, self.entries = self.entries, []
+        if extrinsics is not None:
+            pushed, self.pushed = self.pushed, []
+            result.extend(t._replace(block=block, block_hash=block_hash) for t in pushed
+                          if any(same_hash(t.extrinsic, ext) for ext in extrinsics))
+            return
+        if same_hash(block_hash, self.prepared) or len(entries) % 2:
+            return
+        pairs = list(zip(entries[::2], entries[1::2]))
+        if all(start <= end for start, end in pairs):
+            result.extend(Timing(start, end, block, block_hash, None) for start, end in pairs)
+
+    def follow(self, interval=0.1):
+        """Generator yielding attributed pairs as they appear in the log. Runs forever."""
+        while True:
+            yield from self.poll()
+            sleep(interval)
+
+    def find(self, extrinsic_hash=None, block_hash=None):
+        """Return all collected pairs attributed to a given extrinsic or block."""
+        return [t for t in list(self.timings) if same_hash(t.extrinsic, extrinsic_hash) or same_hash(t.block_hash, block_hash)]
+
+    def wait_for(self, extrinsic_hash, timeout=10, interval=0.05):
+        """Poll the log until the pair attributed to `extrinsic_hash` shows up. Return None on timeout."""
+        deadline = time() + timeout
+        while True:
+            self.poll()
+            found = self.find(extrinsic_hash=extrinsic_hash)
+            if found or time() > deadline:
+                return found[-1] if found else None
+            sleep(interval)
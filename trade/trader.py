@@ -1,40 +1,81 @@
 import random
-from substrateinterface import Keypair, SubstrateInterface, ContractInstance
+from time import time
+from substrateinterface import Keypair
 from substrateinterface.exceptions import ContractReadFailedException
 
-from .utils import build_contract_call, call_contract, check_url, fee, weight, send_batch, send_single_call
+from .dex import Reader
+from .ledger import NATIVE, Ledger
+from .pipeline import BlockWatcher, Pipeline
+from .metrics import error_class
+from .profiler import profiled
+from .quote import get_amount_out
+from .utils import (TIME_UNIT, batch_results, build_contract_call, call_contract, call_gas, check_url, connect, fee, out_of_gas,
+                    send_batch, weight)
 
 FOREVER = 10**18
 ALLOWANCE = 10**24
-NATIVE = 'AZERO'
 
 
 class Trader:
     """Class for sending trade transactions to the router of Common dex.
 
-    Uses on-chain account associated with `phrase`. The account must be funded with some coins to cover fees.
+    Uses on-chain account associated with `phrase` (or the given Keypair, e.g. from derive_keypairs()).
+    The account must be funded with some coins to cover fees. Contract handles are created on first use.
     Extracts all needed information (chain URL, router address, token addresses) from supplied Dex instance.
     Keeps track of balances of all dex tokens. Trades along a random path of PSP22 contracts (connected by Pairs)
-    of a given length. Uses only swap methods with exact input and and does not care about the slippage
-    (will accept any positive amount of output tokens).
+    of a given length. Uses only swap methods with exact input. Without a QuoteEngine (`quotes`) it does not care
+    about the slippage (will accept any positive amount of output tokens). With it, `amount_out_min` is set
+    `slippage` below the local quote and reserves are updated from Sync events of successful trades. Those cover
+    only own trades, so reserves of the pairs along the path are read from the chain before every
+    `refresh_quotes`-th trade (None: never, the quotes then drift as other accounts trade).
 
     Trades are performed via single router call, no batching with `approve` transactions. Because of that,
     dex token contracts must be approved beforehand (by calling set_allowances()).
+    trade_batch() packs several independent swaps into one Utility batch extrinsic instead.
+
+    With `pipeline=True` trade() does not wait for inclusion: it signs the call with a locally tracked nonce,
+    sends it and returns a Submission. Results must be picked up with collect(). Amounts of pending trades
+    are reserved in local balances, so consecutive trades do not spend the same tokens twice.
+    A BlockWatcher can be shared between traders living in the same process.
+
+    If `gas_cache` (a GasCache instance) is supplied, gas estimates are reused instead of doing a dry-run
+    before every call.
+
+    With `ledger=True` balances are not read from the chain after each trade, but derived from events of its
+    receipt (see Ledger). Every `reconcile_every` trades (if set) they are compared with on-chain balances
+    and the drift is reported.
+
+    If `metrics` (a MetricsSink) is supplied, every trade is recorded there (see metrics.py).
+
+    With `endpoints` (an EndpointPool) the connection goes to the least loaded healthy node of the pool
+    instead of `dex.chain_url`. Wrap calls with endpoints.call() (endpoints.submit() for those sending
+    extrinsics) to survive a node going down.
     """
-    def __init__(self, dex, phrase, report=True, change_port=None):
-        self.kp = Keypair.create_from_uri(phrase)
+    def __init__(self, dex, phrase, report=True, change_port=None, pipeline=False, watcher=None, gas_cache=None,
+                 quotes=None, slippage=0.01, ledger=False, reconcile_every=None, metrics=None, endpoints=None, refresh_quotes=10):
+        self.kp = phrase if isinstance(phrase, Keypair) else Keypair.create_from_uri(phrase)
         self.dex = dex
-        url = check_url(dex.chain_url)
-        if change_port:
-            url = url.rsplit(':', 1)[0] + f':{change_port}'
-        self.chain = SubstrateInterface(url=url)
-        self.router = ContractInstance.create_from_address(dex.router_address, dex.router_metadata, self.chain)
+        if endpoints is not None:
+            self.chain = endpoints.connect()
+            url = self.chain.url
+        else:
+            url = check_url(dex.chain_url)
+            if change_port:
+                url = url.rsplit(':', 1)[0] + f':{change_port}'
+            self.chain = connect(url)
+        self.reader = Reader(self.chain, self.kp)
         self.report = report
+        self.gas_cache = gas_cache
+        self.quotes = quotes
+        self.slippage = slippage
+        self.refresh_quotes = refresh_quotes
+        self.quoted = 0
         self.balances = {NATIVE: 0}
-        self.tokens = {}
-        for t in dex.tokens:
-            self.balances[t] = 0
-            self.tokens[t] = ContractInstance.create_from_address(t, dex.psp22_metadata, self.chain)
+        self.balances.update({t: 0 for t in dex.tokens})
+        self.pipeline = Pipeline(self.chain, self.kp, watcher or BlockWatcher(url)) if pipeline else None
+        self.ledger = Ledger(self.addr(), dex, self.balances) if ledger else None
+        self.reconcile_every = reconcile_every
+        self.metrics = metrics
 
     def log(self, msg):
         if self.report:
@@ -43,72 +84,251 @@ class Trader:
     def addr(self):
         return self.kp.ss58_address
 
+    @property
+    def router(self):
+        return self.reader.contract(self.dex.router_address, self.dex.router_metadata)
+
+    def token(self, address):
+        return self.reader.contract(address, self.dex.psp22_metadata)
+
     def symbol(self, addr):
         return self.dex.token_symbols[addr] if addr != self.dex.wnative_address else 'A_0'
 
-    def update_balances(self, tokens=None):
-        balance = self.chain.query('System', 'Account', [self.addr()]).value['data']['free']
-        self.balances[NATIVE] = balance
-        tokens = tokens or list(self.tokens.keys())
+    def read_balances(self, tokens=None):
+        balances = {NATIVE: self.chain.query('System', 'Account', [self.addr()]).value['data']['free']}
+        tokens = tokens or list(self.dex.tokens)
         for t in tokens:
             try:
-                self.balances[t] = self.tokens[t].read(self.kp, method='PSP22::balance_of', args={'owner': self.addr()}).contract_result_data.value['Ok']
+                balances[t] = self.token(t).read(self.kp, method='PSP22::balance_of', args={'owner': self.addr()}).contract_result_data.value['Ok']
             except ContractReadFailedException:
                 self.log(f'Fetching balance of {self.symbol(t)} FAILED\n')
+        return balances
+
+    @profiled('update_balances')
+    def update_balances(self, tokens=None):
+        self.balances.update(self.read_balances(tokens))
+
+    def reconcile(self):
+        """Compare the ledger with on-chain balances of all tokens and fix it. Return the drift.
+        Amounts reserved for pending trades are added back first, so in-flight trades are not reported as drift."""
+        for key, amount in self.pending_amounts().items():
+            self.balances[key] += amount
+        drift = self.ledger.reconcile(self.read_balances())
+        self.reserve_pending()
+        if drift:
+            print(f'Trader {self.addr()} ledger drift: { {self.dex.token_symbols.get(t, NATIVE): d for t, d in drift.items()} }\n', end='')
+        return drift
+
+    def account(self, receipts, tokens):
+        """Bring balances up to date after own extrinsics: from their events if a Ledger is used,
+        otherwise by reading balances of `tokens` from the chain (only if any extrinsic succeeded)."""
+        if self.ledger is None:
+            if any(r.is_success for r in receipts):
+                self.update_balances(tokens)
+                self.reserve_pending([NATIVE] + (tokens or list(self.dex.tokens)))
+            return
+        for r in receipts:
+            self.ledger.apply(r)
+            if self.reconcile_every and self.ledger.applied % self.reconcile_every == 0:
+                self.reconcile()
+
+    def pending_amounts(self):
+        """Amounts of pipelined trades not collected yet, per balance key."""
+        amounts = {}
+        if self.pipeline is not None:
+            for sub in self.pipeline.pending.values():
+                path, amount = sub.tag
+                key = self.balance_key(path[0])
+                amounts[key] = amounts.get(key, 0) + amount
+        return amounts
+
+    def reserve_pending(self, refreshed=None):
+        """Subtract amounts of pending trades from balances just read from the chain (keys in `refreshed`, default all).
+        Other balances hold the reservations made when the trades were sent."""
+        for key, amount in self.pending_amounts().items():
+            if refreshed is None or key in refreshed:
+                self.balances[key] -= amount
 
     def show_balances(self):
         for t in self.balances:
             s = self.dex.token_symbols.get(t, NATIVE)
             self.log(f'{s}\t\t{self.balances[t]}\n')
 
-    def set_allowances(self, value=ALLOWANCE, tokens=None):
+    def read_allowance(self, token):
+        args = {'owner': self.addr(), 'spender': self.router.contract_address}
+        return self.token(token).read(self.kp, method='PSP22::allowance', args=args).contract_result_data.value['Ok']
+
+    def set_allowances(self, value=ALLOWANCE, tokens=None, min_allowance=None):
+        """Approve the router to spend `value` of each token, skipping tokens for which the current allowance
+        is at least `min_allowance` (default: half of `value`)."""
         tokens = tokens or list(self.dex.tokens.keys())
+        min_allowance = value // 2 if min_allowance is None else min_allowance
         router = self.router.contract_address
         calls = []
         for t in tokens:
-            if t != self.dex.wnative_address:
-                call = build_contract_call(self.tokens[t], self.kp, method='PSP22::approve', args={'spender': router, 'value': value})
+            if t != self.dex.wnative_address and self.read_allowance(t) < min_allowance:
+                call = build_contract_call(self.token(t), self.kp, method='PSP22::approve', args={'spender': router, 'value': value}, gas_cache=self.gas_cache)
                 calls.append(call)
+        if not calls:
+            return
         receipt = send_batch(calls, self.chain, self.kp)
         if not receipt.is_success:
             print(f'Error in batch transfer: {receipt.error_message["docs"]}')
 
-    def trade(self, max_path_len=2, minimal_balance=1000000):
-        candidates = [t for t in self.balances if self.balances[t] >= minimal_balance and t != self.dex.wnative_address]
-        start = random.choice(candidates)
-        if start == NATIVE:
-            start = self.dex.wnative_address
-        path = self.dex.random_path(start, max_path_len)
-        if path[0] == self.dex.wnative_address:
-            balance = self.balances[NATIVE]
-            amount = random.randint(int(0.0001 * balance), int(0.01 * balance))
+    @profiled('trade')
+    def trade(self, max_path_len=2, minimal_balance=1000000, intended=None, path=None):
+        """Trade along a random path of at most `max_path_len` swaps, or along `path` (list of token addresses, e.g. chosen
+        by a Scheduler), reversed if only its last token is held. `intended` is the time the trade was scheduled for
+        by a load generator (only used for metrics). Return None, without sending anything, if neither end
+        of `path` is held."""
+        if path is None:
+            path, amount = pick_trade(self.dex, self.balances, max_path_len, minimal_balance)
         else:
-            balance = self.balances[path[0]]
-            amount = random.randint(int(0.2 * balance), int(0.6 * balance))
+            given, path = path, orient_path(self.dex, self.balances, path, minimal_balance)
+            if path is None:
+                self.log('Trade skipped, no balance at either end of the path\n')
+                if self.metrics is not None:
+                    self.metrics.record(intended, path_len=len(given) - 1, error='NoBalance')
+                return None
+            amount = pick_amount(self.dex, self.balances, path)
         self.log(f'Trade {"->".join(list(map(self.symbol,path)))}  ')
+        self.refresh_reserves(path)
 
-        if path[0] == self.dex.wnative_address:
-            receipt = self.trade_native_for_token(path, amount)
-        else:
-            receipt = self.trade_tokens(path, amount)
+        if self.pipeline:
+            call = build_contract_call(self.router, self.kp, *self.swap_args(path, amount), gas_cache=self.gas_cache)
+            sub = self.pipeline.submit(call, tag=(path, amount))
+            sub.intended = intended
+            self.balances[self.balance_key(path[0])] -= amount
+            self.log(f'nonce {sub.nonce}\n')
+            return sub
+
+        submitted = time()
+        receipt = self.swap(path, amount)
+        if self.metrics is not None:
+            self.metrics.record_receipt(receipt, submitted, time(), len(path) - 1, intended)
 
         if receipt.is_success:
             if self.report:
                 block = receipt.get_extrinsic_identifier().split('-')[0]
                 self.log(f'weight {weight(receipt):.1f}  fee {fee(receipt):.5f}  block {block}\n')
-            self.update_balances([path[0], path[-1]])
+            if self.quotes is not None:
+                self.quotes.apply_events(receipt)
         else:
             self.log('FAILED\n')
+        self.account([receipt], [path[0], path[-1]])
         return receipt
 
-    def trade_native_for_token(self, path, amount):
-        args = {'path': path, 'amount_out_min': 1, 'to': self.addr(), 'deadline': FOREVER}
-        return call_contract(self.router, self.kp, method='Router::swap_exact_native_for_tokens', args=args, value=amount)
+    @profiled('trade_batch')
+    def trade_batch(self, steps, minimal_balance=1000000, atomic=False, intended=None, paths=None):
+        """Send one Utility::batch (batch_all if `atomic`) extrinsic with a swap for every entry of `steps`
+        (max path length of each swap). `intended` is an optional list of scheduled times, like in trade(),
+        `paths` an optional list of given paths (None entries are picked randomly). Swaps along given paths
+        with no balance at either end are left out of the batch. Return the receipt (None if nothing was sent)
+        and a list of (path, amount, success, weight) per sent swap, where `success` is None for swaps
+        not executed and `weight` is the swap's share of the extrinsic weight, apportioned by gas limits.
+        Not available in pipeline mode."""
+        swaps, kept = [], []
+        for i, max_path_len in enumerate(steps):
+            path = paths[i] if paths else None
+            if path is None:
+                path, amount = pick_trade(self.dex, self.balances, max_path_len, minimal_balance)
+            else:
+                path = orient_path(self.dex, self.balances, path, minimal_balance)
+                if path is None:
+                    if self.metrics is not None:
+                        self.metrics.record(intended[i] if intended else None, path_len=len(paths[i]) - 1, error='NoBalance')
+                    continue
+                amount = pick_amount(self.dex, self.balances, path)
+            self.balances[self.balance_key(path[0])] -= amount
+            swaps.append((path, amount))
+            self.refresh_reserves(path)
+            kept.append(i)
+        for path, amount in swaps:
+            self.balances[self.balance_key(path[0])] += amount
+        if not swaps:
+            self.log('Batch skipped, no balance for any of its paths\n')
+            return None, []
+        intended = [intended[i] for i in kept] if intended else None
+        calls = [build_contract_call(self.router, self.kp, *self.swap_args(path, amount), gas_cache=self.gas_cache) for path, amount in swaps]
+        gas = [call_gas(c) for c in calls]
+
+        submitted = time()
+        receipt = send_batch(calls, self.chain, self.kp, atomic=atomic)
+        in_block = time()
+        results = batch_results(receipt, len(calls))
+        executed = sum(g for g, ok in zip(gas, results) if ok is not None) or 1
+        total_weight = receipt.weight['ref_time'] if receipt.is_success else 0
+        total_fee = receipt.total_fee_amount
+        items = []
+        for i, ((path, amount), ok) in enumerate(zip(swaps, results)):
+            share = total_weight * gas[i] / executed if ok is not None else 0
+            items.append((path, amount, ok, share))
+            if self.metrics is not None:
+                intended_i = intended[i] if intended else None
+                error = None if ok else ('NotExecuted' if ok is None else 'Utility:ItemFailed')
+                if not receipt.is_success:
+                    error = error_class(receipt)
+                self.metrics.record(intended_i, submitted, in_block, receipt.block_hash, len(path) - 1, share, total_fee / len(calls), error, len(calls))
 
-    def trade_tokens(self, path, amount):
-        method = 'Router::swap_exact_tokens_for_native' if path[-1] == self.dex.wnative_address else 'Router::swap_exact_tokens_for_tokens'
-        args = {'path': path, 'amount_in': amount, 'amount_out_min': 1, 'to': self.addr(), 'deadline': FOREVER}
-        return call_contract(self.router, self.kp, method=method, args=args)
+        n_ok = sum(1 for ok in results if ok)
+        self.log(f'Batch of {len(calls)} swaps: {n_ok} ok  weight {weight(receipt) if receipt.is_success else 0:.1f} '
+                 f'({(total_weight / len(calls)) / TIME_UNIT:.2f} per swap)  fee {fee(receipt):.5f} ({fee(receipt) / len(calls):.5f} per swap)\n')
+        if n_ok and self.quotes is not None:
+            self.quotes.apply_events(receipt)
+        if self.gas_cache is not None:
+            # ItemFailed does not tell the error by name, so the estimate of every failed swap is refreshed
+            for (path, amount), ok in zip(swaps, results):
+                if ok is False:
+                    self.gas_cache.invalidate(self.router, *self.swap_args(path, amount)[:2])
+        self.account([receipt], list({t for path, _ in swaps for t in (path[0], path[-1])}))
+        return receipt, items
+
+    def collect(self, wait=False):
+        """Pick up results of pipelined trades. Balances of all touched tokens are refreshed once per call."""
+        done = self.pipeline.collect(wait)
+        touched = set()
+        receipts = []
+        for sub in done:
+            path, amount = sub.tag
+            touched.update([path[0], path[-1]])
+            self.balances[self.balance_key(path[0])] += amount
+            if sub.receipt is not None:
+                receipts.append(sub.receipt)
+                if self.metrics is not None:
+                    self.metrics.record_receipt(sub.receipt, sub.submitted, sub.included, len(path) - 1, sub.intended)
+            elif self.metrics is not None:
+                self.metrics.record(sub.intended, sub.submitted, path_len=len(path) - 1, error='Timeout')
+            if sub.receipt is not None and sub.receipt.is_success:
+                self.log(f'Trade {"->".join(list(map(self.symbol,path)))}  weight {weight(sub.receipt):.1f}  block {sub.receipt.block_number}\n')
+                if self.quotes is not None:
+                    self.quotes.apply_events(sub.receipt)
+            else:
+                self.log(f'Trade {"->".join(list(map(self.symbol,path)))}  FAILED\n')
+                if self.gas_cache is not None and sub.receipt is not None and out_of_gas(sub.receipt):
+                    self.gas_cache.invalidate(self.router, *self.swap_args(path, amount)[:2])
+        self.account(receipts, list(touched))
+        return done
+
+    def balance_key(self, token):
+        return NATIVE if token == self.dex.wnative_address else token
+
+    def refresh_reserves(self, path):
+        """Read reserves along `path` into the QuoteEngine, on every `refresh_quotes`-th trade."""
+        if self.quotes is None or not self.refresh_quotes:
+            return
+        if self.quoted % self.refresh_quotes == 0:
+            self.quotes.refresh(self.reader, path)
+        self.quoted += 1
+
+    def swap_args(self, path, amount):
+        """Router method, its args and transferred value for a swap of exact `amount` along `path`."""
+        amount_out_min = 1 if self.quotes is None else self.quotes.amount_out_min(path, amount, self.slippage)
+        return swap_args(self.dex, self.addr(), path, amount, amount_out_min)
+
+    def swap(self, path, amount):
+        """Single router swap of exact `amount` along `path`, native coin in or out if the path starts or ends
+        with wnative (see swap_args()). Waits for inclusion, returns the receipt."""
+        return call_contract(self.router, self.kp, *self.swap_args(path, amount), gas_cache=self.gas_cache)
 
 #    def trade_native_for_token(self, path, amount):
 #        args = {'path': path, 'amount_out_min': 1, 'to': self.addr(), 'deadline': FOREVER}
@@ -119,7 +339,7 @@ class Trader:
 #        appr_args = {'spender': self.router.contract_address, 'delta_value': amount}
 #        method = 'Router::swap_exact_tokens_for_native' if path[-1] == self.dex.wnative_address else 'Router::swap_exact_tokens_for_tokens'
 #        trade_args = {'path': path, 'amount_in': amount, 'amount_out_min': 0, 'to': self.addr(), 'deadline': FOREVER}
-#        approve = build_contract_call(self.tokens[path[0]], self.kp, method='PSP22::increase_allowance', args=appr_args)
+#        approve = build_contract_call(self.token(path[0]), self.kp, method='PSP22::increase_allowance', args=appr_args)
 #        trade = build_contract_call(self.router, self.kp, method=method, args=trade_args)
 #        #return send_single_call(trade, self.chain, self.kp)
 #        return send_batch([approve, trade], self.chain, self.kp)
@@ -133,14 +353,15 @@ class Trader:
         amount = random.randint(int(0.2 * balance), int(0.6 * balance))
         self.log(f'Direct trade {"->".join(list(map(self.symbol,path)))}  ')
         pair_address = self.dex.get_pair(path[0], path[1])
-        token_in = ContractInstance.create_from_address(path[0], self.dex.psp22_metadata, self.chain)
-        receipt = call_contract(token_in, self.kp, method='PSP22::transfer', args={'to': pair_address, 'value': amount, '_data': []})
+        token_in = self.token(path[0])
+        receipt = call_contract(token_in, self.kp, method='PSP22::transfer', args={'to': pair_address, 'value': amount, '_data': []}, gas_cache=self.gas_cache)
         if not receipt.is_success:
             self.log('PSP22 transfer failed!\n')
             return
         weight_tr = weight(receipt)
+        transfer_receipt = receipt
 
-        pair = ContractInstance.create_from_address(pair_address, self.dex.pair_metadata, self.chain)
+        pair = self.reader.contract(pair_address, self.dex.pair_metadata)
         reserves = pair.read(keypair=self.kp, method='Pair::get_reserves').contract_result_data.value['Ok']
         if path[0] < path[1]:
             amount_0_out = 0
@@ -149,15 +370,50 @@ class Trader:
             amount_0_out = get_amount_out(amount, reserves[1], reserves[0])
             amount_1_out = 0
         args = {'amount_0_out': amount_0_out, 'amount_1_out': amount_1_out, 'to': self.addr(), 'data': None}
-        receipt = call_contract(pair, self.kp, method='Pair::swap', args=args)
+        receipt = call_contract(pair, self.kp, method='Pair::swap', args=args, gas_cache=self.gas_cache)
         if receipt.is_success:
             weight = weight(receipt)
             self.log(f'weights {weight_tr} {weight} \n')
-            self.update_balances([path[0], path[1]])
         else:
             self.log('FAILED\n')
+        self.account([transfer_receipt, receipt], [path[0], path[1]])
         return receipt
 
 
-def get_amount_out(amount_in, reserve_0, reserve_1):
-    return (amount_in * 997 * reserve_1) // (reserve_0 * 1000 + amount_in * 997)
+def pick_trade(dex, balances, max_path_len=2, minimal_balance=1000000):
+    """Random path starting with a token (or native coin) held in `balances` and a random amount to trade."""
+    candidates = [t for t in balances if balances[t] >= minimal_balance and t != dex.wnative_address]
+    start = random.choice(candidates)
+    if start == NATIVE:
+        start = dex.wnative_address
+    path = dex.random_path(start, max_path_len)
+    return path, pick_amount(dex, balances, path)
+
+
+def pick_amount(dex, balances, path):
+    """Random amount of the first token of `path` to trade: a small part of native balance, a large one of PSP22."""
+    if path[0] == dex.wnative_address:
+        balance = balances[NATIVE]
+        return random.randint(int(0.0001 * balance), int(0.01 * balance))
+    balance = balances[path[0]]
+    return random.randint(int(0.2 * balance), int(0.6 * balance))
+
+
+def orient_path(dex, balances, path, minimal_balance=1000000):
+    """`path` if its first token is held (at least `minimal_balance`), reversed if only the last one is, else None."""
+    held = lambda t: balances[NATIVE if t == dex.wnative_address else t] >= minimal_balance
+    if held(path[0]):
+        return path
+    if held(path[-1]):
+        return path[::-1]
+    return None
+
+
+def swap_args(dex, to, path, amount, amount_out_min=1):
+    """Router method, its args and transferred value for a swap of exact `amount` along `path`."""
+    args = {'path': path, 'amount_out_min': amount_out_min, 'to': to, 'deadline': FOREVER}
+    if path[0] == dex.wnative_address:
+        return 'Router::swap_exact_native_for_tokens', args, amount
+    method = 'Router::swap_exact_tokens_for_native' if path[-1] == dex.wnative_address else 'Router::swap_exact_tokens_for_tokens'
+    args['amount_in'] = amount
+    return method, args, 0
@@ -0,0 +1,139 @@
+import math
+import random
+from collections import namedtuple
+from time import perf_counter, sleep, time
+
+Order = namedtuple('Order', ['steps', 'intended', 'sent', 'path'], defaults=(None,))
+Order.__doc__ = """Signal for a trader: perform a trade with `steps` swaps. `intended` is the time (time.time()) the order
+was scheduled for by the load generator, `sent` the time it was actually dispatched. Latency measured from
+`intended` is free from coordinated omission. `path` is set when a Scheduler chose the path (see schedule.py),
+otherwise the trader picks a random one."""
+
+
+class Constant:
+    """`rate` orders per second, evenly spaced, for `duration` seconds (None means forever)."""
+    def __init__(self, rate, duration=None):
+        self.rate = rate
+        self.duration = duration
+
+    def rate_at(self, t):
+        return self.rate
+
+    def times(self):
+        i = 0
+        while self.rate > 0:
+            t = i / self.rate
+            if self.duration is not None and t >= self.duration:
+                return
+            yield t
+            i += 1
+
+
+class Poisson(Constant):
+    """Poisson process with mean `rate` orders per second (exponential gaps), for `duration` seconds."""
+    def __init__(self, rate, duration=None, seed=None):
+        super().__init__(rate, duration)
+        self.rng = random.Random(seed)
+
+    def times(self):
+        if self.rate <= 0:
+            return
+        t = self.rng.expovariate(self.rate)
+        while self.duration is None or t < self.duration:
+            yield t
+            t += self.rng.expovariate(self.rate)
+
+
+class Ramp:
+    """Rate changing linearly from `start` to `end` orders per second over `duration` seconds."""
+    def __init__(self, start, end, duration):
+        self.start = start
+        self.end = end
+        self.duration = duration
+
+    def rate_at(self, t):
+        return self.start + (self.end - self.start) * min(t, self.duration) / self.duration
+
+    def times(self):
+        # invert the cumulative number of orders: n(t) = start * t + (end - start) * t^2 / (2 * duration)
+        a = (self.end - self.start) / (2 * self.duration)
+        if a == 0 and self.start <= 0:
+            return
+        i = 0
+        while True:
+            t = i / self.start if a == 0 else (-self.start + math.sqrt(self.start ** 2 + 4 * a * i)) / (2 * a)
+            if t >= self.duration:
+                return
+            yield t
+            i += 1
+
+
+class Step:
+    """Sequence of profiles run one after another, e.g. Step([Constant(10, 60), Constant(20, 60)]).
+    All but the last must have a finite duration."""
+    def __init__(self, profiles):
+        self.profiles = profiles
+        self.duration = None if any(p.duration is None for p in profiles) else sum(p.duration for p in profiles)
+
+    def rate_at(self, t):
+        for p in self.profiles:
+            if p.duration is None or t < p.duration:
+                return p.rate_at(t)
+            t -= p.duration
+        return 0
+
+    def times(self):
+        offset = 0
+        for p in self.profiles:
+            for t in p.times():
+                yield offset + t
+            if p.duration is None:
+                return
+            offset += p.duration
+
+
+def make_profile(spec):
+    """Build a profile from a dict, e.g. {'type': 'poisson', 'rate': 50, 'duration': 60, 'seed': 1}
+    or {'type': 'step', 'steps': [{'type': 'constant', 'rate': 10, 'duration': 30}, ...]}."""
+    spec = dict(spec)
+    kind = spec.pop('type')
+    if kind == 'step':
+        return Step([make_profile(s) for s in spec['steps']])
+    profiles = {'constant': Constant, 'poisson': Poisson, 'ramp': Ramp}
+    if kind not in profiles:
+        raise ValueError(f'Unknown rate profile: {kind}')
+    return profiles[kind](**spec)
+
+
+def wait_until(deadline, stop=None):
+    """Wait until perf_counter() reaches `deadline`, or until `stop` (an Event) is set. Return True if it is set."""
+    left = deadline - perf_counter()
+    if stop is not None:
+        return stop.wait(left) if left > 0 else stop.is_set()
+    if left > 0:
+        sleep(left)
+    return False
+
+
+def make_traffic(queue, profile, stop, steps=1, seed=None):
+    """Open-loop load generator: put an Order into `queue` at each time of the profile, regardless of how many orders
+    are still waiting. Runs until the profile ends or `stop` (multiprocessing.Event) is set. If the generator itself
+    falls behind, orders are sent immediately, but they keep their intended times.
+    `steps` is the number of swaps per order, or a dict {steps: weight} to draw it for every order (with `seed`)."""
+    rng = random.Random(seed)
+    mix = (list(steps), list(steps.values())) if isinstance(steps, dict) else None
+    start_wall, start = time(), perf_counter()
+    for t in profile.times():
+        if wait_until(start + t, stop):
+            return
+        n = rng.choices(*mix)[0] if mix else steps
+        queue.put(Order(n, start_wall + t, time()))
+
+
+def latency_summary(latencies):
+    """Short text summary of a list of latencies (in seconds)."""
+    if not latencies:
+        return 'no data'
+    latencies = sorted(latencies)
+    p = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+    return f'mean {sum(latencies) / len(latencies):.3f}s  p50 {p(0.5):.3f}s  p99 {p(0.99):.3f}s  max {latencies[-1]:.3f}s'
@@ -1,23 +1,70 @@
-from os.path import isfile, join
-from substrateinterface import Keypair, SubstrateInterface
+import json
+from itertools import count
+from concurrent.futures import ProcessPoolExecutor
+from os.path import abspath, isfile, join
+from time import time
+from scalecodec.base import ScaleBytes
+from substrateinterface import ContractInstance, ContractMetadata, ExtrinsicReceipt, Keypair, SubstrateInterface
+from substrateinterface.contracts import ContractEvent, ContractExecutionReceipt
+
+from . import profiler
+from .profiler import stage
 
 TIME_UNIT = 10**9
 AZERO = 10**12
+MOCK_SCHEME = 'mock://'
+PARSED_METADATA = {}
+SIGNED = {}
+SIGNATURES = count()
 
 
 def check_url(url):
-    """Make sure that the provided WebSocket address is legit. Resolve shortcut aliases."""
+    """Make sure that the provided WebSocket address (or mock:// URL, see mock.py) is legit. Resolve shortcut aliases."""
     aliases = {
         'testnet': 'wss://ws.test.azero.dev',
         'mainnet': 'wss://ws.azero.dev',
         'local': 'ws://127.0.0.1:9944'
     }
     address = aliases.get(url, url)
-    if not address.startswith(('wss://', 'ws://')):
+    if not address.startswith(('wss://', 'ws://', MOCK_SCHEME)):
         raise ValueError(f'Invalid WebSocket URL: {url}')
     return address
 
 
+class Substrate(SubstrateInterface):
+    """SubstrateInterface which also creates the contract handles, receipts and decoded contract events used by this
+    package. Code going through these methods runs unchanged on a MockSubstrate (see mock.py)."""
+    def contract_metadata(self, metadata_file):
+        return ContractMetadata(read_metadata(metadata_file), self)
+
+    def contract(self, address, metadata):
+        return ContractInstance(address, metadata, self)
+
+    def contract_receipt(self, receipt, contract):
+        """ContractExecutionReceipt of a call to `contract` from its ExtrinsicReceipt."""
+        return ContractExecutionReceipt.create_from_extrinsic_receipt(receipt, contract.metadata, contract.contract_address)
+
+    def extrinsic_receipt(self, extrinsic_hash, block_hash, block_number, extrinsic_idx):
+        return ExtrinsicReceipt(self, extrinsic_hash=extrinsic_hash, block_hash=block_hash, block_number=block_number,
+                                extrinsic_idx=extrinsic_idx)
+
+    def decode_contract_event(self, event, metadata):
+        """(name, args) of a ContractEmitted event record, decoded with ContractMetadata of the emitting contract."""
+        decoded = ContractEvent(data=ScaleBytes(event['event'][1][1]['data'].value_object),
+                                runtime_config=self.runtime_config, contract_metadata=metadata)
+        decoded.decode()
+        return decoded.name, {arg['label']: arg['value'] for arg in decoded.args}
+
+
+def connect(url, **kwargs):
+    """New connection to `url`: a Substrate, or a MockSubstrate for mock:// URLs."""
+    url = check_url(url)
+    if url.startswith(MOCK_SCHEME):
+        from .mock import connect as connect_mock
+        return connect_mock(url)
+    return Substrate(url=url, **kwargs)
+
+
 def check_file(*path):
     """Make sure file exists."""
     path = join(*path)
@@ -33,6 +80,33 @@ def check_address(account_id, chain):
     return account_id
 
 
+def read_metadata(metadata_file):
+    """Contract metadata JSON, parsed once per process. Read before forking workers (see Dex.preload_metadata()),
+    the parsed dict is inherited by all of them. Connections turn it into ContractMetadata (Substrate.contract_metadata()).
+    Metadata registered under a name which is not a file (see mock.METADATA) is returned as is."""
+    path = metadata_file if metadata_file in PARSED_METADATA else abspath(metadata_file)
+    if path not in PARSED_METADATA:
+        with open(path, encoding='utf-8') as f:
+            PARSED_METADATA[path] = json.load(f)
+    return PARSED_METADATA[path]
+
+
+def derive_key(uri):
+    kp = Keypair.create_from_uri(uri)
+    return kp.public_key, kp.private_key, kp.ss58_format, kp.crypto_type
+
+
+def derive_keypairs(phrase, indices, workers=None):
+    """Keypairs for `phrase`//i for all `indices`. Derivation takes a few ms per account, so for many accounts
+    it is spread over a process pool of `workers` processes (default: number of CPUs)."""
+    uris = [f'{phrase}//{i}' for i in indices]
+    if workers == 1 or len(uris) < 100:
+        return [Keypair.create_from_uri(u) for u in uris]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        keys = list(executor.map(derive_key, uris, chunksize=50))
+    return [Keypair(public_key=pub, private_key=priv, ss58_format=fmt, crypto_type=crypto) for pub, priv, fmt, crypto in keys]
+
+
 def weight(extrinsic_receipt):
     return extrinsic_receipt.weight["ref_time"] / TIME_UNIT
 
@@ -41,49 +115,200 @@ def fee(extrinsic_receipt):
     return extrinsic_receipt.total_fee_amount / AZERO
 
 
-def call_contract(contract, keypair, method, args, value=0, gas_factor=1.01):
-    """Simple wrapper which mimics ContractInstance.exec() with no gas limit, but relaxes the gas estimate returned from dry-run by `gas_factor`."""
-    gas_limit = contract.read(keypair=keypair, method=method, args=args, value=value).gas_required
-    gas_limit['ref_time'] = int(gas_factor * gas_limit['ref_time'])
-    return contract.exec(keypair=keypair, method=method, args=args, value=value, gas_limit=gas_limit)
+class GasCache:
+    """Cache of gas estimates for contract calls, keyed by contract address, method and length of `path` arg.
+
+    Stores raw `gas_required` returned by a dry-run, the caller's `gas_factor` margin is applied on every get().
+    An entry is refreshed with a live dry-run after being used `refresh_every` times or after `max_age` seconds
+    (None disables either rule). Call invalidate() after a call ran out of gas, call_contract() does that itself.
+    """
+    def __init__(self, refresh_every=1000, max_age=None):
+        self.refresh_every = refresh_every
+        self.max_age = max_age
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+
+    @staticmethod
+    def key(contract, method, args):
+        return contract.contract_address, method, len(args.get('path', ())) if args else 0
+
+    def get(self, contract, keypair, method, args, value=0, gas_factor=1.01):
+        key = self.key(contract, method, args)
+        entry = self.entries.get(key)
+        if entry is None or self.expired(entry):
+            self.misses += 1
+            gas = dry_run(contract, keypair, method, args, value)
+            entry = self.entries[key] = [gas, 0, time()]
+        else:
+            self.hits += 1
+        entry[1] += 1
+        gas_limit = dict(entry[0])
+        gas_limit['ref_time'] = int(gas_factor * gas_limit['ref_time'])
+        return gas_limit
+
+    def expired(self, entry):
+        _, uses, created = entry
+        if self.refresh_every is not None and uses >= self.refresh_every:
+            return True
+        return self.max_age is not None and time() - created > self.max_age
+
+    def invalidate(self, contract, method, args):
+        self.fallbacks += 1
+        self.entries.pop(self.key(contract, method, args), None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'fallbacks': self.fallbacks,
+            'hit_rate': self.hits / total if total else 0.0,
+            'entries': len(self.entries)
+        }
+
+
+def contract_events(receipt, metadata_for):
+    """Decode ContractEmitted events triggered by the extrinsic. `metadata_for(address)` should return metadata
+    of the emitting contract (from contract_metadata() of the connection), or None to skip its events.
+    Return a list of (contract_address, event_name, args) tuples."""
+    result = []
+    for event in receipt.triggered_events:
+        if event.value['module_id'] != 'Contracts' or event.value['event_id'] != 'ContractEmitted':
+            continue
+        address = event.value['attributes']['contract']
+        metadata = metadata_for(address)
+        if metadata is None:
+            continue
+        result.append((address, *receipt.substrate.decode_contract_event(event, metadata)))
+    return result
 
 
-def build_contract_call(contract, keypair, method, args, value=0, gas_factor=1.05):
-    gas_limit = contract.read(keypair=keypair, method=method, args=args, value=value).gas_required
+def out_of_gas(receipt):
+    return not receipt.is_success and receipt.error_message is not None and receipt.error_message['name'] == 'OutOfGas'
+
+
+def dry_run(contract, keypair, method, args, value=0):
+    """Gas required by a contract call, from a dry-run."""
+    with stage('dry_run'):
+        return contract.read(keypair=keypair, method=method, args=args, value=value).gas_required
+
+
+def estimate_gas(contract, keypair, method, args, value, gas_factor, gas_cache=None):
+    if gas_cache is not None:
+        return gas_cache.get(contract, keypair, method, args, value, gas_factor)
+    gas_limit = dry_run(contract, keypair, method, args, value)
     gas_limit['ref_time'] = int(gas_factor * gas_limit['ref_time'])
-    data = contract.metadata.generate_message_data(name=method, args=args)
-    return contract.substrate.compose_call(call_module='Contracts', call_function='call', call_params={
-        'dest': contract.contract_address,
-        'value': value,
-        'gas_limit': gas_limit,
-        'storage_deposit_limit': None,
-        'data': data.to_hex()
-    })
+    return gas_limit
+
+
+def call_contract(contract, keypair, method, args, value=0, gas_factor=1.01, gas_cache=None):
+    """Simple wrapper which mimics ContractInstance.exec() with no gas limit, but relaxes the gas estimate returned from dry-run by `gas_factor`.
+    With `gas_cache` the dry-run is skipped when possible. If the cached estimate turns out too low, the call is repeated once with a live estimate."""
+    gas_limit = estimate_gas(contract, keypair, method, args, value, gas_factor, gas_cache)
+    receipt = execute(contract, keypair, method, args, value, gas_limit)
+    if gas_cache is not None and out_of_gas(receipt):
+        gas_cache.invalidate(contract, method, args)
+        gas_limit = estimate_gas(contract, keypair, method, args, value, gas_factor, gas_cache)
+        receipt = execute(contract, keypair, method, args, value, gas_limit)
+    return receipt
+
+
+def sign(chain, call, keypair, nonce=None):
+    """chain.create_signed_extrinsic() which remembers the nonce used (see last_signed())."""
+    if nonce is None:
+        nonce = chain.get_account_nonce(keypair.ss58_address) or 0
+    extrinsic = chain.create_signed_extrinsic(call=call, keypair=keypair, nonce=nonce)
+    SIGNED[keypair.ss58_address] = (next(SIGNATURES), nonce)
+    return extrinsic
+
+
+def last_signed(address):
+    """(serial number, nonce) of the last extrinsic of `address` signed in this process with sign(), None if none was."""
+    return SIGNED.get(address)
+
+
+def execute(contract, keypair, method, args, value, gas_limit):
+    """Same as ContractInstance.exec() with a gas limit, but split into stages seen by the profiler."""
+    call = contract_call(contract, method, args, value, gas_limit)
+    with stage('sign'):
+        extrinsic = sign(contract.substrate, call, keypair)
+    with stage('rpc'):
+        receipt = contract.substrate.submit_extrinsic(extrinsic, wait_for_inclusion=True)
+    return decode_receipt(contract.substrate.contract_receipt(receipt, contract))
+
+
+def decode_receipt(receipt):
+    """Events of a receipt are fetched and decoded lazily, on first access. When profiling, do it right away,
+    so that it is counted as the `receipt` stage."""
+    if profiler.PROFILER is not None:
+        with stage('receipt'):
+            receipt.is_success
+    return receipt
+
+
+def build_contract_call(contract, keypair, method, args, value=0, gas_factor=1.05, gas_cache=None):
+    gas_limit = estimate_gas(contract, keypair, method, args, value, gas_factor, gas_cache)
+    return contract_call(contract, method, args, value, gas_limit)
+
+
+def contract_call(contract, method, args, value, gas_limit):
+    """Contracts::call with a known gas limit, no dry-run."""
+    with stage('encode'):
+        data = contract.metadata.generate_message_data(name=method, args=args)
+        return contract.substrate.compose_call(call_module='Contracts', call_function='call', call_params={
+            'dest': contract.contract_address,
+            'value': value,
+            'gas_limit': gas_limit,
+            'storage_deposit_limit': None,
+            'data': data.to_hex()
+        })
 
 
 def send_single_call(call, chain, keypair, wait=True):
-    extrinsic = chain.create_signed_extrinsic(call=call, keypair=keypair)
+    extrinsic = sign(chain, call, keypair)
     return chain.submit_extrinsic(extrinsic, wait_for_inclusion=wait)
 
 
-def send_batch(calls, chain, keypair, wait=True):
-    batch = chain.compose_call(call_module='Utility', call_function='batch', call_params={'calls': calls})
-    extrinsic = chain.create_signed_extrinsic(call=batch, keypair=keypair)
-    return chain.submit_extrinsic(extrinsic, wait_for_inclusion=wait)
+def send_batch(calls, chain, keypair, wait=True, atomic=False):
+    """Send `calls` in a single Utility::batch extrinsic (Utility::batch_all if `atomic`, reverting all calls if any fails)."""
+    with stage('encode'):
+        batch = chain.compose_call(call_module='Utility', call_function='batch_all' if atomic else 'batch', call_params={'calls': calls})
+    with stage('sign'):
+        extrinsic = sign(chain, batch, keypair)
+    with stage('rpc'):
+        receipt = chain.submit_extrinsic(extrinsic, wait_for_inclusion=wait)
+    return decode_receipt(receipt) if wait else receipt
 
 
-def fund_traders(chain_url, n_traders, balance, stash_phrase, trader_phrase):
-    """Send `balance` native coins from an account generated by `stash_phrase` to `n_traders` accounts generated by `trader_phrase`.
-    Funded accounts are: trader_phrase//0, trader_phrase//1, ... , trader_phrase//(n_traders-1)
-    """
-    stash_keypair = Keypair.create_from_uri(stash_phrase)
-    chain = SubstrateInterface(url=check_url(chain_url))
-    calls = []
-    for i in range(n_traders):
-        trader_addr = Keypair.create_from_uri(f'{trader_phrase}//{i}').ss58_address
-        call = chain.compose_call(call_module='Balances', call_function='transfer_keep_alive', call_params={'dest': trader_addr, 'value': balance * AZERO})
-        calls.append(call)
-
-    receipt = send_batch(calls, chain, stash_keypair)
-    if not receipt.is_success:
-        print(f'Error in batch transfer: {receipt.error_message["docs"]}')
+def call_gas(call):
+    """ref_time of the gas limit of a call built with build_contract_call()."""
+    return call.value['call_args']['gas_limit']['ref_time']
+
+
+def batch_results(receipt, n_calls):
+    """Outcome of each call of a Utility batch: True (completed), False (failed) or None (not executed,
+    because an earlier call interrupted the batch). Based on ItemCompleted/ItemFailed/BatchInterrupted events.
+    A failed batch_all reverts everything, so all its calls are reported as failed."""
+    return batch_items(receipt.triggered_events, n_calls, receipt.is_success)
+
+
+def batch_items(events, n_calls, success=True):
+    """Same as batch_results(), from `events` of the batch extrinsic (event records, like in receipts or from get_events())
+    and `success` of the whole extrinsic."""
+    if not success:
+        return [False] * n_calls
+    results = []
+    for event in events:
+        if event.value['module_id'] != 'Utility':
+            continue
+        name = event.value['event_id']
+        if name == 'ItemCompleted':
+            results.append(True)
+        elif name == 'ItemFailed':
+            results.append(False)
+        elif name == 'BatchInterrupted':
+            results.append(False)
+            break
+    return results + [None] * (n_calls - len(results))